@@ -0,0 +1,51 @@
+from os import makedirs, path
+import sqlite3
+
+
+class AnnotationCache():
+    '''This class stores the snpEff annotation of every variant annotated so far in a sqlite database that is shared by all samples.
+    Annotations are keyed by chrom, pos, ref, alt and the snpEff version (database and parameters), the value is the INFO fields
+    snpEff added to the record (ANN, LOF, NMD). The header lines snpEff adds are stored once per version'''
+
+    def __init__(self, database, version):
+        self.database = database
+        self.version = version
+        makedirs(path.dirname(database), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS annotations (chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, version TEXT, info TEXT,
+                                  PRIMARY KEY (chrom, pos, ref, alt, version))''')
+            connection.execute("CREATE TABLE IF NOT EXISTS headers (version TEXT PRIMARY KEY, lines TEXT)")
+
+    #---------------------------------------------------------------------------
+    def connect(self):
+        '''Returns a connection to the database, several samples may annotate at the same time'''
+
+        return sqlite3.connect(self.database, timeout=60)
+
+    #---------------------------------------------------------------------------
+    def lookup(self, keys):
+        '''Returns {(chrom, pos, ref, alt): info} for the keys that are in the cache'''
+
+        found = {}
+        with self.connect() as connection:
+            for chrom, pos, ref, alt in keys:
+                row = connection.execute("SELECT info FROM annotations WHERE chrom = ? AND pos = ? AND ref = ? AND alt = ? AND version = ?", (chrom, pos, ref, alt, self.version)).fetchone()
+                if row:
+                    found[(chrom, pos, ref, alt)] = row[0]
+        return found
+
+    #---------------------------------------------------------------------------
+    def store(self, annotations, header_lines):
+        '''Stores {(chrom, pos, ref, alt): info} and the snpEff header lines of this version'''
+
+        with self.connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?)", [(*key, self.version, info) for key, info in annotations.items()])
+            connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?)", (self.version, "\n".join(header_lines)))
+
+    #---------------------------------------------------------------------------
+    def header_lines(self):
+        '''Returns the header lines snpEff adds, or None if this version has not annotated anything yet'''
+
+        with self.connect() as connection:
+            row = connection.execute("SELECT lines FROM headers WHERE version = ?", (self.version,)).fetchone()
+        return row[0].splitlines() if row else None
@@ -1,5 +1,5 @@
 # Packages used in script
-from os import listdir, sys, mkdir, getenv, path, rename, remove
+from os import listdir, sys, mkdir, getenv, path, rename, remove, stat
 import subprocess
 import argparse
 import csv
@@ -7,8 +7,14 @@ import multiprocessing as mp
 import time
 import timeit
 import re
-from shutil import copy
-from functools import partial
+import random
+import json
+import hashlib
+from shutil import copy, rmtree
+from storage import Storage
+from executor import Job, create_executor
+from annotation_cache import AnnotationCache
+from reference_bundle import ReferenceBundle
 
 
 
@@ -16,121 +22,351 @@ from functools import partial
 class DnaSeqAnalysis():
 
     def __init__(self):
-        pass
+        self.storage = Storage()
+        # bwa-mem2 loads the whole index per job, so lanes are aligned in parallel only with at least this many threads per job
+        self.alignment_threads_per_job = 8
+        # Memory (GB) requested per job from the executor
+        self.job_memory = {"bwa-mem2": 32, "split": 1, "samtools merge": 4, "SortSam": 24, "MergeSamFiles": 4, "MarkDuplicates": 75, "samtools index": 1, "LeftAlignIndels": 8, "HaplotypeCaller": 6, "delly": 8, "samtools cat": 1, "bwa-mem2 index": 64}
+        # Fast BAM validation: empty BGZF block that ends every complete BAM file, and how many records are sampled
+        self.bgzf_eof = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+        self.validation_regions = 10
+        self.validation_records = 1000
+        # Heap (GB) per Picard ValidateSamFile in the deep validation and the background process running it
+        self.validation_heap = 8
+        # Share of the memory budget reserved for the deep validation while the following stages run
+        self.validation_memory_share = 0.25
+        self.deep_validation = None
+        # Times a failed HaplotypeCaller chunk is started again before the calling stops
+        self.haplotypecaller_retries = 2
+        # delly call runs once per SV type
+        self.delly_sv_types = ["DEL", "DUP", "INV", "BND", "INS"]
+        # Size (bp) of the reference windows, two windows per chunk of the chunked stages
+        self.reference_chunk_size = 10000000
+        # snpEff database and parameters, both are part of the annotation cache key
+        self.snpeff_database = "GRCh38.99"
+        self.snpeff_parameters = "-canon -noInteraction -noNextProt -noMotif -strict -onlyProtein"
 
 
     #---------------------------------------------------------------------------
-    def index_genome_dna(self, misc, shortcuts):
-        '''Runs bwa-mem2 index in the linux shell to index the reference genome'''
+    def index_genome_dna(self, options, misc, shortcuts):
+        '''Indexes the reference genome. bwa-mem2 index, samtools dict and samtools faidx with the chunk planning run at the same time
+        as executor jobs, the index is complete when all of them are. With --reference_bundle the index is built in a new version of
+        the shared bundle, which is published read-only when it is complete'''
+        misc.set_log_context(stage="index_genome_dna")
         misc.log_to_file("INFO", 'Starting: index_genome_dna')
         start = timeit.default_timer()
 
         try:
-            # Create shortcuts
-            misc.log_to_file("DEBUG", "# Create shortcuts")
-            ref_file = shortcuts.reference_genome_file
-            chunks_dir = shortcuts.reference_genome_chunks_dir
-            allready_completed = shortcuts.bwa_index_complete
-
-
-
-            # Check if step is allready completed
-            misc.log_to_file("DEBUG", "# Check if step is allready completed")
-            if not misc.step_allready_completed(allready_completed, f"Indexing {ref_file.split('/')[-1]}"):
-                misc.clear_screen()
-
-                cmd_bwa_index = f"bwa-mem2 index {ref_file}"
-                misc.run_command(cmd_bwa_index, "Bwa-mem2 index", f"{ref_file}.sa", None)
-
-                cmd_create_dict = f"samtools dict {ref_file} -o {ref_file[:-2]}dict"
-                misc.run_command(cmd_create_dict, "Creating .dict with samtools dict", f"{ref_file[:-2]}dict", None)
-
-                cmd_create_fai = f"samtools faidx {ref_file} -o {ref_file}.fai"
-                misc.run_command(cmd_create_fai, "Creating .fai with samtools faidx", f"{ref_file}.fai", None)
-
-            cmd_split_fasta = f"bedtools makewindows -w 10000000 -g {ref_file}.fai > {chunks_dir}chunk.bed"
-            misc.run_command(cmd_split_fasta, "Spliting fa.fai with bedtools makewindows", f"{chunks_dir}chunk.bed", None)
-            cmd_split_bed = f"split -l 2 {chunks_dir}chunk.bed {chunks_dir}chunk_"
-            misc.run_command(cmd_split_bed, "Splitting chunk.bed", None, allready_completed)
-
-            # add suffix .bed to split files
-            for file in listdir(chunks_dir):
-                if not file.endswith("bed"): rename(f"{chunks_dir}{file}", f"{chunks_dir}{file}.bed")
-                if file == "chunk.bed": remove(f"{chunks_dir}{file}")
-            misc.log_to_file("INFO", 'Renaming chunk_* > chunk_*.bed succesfully completed - OK!')
+            source_file = shortcuts.reference_genome_source_file
+            fasta = path.basename(source_file)
+            cmd_bwa_index = "bwa-mem2 index {fasta}"
+            cmd_create_dict = "samtools dict {fasta} -o {dict}"
+            cmd_create_fai = f"rm -f {{chunks_dir}}chunk_*.bed && samtools faidx {{fasta}} -o {{fasta}}.fai && bedtools makewindows -w {self.reference_chunk_size} -g {{fasta}}.fai | split -l 2 --additional-suffix=.bed - {{chunks_dir}}chunk_"
+
+            if shortcuts.reference_bundle_dir:
+                bundle = ReferenceBundle(shortcuts.reference_bundle_dir)
+                version = bundle.version(misc, source_file, [cmd_bwa_index, cmd_create_dict, cmd_create_fai])
+                lock = bundle.lock(version)
+                index_dir = f"{bundle.root}{version}/"
+                build_dir = f"{bundle.root}{version}.partial/"
+                if misc.step_allready_completed(f"{index_dir}{bundle.manifest_name}", f"Indexing {fasta} (reference bundle {version})"):
+                    shortcuts.set_reference_index_dir(index_dir)
+                    lock.close()
+                    return input("Press any key to return to DNA analysis menu...")
+                misc.create_directory([f"{build_dir}chunks/"])
+                if not misc.step_allready_completed(f"{build_dir}{fasta}", f"Copying {fasta} to {build_dir}"):
+                    copy(source_file, f"{build_dir}{fasta}.partial")
+                    rename(f"{build_dir}{fasta}.partial", f"{build_dir}{fasta}")
+            else:
+                build_dir = shortcuts.reference_genome_dir
+                if misc.step_allready_completed(shortcuts.bwa_index_complete, f"Indexing {fasta}"):
+                    return input("Press any key to return to DNA analysis menu...")
+                misc.create_directory([f"{build_dir}chunks/"])
+
+            ref_file, chunks_dir = f"{build_dir}{fasta}", f"{build_dir}chunks/"
+            jobs = [Job("index_bwa-mem2", cmd_bwa_index.format(fasta=ref_file), f"{ref_file}.bwt.2bit.64.complete", f"Bwa-mem2 index of {fasta}", 1, self.job_memory["bwa-mem2 index"], stage="index reference"),
+                    Job("index_dict", cmd_create_dict.format(fasta=ref_file, dict=f"{path.splitext(ref_file)[0]}.dict"), f"{path.splitext(ref_file)[0]}.dict.complete", f"Creating .dict of {fasta} with samtools dict", 1, 1, stage="index reference"),
+                    Job("index_faidx", cmd_create_fai.format(fasta=ref_file, chunks_dir=chunks_dir), f"{ref_file}.fai.complete", f"Creating .fai of {fasta} and splitting it into chunks of {self.reference_chunk_size} bp", 1, 1, stage="index reference")]
+            if not create_executor(options, misc, shortcuts).run(jobs):
+                misc.log_to_file("ERROR", f"Indexing {fasta} failed, see the logs in {shortcuts.executor_dir}")
+                sys.exit()
+
+            # The index is only marked complete when every job is
+            if shortcuts.reference_bundle_dir:
+                bundle.publish(misc, build_dir, version)
+                shortcuts.set_reference_index_dir(index_dir)
+                lock.close()
+            else:
+                misc.create_trackFile(shortcuts.bwa_index_complete)
             elapsed = timeit.default_timer() - start
             misc.log_to_file("INFO", f'Indexing reference genome successfully completed in {misc.elapsed_time(elapsed)} - OK!!')
             input("Press any key to return to DNA analysis menu...")
         except Exception as e:
-            misc.log_to_file("ERROR", f"{e}: .index_genome_dna() in dna_seq_analysis.py:")
+            misc.log_exception(".index_genome_dna() in dna_seq_analysis.py:", e)
+            sys.exit()
 
     #---------------------------------------------------------------------------
     def validate_bam_dna(self, options, misc, shortcuts):
-        '''Runs picard ValidateSamFile to check if any errors are present in the aligned files. Returns True/False if errors are found/not found'''
+        '''Runs the fast validation on the aligned files: BGZF end of file marker, header and read groups, index and a sample of
+           records. Returns True/False if no errors/errors are found. With --deep_validation Picard ValidateSamFile is also started
+           in the background, its result is collected with wait_deep_validation()'''
+        misc.set_log_context(stage="validate_bam_dna")
 
         try:
             misc.log_to_file("INFO", "Starting: Validating bam files")
             start = timeit.default_timer()
-            cmd_validate = []
             target_dir = shortcuts.aligned_output_dir
-
-            for sample in listdir(target_dir):
-                path_to_sample = path.join(target_dir, sample)
-                if path.isfile(path_to_sample) and sample.endswith('.bam'):
-                    cmd_validate.append(f"java -Xmx60g -jar $HOME/anaconda3/envs/sequencing/share/picard-2.25.2-0/picard.jar ValidateSamFile -I {path_to_sample} --MODE SUMMARY --IGNORE_WARNINGS true --MAX_OPEN_TEMP_FILES 1000 --MAX_RECORDS_IN_RAM 10000000 --TMP_DIR {path_to_sample}/tmp_validate")
-                else:
-                    misc.log_to_file("ERROR", "File doesn't exist")
-                    
-                    
-            with mp.Pool(processes=3) as pool:
-                pool.map(partial(misc.run_command, "ValidateSamFile", None, None, None), cmd_validate)
+            bam_files = [f"{target_dir}{sample}" for sample in sorted(listdir(target_dir)) if sample.endswith('.bam') and path.isfile(f"{target_dir}{sample}")]
+            if not bam_files:
+                misc.log_to_file("ERROR", f"No .bam files found in {target_dir}")
+                return False
+
+            errors = []
+            for bam in bam_files:
+                errors += [f"{path.basename(bam)}: {error}" for error in self.validate_bam_fast(options, bam)]
+            for error in errors:
+                misc.log_to_file("ERROR", error)
+            if errors:
+                return False
+
+            if options.deep_validation:
+                # The validation gets a fixed share of the budget, the executors of the following stages plan with the rest
+                budget = max(2, int(misc.memory_budget(options) * self.validation_memory_share))
+                self.deep_validation = mp.Process(target=self.validate_bam_deep, args=(options, misc, shortcuts, bam_files, budget))
+                self.deep_validation.start()
+                misc.reserved_memory += budget
+                misc.log_to_file("INFO", f"Picard ValidateSamFile started in the background, {budget} GB of the memory budget is reserved for it")
             elapsed = timeit.default_timer() - start
-            misc.log_to_file("INFO", f'All .bam files succesfully validated in {misc.elapsed_time(elapsed)} - OK!')    
+            misc.log_to_file("INFO", f'All .bam files succesfully validated in {misc.elapsed_time(elapsed)} - OK!')
             return True
 
         except Exception as e:
             misc.log_exception(".validate_bam_dna() in dna_seq_analysis.py:", e)
             sys.exit()
+
+    #---------------------------------------------------------------------------
+    def validate_bam_fast(self, options, bam):
+        '''Checks a BAM file in seconds and returns a list of the errors found (empty if the file is ok)'''
+
+        errors = []
+        # A BAM file that was completely written ends with an empty BGZF block
+        with open(bam, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(0, f.tell() - len(self.bgzf_eof)))
+            if f.read() != self.bgzf_eof:
+                return ["BGZF end of file marker is missing (truncated file)"]
+
+        header = subprocess.run(["samtools", "view", "-H", bam], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if header.returncode != 0:
+            return [f"header can not be read: {header.stderr.strip()}"]
+        lines = header.stdout.splitlines()
+        sequences = [dict(field.split(':', 1) for field in line.split('\t')[1:]) for line in lines if line.startswith('@SQ')]
+        read_groups = [dict(field.split(':', 1) for field in line.split('\t')[1:]) for line in lines if line.startswith('@RG')]
+        read_group_ids = [read_group.get("ID") for read_group in read_groups]
+        if not sequences:
+            errors.append("no @SQ lines in header")
+        if not read_groups:
+            errors.append("no @RG lines in header")
+        if len(set(read_group_ids)) != len(read_group_ids):
+            errors.append("duplicated read group ids in header")
+        for read_group in read_groups:
+            if read_group.get("SM") not in (options.tumor_id, options.normal_id):
+                errors.append(f"read group {read_group.get('ID')} has sample {read_group.get('SM')}, expected {options.tumor_id} or {options.normal_id}")
+
+        # Coordinate sorted files must have an index that is newer than the file, then records are sampled from random regions
+        indexed = "SO:coordinate" in (lines[0] if lines and lines[0].startswith('@HD') else "")
+        if indexed:
+            index = next((index for index in (f"{bam}.bai", f"{bam[:-4]}.bai", f"{bam}.csi") if path.isfile(index)), None)
+            if not index:
+                return errors + ["coordinate sorted but no index (.bai/.csi) found"]
+            if stat(index).st_mtime < stat(bam).st_mtime:
+                errors.append(f"index {path.basename(index)} is older than the file")
+            sampler = random.Random(path.basename(bam))
+            contigs = sampler.choices(sequences, weights=[int(sequence["LN"]) for sequence in sequences], k=self.validation_regions)
+            regions = [f"{contig['SN']}:{position}-{position + 1000}" for contig in contigs for position in [sampler.randrange(1, max(2, int(contig['LN']) - 1000))]]
+            records = subprocess.run(["samtools", "view", "-X", bam, index] + regions, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if records.returncode != 0:
+                return errors + [f"records can not be decoded: {records.stderr.strip()}"]
+            records = records.stdout.splitlines()[:self.validation_records]
+        else:
+            # Not sorted, no index to seek with: read the first records of the file
+            process = subprocess.Popen(["samtools", "view", bam], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            records = [line for _, line in zip(range(self.validation_records), process.stdout)]
+            process.kill()
+            process.wait()
+            if not records:
+                errors.append("no records could be read")
+
+        for record in records:
+            tags = {tag[:2]: tag[5:] for tag in record.rstrip('\n').split('\t')[11:]}
+            if tags.get("RG") not in read_group_ids:
+                errors.append(f"record {record.split()[0]} has read group {tags.get('RG')} that is not in the header")
+                break
+        return errors
+
+    #---------------------------------------------------------------------------
+    def validate_bam_deep(self, options, misc, shortcuts, bam_files, budget):
+        '''Runs picard ValidateSamFile on the bam files, as many at a time as budget (GB) allows'''
+        misc.set_log_context(stage="validate_bam_deep")
+
+        jobs = max(1, min(len(bam_files), budget // self.validation_heap))
+        # The JVM uses memory beyond the heap, the heaps take 80 % of the budget
+        heap = max(2, min(self.validation_heap * 2, int(budget * 0.8) // jobs))
+        misc.create_directory([shortcuts.validation_tmp_dir])
+        misc.log_to_file("INFO", f"Starting: Picard ValidateSamFile on {len(bam_files)} files, {jobs} at a time with -Xmx{heap}g ({budget} GB memory budget)")
+        cmd_validate = [f"java -Xmx{heap}g -jar $HOME/anaconda3/envs/sequencing/share/picard-2.25.2-0/picard.jar ValidateSamFile -I {bam} --MODE SUMMARY --IGNORE_WARNINGS true --MAX_OPEN_TEMP_FILES 1000 --MAX_RECORDS_IN_RAM {heap * 250000} --TMP_DIR {shortcuts.validation_tmp_dir}" for bam in bam_files]
+        # One process per file, run_command() exits on errors so the result is read from the .validated trackfiles
+        for batch in range(0, len(cmd_validate), jobs):
+            processes = [mp.Process(target=misc.run_command, args=("ValidateSamFile", None, None, None, cmd)) for cmd in cmd_validate[batch:batch + jobs]]
+            for process in processes: process.start()
+            for process in processes: process.join()
+        rmtree(shortcuts.validation_tmp_dir, ignore_errors=True)
+        sys.exit(0 if all(path.isfile(f"{bam[:-3]}validated") for bam in bam_files) else 1)
+
+    #---------------------------------------------------------------------------
+    def wait_deep_validation(self, misc):
+        '''Waits for the background Picard validation (if it was started) and returns False if it found errors'''
+
+        if not self.deep_validation:
+            return True
+        misc.log_to_file("INFO", "Waiting for Picard ValidateSamFile to finish")
+        self.deep_validation.join()
+        misc.reserved_memory = 0
+        if self.deep_validation.exitcode != 0:
+            misc.log_to_file("ERROR", "Picard ValidateSamFile found errors in the aligned bam files, see the log of validate_bam_deep")
+            return False
+        misc.log_to_file("INFO", "Picard ValidateSamFile succesfully completed - OK!")
+        return True
+
+    #---------------------------------------------------------------------------
+    def file_size(self, files):
+        '''Returns the total size in bytes of the files that exist, the input size runtimes are predicted from'''
+
+        return sum(path.getsize(file) for file in files if path.isfile(file)) or None
+
+    #---------------------------------------------------------------------------
+    def interval_length(self, bed_file):
+        '''Returns the number of bases in the intervals of a bed file'''
+
+        with open(bed_file, 'r') as bed:
+            return sum(int(line.split()[2]) - int(line.split()[1]) for line in bed if line.strip() and not line.startswith(('#', 'track', 'browser')))
+
     #---------------------------------------------------------------------------
     def alignment(self, options, misc, shortcuts):
-        '''This function align reads to reference genome using Burrows Wheeler aligner'''
+        '''This function align reads to reference genome using Burrows Wheeler aligner.
+           Every line in the library file (one flowcell lane if it was created with automatic discovery) is aligned as a separate
+           job and the jobs run in parallel. Read groups are taken from the manifest if the unit was found by automatic discovery.
+           With --shard_reads the FASTQ files are split into shards that are aligned in parallel and merged per library'''
+        misc.set_log_context(stage="alignment")
 
-        misc.log_to_file("INFO", f'Starting: Burrows Wheeler aligner Using {options.threads} out of {mp.cpu_count()} available threads')
         start = timeit.default_timer()
 
         try:
-            print(shortcuts.aligned_output_dir)
-            misc.create_directory([f"{shortcuts.aligned_output_dir}"])
+            misc.create_directory([f"{shortcuts.aligned_output_dir}", path.dirname(shortcuts.alignedFiles_list)])
+            read_groups = {}
+            if path.isfile(shortcuts.dna_reads_manifest):
+                with open(shortcuts.dna_reads_manifest, 'r') as manifest:
+                    read_groups = {unit["unit"]: unit["read_group"] for unit in json.load(manifest)["units"]}
 
             with open(f'{shortcuts.dna_seq_dir}{options.tumor_id}_library.txt', 'r') as fastq_list:
-                for line in fastq_list.readlines():
-                    clinical_id, library_id, read1, read2 = line.split()
-                    read_group_header = f'\'@RG\\tID:{library_id}\\tSM:{clinical_id}\\tLB:{library_id}\\tPL:ILLUMINA\\tPU:{library_id}\''
-                    
-                    if read2 == 'N/A': # single-end
-                        cmd_bwa = f"set -o pipefail && bwa-mem2 mem -R {read_group_header} {shortcuts.reference_genome_file} {shortcuts.dna_reads_dir}{read1} -t {options.threads} | samtools view -bS -o {shortcuts.aligned_output_dir}{library_id}.bam -" # samtools view converts SAM to BAM
-                    
-                    else: # paired-end
-                        cmd_bwa = f"set -o pipefail && bwa-mem2 mem -R {read_group_header} {shortcuts.reference_genome_file} {shortcuts.dna_reads_dir}/{read1} {shortcuts.dna_reads_dir}/{read2} -t {options.threads} | samtools view -bS -o {shortcuts.aligned_output_dir}{library_id}.bam -"
-                    
-                    misc.run_command("bwa-mem2", library_id, f"{shortcuts.aligned_output_dir}{library_id}.bam", None, cmd_bwa)       
-                elapsed = timeit.default_timer() - start
-                misc.log_to_file("INFO", f'Burrows Wheeler aligner succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-        
+                libraries = [line.split() for line in fastq_list.read().splitlines() if line.strip()]
+            aligned_files = [f"{library_id}.bam" for _, library_id, _, _ in libraries]
+
+            if options.shard_reads:
+                self.alignment_sharded(options, misc, shortcuts, libraries, read_groups)
+            else:
+                jobs_bwa = []
+                jobs = max(1, min(len(libraries), int(options.threads) // self.alignment_threads_per_job))
+                threads = max(1, int(options.threads) // jobs)
+                misc.log_to_file("INFO", f'Starting: Burrows Wheeler aligner, {len(libraries)} read groups in {jobs} parallel jobs using {threads} threads each ({options.threads} out of {mp.cpu_count()} available threads)')
+                for clinical_id, library_id, read1, read2 in libraries:
+                    read_group_header = read_groups.get(library_id, f"@RG\\tID:{library_id}\\tSM:{clinical_id}\\tLB:{library_id}\\tPL:ILLUMINA\\tPU:{library_id}")
+                    reads = f"{shortcuts.dna_reads_dir}{read1}" if read2 == 'N/A' else f"{shortcuts.dna_reads_dir}{read1} {shortcuts.dna_reads_dir}{read2}" # single-end or paired-end
+                    # samtools view converts SAM to BAM
+                    jobs_bwa.append(Job(f"bwa_{library_id}", f"bwa-mem2 mem -R '{read_group_header}' {shortcuts.reference_genome_file} {reads} -t {threads} | samtools view -bS -o {shortcuts.aligned_output_dir}{library_id}.bam -",
+                                        f"{shortcuts.aligned_output_dir}{library_id}.bam.complete", f"Alignment of {library_id}", threads, self.job_memory["bwa-mem2"], input_size=self.file_size(reads.split())))
+                if not create_executor(options, misc, shortcuts).run(jobs_bwa):
+                    sys.exit()
+
+            with open(shortcuts.alignedFiles_list, 'w') as list:
+                list.write("\n".join(aligned_files))
+            elapsed = timeit.default_timer() - start
+            misc.log_to_file("INFO", f'Burrows Wheeler aligner succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+
         except OSError as e:
             misc.log_exception("You have to create a library file first", e)
             sys.exit()
-        
+
         except Exception as e:
             misc.log_exception("alignment() in dna_seq_analysis.py:", e)
             sys.exit()
 
 
+    #---------------------------------------------------------------------------
+    def alignment_sharded(self, options, misc, shortcuts, libraries, read_groups):
+        '''This function splits the FASTQ files of every library into shards of --shard_reads reads (streamed, gzipped or not),
+           aligns and sorts all shards in parallel over the thread budget and merges the shard BAMs of each library into one BAM.
+           Shards are written to the temp folder (scratch tier if configured) and removed when the library is merged'''
+
+        try:
+            jobs = max(1, int(options.threads) // self.alignment_threads_per_job)
+            threads = max(1, int(options.threads) // jobs)
+            libraries = [library for library in libraries if not misc.step_allready_completed(f"{shortcuts.aligned_output_dir}{library[1]}.bam.complete", f"Alignment of {library[1]}")]
+
+            executor = create_executor(options, misc, shortcuts)
+            # Split read 1 and read 2 of a library at the same time, the shards of both files get the same numbers
+            jobs_split = []
+            for clinical_id, library_id, read1, read2 in libraries:
+                shard_dir = f"{shortcuts.alignment_shards_dir}{library_id}/"
+                misc.create_directory([shard_dir])
+                # Shards are gzipped on the way out (fast level) so they take about as much space as the input, bwa-mem2 reads them as is
+                split = f"split -l {4 * options.shard_reads} -d -a 5 --filter='gzip -1 > $FILE.gz'"
+                if read2 == 'N/A':
+                    cmd_split = f"zcat -f {shortcuts.dna_reads_dir}{read1} | {split} --additional-suffix=_R1.fastq - {shard_dir}shard_"
+                else:
+                    cmd_split = f"(zcat -f {shortcuts.dna_reads_dir}{read1} | {split} --additional-suffix=_R1.fastq - {shard_dir}shard_) & read1=$!; zcat -f {shortcuts.dna_reads_dir}{read2} | {split} --additional-suffix=_R2.fastq - {shard_dir}shard_ || exit 1; wait $read1"
+                jobs_split.append(Job(f"split_{library_id}", cmd_split, f"{shard_dir}split.complete", f"Splitting {library_id} into shards of {options.shard_reads} reads", 2, self.job_memory["split"],
+                                      input_size=self.file_size([f"{shortcuts.dna_reads_dir}{read}" for read in (read1, read2) if read != 'N/A'])))
+            if not executor.run(jobs_split):
+                sys.exit()
+
+            # Align the shards of all libraries as one pool of jobs, each shard is sorted on the way out
+            jobs_bwa = []
+            for clinical_id, library_id, read1, read2 in libraries:
+                shard_dir = f"{shortcuts.alignment_shards_dir}{library_id}/"
+                read_group_header = read_groups.get(library_id, f"@RG\\tID:{library_id}\\tSM:{clinical_id}\\tLB:{library_id}\\tPL:ILLUMINA\\tPU:{library_id}")
+                for shard in sorted(file[:-12] for file in listdir(shard_dir) if file.endswith("_R1.fastq.gz")):
+                    reads = f"{shard_dir}{shard}_R1.fastq.gz" if read2 == 'N/A' else f"{shard_dir}{shard}_R1.fastq.gz {shard_dir}{shard}_R2.fastq.gz"
+                    jobs_bwa.append(Job(f"bwa_{library_id}_{shard}", f"bwa-mem2 mem -R '{read_group_header}' {shortcuts.reference_genome_file} {reads} -t {threads} | samtools sort -@ 2 -m 1G -T {shard_dir}{shard}.bam.tmp -o {shard_dir}{shard}.bam -",
+                                        f"{shard_dir}{shard}.bam.complete", f"Alignment of {library_id} {shard}", threads, self.job_memory["bwa-mem2"], f"{shard_dir}{shard}.bam", input_size=self.file_size(reads.split())))
+            misc.log_to_file("INFO", f'Starting: Burrows Wheeler aligner, {len(jobs_bwa)} shards of {len(libraries)} read groups using {threads} threads per shard')
+            if not executor.run(jobs_bwa):
+                sys.exit()
+
+            # Gather: merge the sorted shard BAMs, -c and -p keep one @RG and @PG line per id
+            jobs_merge = []
+            for clinical_id, library_id, read1, read2 in libraries:
+                shard_dir = f"{shortcuts.alignment_shards_dir}{library_id}/"
+                with open(f"{shard_dir}shards.txt", 'w') as shards:
+                    shards.write("\n".join(sorted(f"{shard_dir}{file}" for file in listdir(shard_dir) if file.endswith(".bam"))))
+                jobs_merge.append(Job(f"merge_{library_id}", f"samtools merge -c -p -f -@ {threads} --write-index -o {shortcuts.aligned_output_dir}{library_id}.bam -b {shard_dir}shards.txt",
+                                      f"{shortcuts.aligned_output_dir}{library_id}.bam.complete", f"Merging shards of {library_id}", threads, self.job_memory["samtools merge"], stage="merge shards"))
+            if not executor.run(jobs_merge):
+                sys.exit()
+            for clinical_id, library_id, read1, read2 in libraries:
+                rmtree(f"{shortcuts.alignment_shards_dir}{library_id}/", ignore_errors=True)
+
+        except Exception as e:
+            misc.log_exception(".alignment_sharded() in dna_seq_analysis.py:", e)
+            sys.exit()
+
+
     #---------------------------------------------------------------------------
     def sort(self, options, misc, shortcuts):
         '''This function reads the completed_steps.txt to check if the previous step was completed without errors.
            The function returns a list of string containg the filenames of the sorted tumor samples and normal samples separated.
            The string is needed because you have several inputs in the next function and can therefore not run a for loop'''
+        misc.set_log_context(stage="sort")
 
         try:
             if not misc.step_allready_completed(shortcuts.sortedFiles_list, "Picard sortsam"):
@@ -138,195 +374,281 @@ class DnaSeqAnalysis():
                 start = timeit.default_timer()
                 misc.log_to_file("INFO", "Starting: sorting SAM/BAM files using Picard Sortsam")
                 # Empty strings to store the output
-                cmd_sort = []
+                jobs_sort = []
                 tumor_sort_str = ""
                 normal_sort_str = ""
                 write_to_file = ""
                 with open(shortcuts.alignedFiles_list, 'r') as list:
                     for sample in list.read().splitlines():
                         # --MAX_RECORDS_IN_RAM 21000000, -Xmx60g
-                        cmd_sort.append(f"java -Xmx20g -jar $HOME/anaconda3/envs/sequencing/share/picard-2.25.2-0/picard.jar SortSam -I {shortcuts.aligned_output_dir}{options.tumor_id}/{sample} -O {shortcuts.sorted_output_dir}{options.tumor_id}/{sample} --SORT_ORDER coordinate --TMP_DIR {shortcuts.sorted_output_dir}{options.tumor_id}/tmp")
+                        jobs_sort.append(Job(f"sort_{sample[:-4]}", f"java -Xmx20g -jar $HOME/anaconda3/envs/sequencing/share/picard-2.25.2-0/picard.jar SortSam -I {shortcuts.aligned_output_dir}{sample} -O {shortcuts.sorted_output_dir}{options.tumor_id}/{sample} --SORT_ORDER coordinate --TMP_DIR {shortcuts.tmp_dir}",
+                                             f"{shortcuts.sorted_output_dir}{options.tumor_id}/{sample}.complete", f"Sorting {sample}", 2, self.job_memory["SortSam"], input_size=self.file_size([f"{shortcuts.aligned_output_dir}{sample}"])))
                         if options.tumor_id in sample:
                             tumor_sort_str += f" -I {shortcuts.sorted_output_dir}{options.tumor_id}/{sample}".rstrip()
                         else:
                             normal_sort_str += f" -I {shortcuts.sorted_output_dir}{options.tumor_id}/{sample}".rstrip()
                     write_to_file = f"{tumor_sort_str.lstrip()}\n{normal_sort_str.lstrip()}"
 
-                    with mp.Pool(processes=1) as pool:
-                        pool.map(partial(self.multi_processing, None, None, options, misc, shortcuts),cmd_sort)
+                    if not create_executor(options, misc, shortcuts).run(jobs_sort):
+                        sys.exit()
                     misc.create_outputList_dna(shortcuts.sortedFiles_list, write_to_file)
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("INFO", f'Picard SortSam succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-                # misc.run_command(f"rm {shortcuts.aligned_output_dir}{options.tumor_id}/*.bam", 'Removing aligned BAM files to save space', None, None)
+                self.storage.stage_finished(options, misc, shortcuts, "sort")
         except Exception as e:
             misc.log_exception(".sort() in dna_seq_analysis.py:", e)
             sys.exit()
 
     #---------------------------------------------------------------------------
     def merge(self, options, misc, shortcuts):
-        '''This function merges all the input files in the sortedFiles_list to one output file'''
+        '''This function merges all the input files in the sortedFiles_list to one output file. With --markdup_backend samtools the
+        duplicates are marked in the same pass and the output is written directly to the removed duplicates folder'''
+        misc.set_log_context(stage="merge")
 
         try:
             if not misc.step_allready_completed(shortcuts.mergedFiles_list, "Picard MergeSamFiles"):
                 misc.create_directory([f"{shortcuts.merged_output_dir}{options.tumor_id}/"])
                 start = timeit.default_timer()
                 misc.log_to_file("INFO", "Starting: merging SAM/BAM files using Picard MergeSamFiles")
-                cmd_merge = []
+                jobs_merge = []
                 with open(shortcuts.sortedFiles_list, 'r') as list:
                     for sample in list.read().splitlines():
                         if f"{options.tumor_id}." in sample: tumor = sample
                         else: normal = sample
-                    cmd_merge.extend([f"picard MergeSamFiles {tumor} -O {shortcuts.merged_output_dir}{options.tumor_id}/{options.tumor_id}.bam",
-                                      f"picard MergeSamFiles {normal} -O {shortcuts.merged_output_dir}{options.tumor_id}/{options.normal_id}.bam"])
+                    for clinical_id, inputs in ((options.tumor_id, tumor), (options.normal_id, normal)):
+                        if options.markdup_backend == "samtools":
+                            misc.create_directory([f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/"])
+                            output = f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/{clinical_id}.bam"
+                            cmd_markdup, threads, side_paths = self.markdup_samtools_command(options, shortcuts, inputs.split()[1::2], output, f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/marked_dup_metrics_{clinical_id}.bam.samtools.txt")
+                            jobs_merge.append(Job(f"merge_{clinical_id}", cmd_markdup, f"{output}.complete", f"Merging and marking duplicates in {clinical_id}.bam", threads, threads + 2, output, stage="merge markdup", input_size=self.file_size(inputs.split()[1::2]), side_paths=side_paths))
+                            continue
+                        jobs_merge.append(Job(f"merge_{clinical_id}", f"picard MergeSamFiles {inputs} -O {shortcuts.merged_output_dir}{options.tumor_id}/{clinical_id}.bam",
+                                              f"{shortcuts.merged_output_dir}{options.tumor_id}/{clinical_id}.bam.complete", f"Merging {clinical_id}.bam", 1, self.job_memory["MergeSamFiles"], input_size=self.file_size(inputs.split()[1::2])))
+                    if not create_executor(options, misc, shortcuts).run(jobs_merge):
+                        sys.exit()
                     misc.create_outputList_dna(shortcuts.mergedFiles_list, f"{options.tumor_id}.bam")
                     misc.create_outputList_dna(shortcuts.mergedFiles_list, f"{options.normal_id}.bam")
-                    with mp.Pool(processes=2) as pool:
-                        pool.map(partial(self.multi_processing, [f"{options.normal_id}.bam", f"{options.tumor_id}.bam"], [f"{shortcuts.merged_output_dir}{options.tumor_id}/{options.normal_id}.bam", f"{shortcuts.merged_output_dir}{options.tumor_id}/{options.tumor_id}.bam"], options, misc, shortcuts),cmd_merge)
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("INFO", f'Picard MergeSamFiles succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-                misc.run_command(f"rm {shortcuts.sorted_output_dir}{options.tumor_id}/*.bam", 'Removing sorted BAM files to save space', None, None)
+                self.storage.stage_finished(options, misc, shortcuts, "merge")
         except Exception as e:
             misc.log_exception(".merge() in dna_seq_analysis.py:", e)
             sys.exit()
 
     #---------------------------------------------------------------------------
     def remove_duplicate(self, options, misc, shortcuts):
-        '''This function removes duplicates '''
+        '''This function marks duplicates with the backend of --markdup_backend: picard (MarkDuplicates), samtools (collate, fixmate,
+        sort and markdup streamed in one pass, usually already done in merge) or compare (both, picard output is used and a report with
+        the metric differences and runtimes is written)'''
+        misc.set_log_context(stage="remove_duplicate")
 
         try:
             if not misc.step_allready_completed(shortcuts.removeDuplicates_list, "Picard MarkDuplicates"):
-                misc.create_directory([f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/"])
+                output_dir = f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/"
+                misc.create_directory([output_dir])
                 start = timeit.default_timer()
-                misc.log_to_file("INFO", "Starting: removing duplicates in SAM/BAM files using Picard MarkDuplicates")
-                cmd_removedup = []
+                misc.log_to_file("INFO", f"Starting: marking duplicates in SAM/BAM files ({options.markdup_backend})")
+                jobs_picard = []
+                jobs_samtools = []
                 with open(shortcuts.mergedFiles_list, 'r') as list:
                     for sample in list.read().splitlines():
                         if f"{options.tumor_id}." in sample: tumor = sample
                         else: normal = sample
-                    cmd_removedup.extend([f"picard -Xmx70g MarkDuplicates -I {shortcuts.merged_output_dir}{options.tumor_id}/{tumor} -O {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/{tumor} -M {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/marked_dup_metrics_{tumor}.txt --TMP_DIR {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/tmp",
-                                          f"picard -Xmx70g MarkDuplicates -I {shortcuts.merged_output_dir}{options.tumor_id}/{normal} -O {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/{normal} -M {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/marked_dup_metrics_{normal}.txt --TMP_DIR {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/tmp"])
-                    # Runs multiprocessing
-                    with mp.Pool(processes=2) as pool:
-                        pool.map(partial(self.multi_processing, [f"{options.normal_id}.bam", f"{options.tumor_id}.bam"], [f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/{options.normal_id}.bam", f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/{options.tumor_id}.bam"], options, misc, shortcuts),cmd_removedup)
+                samtools_dir = f"{output_dir}samtools/" if options.markdup_backend == "compare" else output_dir
+                for sample in (tumor, normal):
+                    merged = f"{shortcuts.merged_output_dir}{options.tumor_id}/{sample}"
+                    jobs_picard.append(Job(f"markdup_{sample[:-4]}", f"picard -Xmx70g MarkDuplicates -I {merged} -O {output_dir}{sample} -M {output_dir}marked_dup_metrics_{sample}.txt --TMP_DIR {shortcuts.tmp_dir}",
+                                           f"{output_dir}{sample}.complete", f"Removing duplicates in {sample}", 2, self.job_memory["MarkDuplicates"], input_size=self.file_size([merged])))
+                    cmd_markdup, threads, side_paths = self.markdup_samtools_command(options, shortcuts, [merged], f"{samtools_dir}{sample}", f"{output_dir}marked_dup_metrics_{sample}.samtools.txt")
+                    jobs_samtools.append(Job(f"markdup_{sample[:-4]}", cmd_markdup, f"{samtools_dir}{sample}.complete", f"Marking duplicates in {sample} with samtools", threads, threads + 2,
+                                             f"{samtools_dir}{sample}", stage="samtools markdup", input_size=self.file_size([merged]), side_paths=side_paths))
+
+                executor = create_executor(options, misc, shortcuts)
+                runtimes = {}
+                for backend, jobs in (("picard", jobs_picard), ("samtools", jobs_samtools)):
+                    if options.markdup_backend in (backend, "compare"):
+                        misc.create_directory([samtools_dir])
+                        backend_start = timeit.default_timer()
+                        if not executor.run(jobs):
+                            sys.exit()
+                        runtimes[backend] = timeit.default_timer() - backend_start
+                if options.markdup_backend == "compare":
+                    self.compare_markdup(misc, output_dir, (tumor, normal), runtimes)
+                    rmtree(samtools_dir, ignore_errors=True)
+                # The duplicate metrics and the comparison report are QC outputs, they are kept next to the realigned bam files
+                for prefix in ("marked_dup_metrics_", "markdup_comparison"):
+                    self.storage.promote_outputs(misc, output_dir, f"{shortcuts.realigned_output_dir}{options.tumor_id}/", prefix)
                 copy(shortcuts.mergedFiles_list, shortcuts.removeDuplicates_list) # just copying because the content will be the same
                 elapsed = timeit.default_timer() - start
-                misc.log_to_file("INFO", f'Picard MarkDuplicates succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-                misc.run_command(f"rm {shortcuts.merged_output_dir}{options.tumor_id}/*.bam", 'Removing merged BAM files to save space', None, None)
+                misc.log_to_file("INFO", f'Marking duplicates succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+                self.storage.stage_finished(options, misc, shortcuts, "remove_duplicate")
         except Exception as e:
             misc.log_exception(".remove_duplicate() in dna_seq_analysis.py:", e)
             sys.exit()
 
+    #---------------------------------------------------------------------------
+    def markdup_samtools_command(self, options, shortcuts, inputs, output, metrics):
+        '''This function returns the samtools command that merges coordinate sorted bam files and marks duplicates in one stream
+        (merge, collate, fixmate -m, sort, markdup), the threads it uses and its side paths (metrics file and temp prefix).
+        Sorting spills to disk, so memory is about 1 GB per thread'''
+
+        threads = max(2, int(options.threads) // 2)
+        tmp = f"{shortcuts.tmp_dir}{path.basename(output)[:-4]}_markdup"
+        cmd_markdup = (f"samtools merge -u -o - {' '.join(inputs)} | samtools collate -O -u - {tmp}_collate | samtools fixmate -m -u - - | "
+                       f"samtools sort -u -@ {threads} -m 1G -T {tmp}_sort - | samtools markdup -@ {threads} -d 100 -f {metrics} -T {tmp}_markdup - {output}")
+        return cmd_markdup, threads, [metrics, tmp]
+
+    #---------------------------------------------------------------------------
+    def markdup_metrics(self, metrics_file):
+        '''This function returns examined reads, duplicate reads, optical duplicate reads and estimated library size from a Picard
+        MarkDuplicates metrics file or a samtools markdup stats file (.samtools.txt)'''
+
+        if metrics_file.endswith(".samtools.txt"):
+            with open(metrics_file, 'r') as f:
+                stats = dict(line.rsplit(':', 1) for line in f if ':' in line and not line.startswith("COMMAND"))
+            stats = {key.strip(): int(value) for key, value in stats.items()}
+            return {"examined": stats["EXAMINED"], "duplicates": stats["DUPLICATE PRIMARY TOTAL"],
+                    "optical": stats["DUPLICATE PAIR OPTICAL"] + stats["DUPLICATE SINGLE OPTICAL"], "library_size": stats["ESTIMATED_LIBRARY_SIZE"]}
+
+        with open(metrics_file, 'r') as f:
+            lines = f.read().split("## METRICS CLASS")[1].split("\n\n")[0].strip().splitlines()[1:]
+        header = lines[0].split('\t')
+        libraries = [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+        total = lambda column: sum(int(library[column] or 0) for library in libraries)
+        return {"examined": total("UNPAIRED_READS_EXAMINED") + 2 * total("READ_PAIRS_EXAMINED"),
+                "duplicates": total("UNPAIRED_READ_DUPLICATES") + 2 * total("READ_PAIR_DUPLICATES"),
+                "optical": 2 * total("READ_PAIR_OPTICAL_DUPLICATES"), "library_size": total("ESTIMATED_LIBRARY_SIZE")}
+
+    #---------------------------------------------------------------------------
+    def compare_markdup(self, misc, output_dir, samples, runtimes):
+        '''This function writes markdup_comparison.tsv with the duplicate metrics of both backends, their difference and the runtimes'''
+
+        with open(f"{output_dir}markdup_comparison.tsv", 'w') as report:
+            report.write("sample\tmetric\tpicard\tsamtools\tdifference\n")
+            for sample in samples:
+                picard = self.markdup_metrics(f"{output_dir}marked_dup_metrics_{sample}.txt")
+                samtools = self.markdup_metrics(f"{output_dir}marked_dup_metrics_{sample}.samtools.txt")
+                picard["percent_duplication"] = round(100 * picard["duplicates"] / max(1, picard["examined"]), 3)
+                samtools["percent_duplication"] = round(100 * samtools["duplicates"] / max(1, samtools["examined"]), 3)
+                for metric in ("examined", "duplicates", "optical", "percent_duplication", "library_size"):
+                    report.write(f"{sample}\t{metric}\t{picard[metric]}\t{samtools[metric]}\t{round(samtools[metric] - picard[metric], 3)}\n")
+                misc.log_to_file("INFO", f"{sample}: {picard['percent_duplication']} % duplicates with picard, {samtools['percent_duplication']} % with samtools")
+            report.write(f"all\truntime_seconds\t{runtimes['picard']:.0f}\t{runtimes['samtools']:.0f}\t{runtimes['samtools'] - runtimes['picard']:.0f}\n")
+        misc.log_to_file("INFO", f"Runtime picard {misc.elapsed_time(runtimes['picard'])}, samtools {misc.elapsed_time(runtimes['samtools'])}. Report: {output_dir}markdup_comparison.tsv")
+
     #---------------------------------------------------------------------------
     def realign(self, options, misc, shortcuts):
-        '''This function realigns the bam files'''
+        '''This function realigns the bam files. Every bam file is scattered over the reference chunks (reads are assigned to the chunk
+        where they start) and one shard of unplaced reads, the shards are realigned concurrently and gathered in chunk order with
+        samtools cat, so the gathered file is coordinate sorted without sorting again. The realigned bam files are written to the
+        scratch tier and promoted to the persistent tree when both are completed'''
+        misc.set_log_context(stage="realign")
 
         try:
             if not misc.step_allready_completed(shortcuts.realignedFiles_list, "GATK LeftAlignIndels"):
-                misc.create_directory([f"{shortcuts.realigned_output_dir}"])
+                misc.create_directory([shortcuts.realigned_scratch_dir, f"{shortcuts.realigned_output_dir}{options.tumor_id}/"])
                 start = timeit.default_timer()
-                misc.log_to_file("INFO", "Starting: realigning SAM/BAM files using GATK LeftAlignIndels")
-                cmd_index = []
-                cmd_leftAlignIndels = []
-
-                target_dir = shortcuts.removed_duplicates_output_dir
+                chunks = self.realign_chunks(shortcuts)
+                misc.log_to_file("INFO", f"Starting: realigning SAM/BAM files using GATK LeftAlignIndels ({len(chunks) + 1} shards per file)")
+                jobs_index = []
+                jobs_leftAlignIndels = []
+                jobs_gather = []
+                samples = []
+
+                target_dir = f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/"
                 for sample in listdir(target_dir):
                     path_to_sample = path.join(target_dir, sample)
                     if path.isfile(path_to_sample) and sample.endswith('.bam'):
-                        cmd_index.append(f"samtools index {path_to_sample}")
-                        cmd_leftAlignIndels.append(f"gatk LeftAlignIndels -R {shortcuts.reference_genome_file} -I {path_to_sample} -O {shortcuts.realigned_output_dir}{sample}")
-                print(cmd_index)
-                print(cmd_leftAlignIndels)
-
-             
-                    
-                with mp.Pool(processes=2) as pool:
-                    pool.map(partial(misc.run_command, "realing index", None, None, None), cmd_index)
-                    
-                with mp.Pool(processes=2) as pool:
-                    pool.map(partial(misc.run_command, "realign LeftAlignIndels", None, None, None), cmd_leftAlignIndels)
-                    
+                        jobs_index.append(Job(f"index_{sample[:-4]}", f"samtools index {path_to_sample}", f"{path_to_sample}.bai.complete", f"Indexing {sample}", 1, self.job_memory["samtools index"], input_size=self.file_size([path_to_sample])))
+                        shard_dir = f"{shortcuts.realigned_shards_dir}{sample[:-4]}/"
+                        misc.create_directory([shard_dir])
+                        shards = []
+                        for chunk, regions, expression in chunks + [("unplaced", "'*'", None)]:
+                            shard = f"{shard_dir}{chunk}"
+                            select = f"-M -e '{expression}'" if expression else ""
+                            cmd_realign = (f"samtools view -b {select} -o {shard}_input.bam {path_to_sample} {regions} && "
+                                           f"gatk --java-options -Xmx3g LeftAlignIndels -R {shortcuts.reference_genome_file} -I {shard}_input.bam -O {shard}.bam && rm {shard}_input.bam")
+                            jobs_leftAlignIndels.append(Job(f"realign_{sample[:-4]}_{chunk}", cmd_realign, f"{shard}.bam.complete", f"Realigning {sample} {chunk}", 1, self.job_memory["LeftAlignIndels"],
+                                                            f"{shard}.bam", input_size=self.file_size([path_to_sample]) // (len(chunks) + 1), side_paths=[f"{shard}_input.bam"]))
+                            shards.append(f"{shard}.bam")
+                        jobs_gather.append(Job(f"gather_{sample[:-4]}", f"samtools cat -o {shortcuts.realigned_scratch_dir}{sample} {' '.join(shards)} && samtools index {shortcuts.realigned_scratch_dir}{sample}",
+                                               f"{shortcuts.realigned_scratch_dir}{sample}.complete", f"Gathering realigned shards of {sample}", 1, self.job_memory["samtools cat"],
+                                               f"{shortcuts.realigned_scratch_dir}{sample}", input_size=self.file_size([path_to_sample])))
+                        samples.append(sample)
+
+                executor = create_executor(options, misc, shortcuts)
+                if not executor.run(jobs_index) or not executor.run(jobs_leftAlignIndels) or not executor.run(jobs_gather):
+                    sys.exit()
+                rmtree(shortcuts.realigned_shards_dir, ignore_errors=True)
+
+                # Promote the realigned bam files (final output), tumor first as expected by the calling steps
+                for sample in sorted(samples, key=lambda sample: not sample.startswith(f"{options.tumor_id}.")):
+                    self.storage.promote_outputs(misc, shortcuts.realigned_scratch_dir, f"{shortcuts.realigned_output_dir}{options.tumor_id}/", f"{sample[:-4]}.")
+                    misc.create_outputList_dna(shortcuts.realignedFiles_list, sample)
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("INFO", f'gatk LeftAlignIndels succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-                # misc.run_command(f"rm {shortcuts.removed_duplicates_output_dir}{options.tumor_id}/*.bam", 'Removing remove_duplicate BAM files to save space', None, None)
+                self.storage.stage_finished(options, misc, shortcuts, "realign")
         except Exception as e:
             misc.log_exception(".realign() in dna_seq_analysis.py:", e)
             sys.exit()
 
     #---------------------------------------------------------------------------
-    # def multi_processing(self, text, file, options, misc, shortcuts, input):
-    #     '''This function runs pipeline steps in parallell'''
-
-    #     try:
-    #         
-
-    #         elif "SortSam" in input:
-    #             # multi_processing() uses SortSam options
-    #             misc.log_to_file("DEBUG", "# multi_processing() uses SortSam options")
-    #             text = input.split()[8].split('/')[7]
-    #             file = input.split()[8]
-    #             misc.run_command(input, text, file, None)
-
-    #         elif "MergeSamFiles" in input or "MarkDuplicates" in input:
-    #             # multi_processing() uses MergeSamFiles or MarkDuplicates options
-    #             misc.log_to_file("DEBUG", "# multi_processing() uses MergeSamFiles or MarkDuplicates options")
-    #             text = text[0] if f"{options.normal_id}.bam" in input else text[1]
-    #             file = file[0] if f"{options.normal_id}.bam" in input else file[1]
-    #             misc.run_command(input, text, file, None)
-
-    #         elif "HaplotypeCaller" in input:
-    #             # multi_processing() uses HaplotypeCaller options
-    #             misc.log_to_file("DEBUG", "# multi_processing() uses HaplotypeCaller options")
-    #             text = input.split()[9].split('/')[8]
-    #             print("text:", text)
-    #             file = input.split()[9]
-    #             print("file:", file)
-    #             misc.run_command(input, text, file, None)
-
-
-    #         else:
-    #             # multi_processing() uses else options
-    #             misc.log_to_file("DEBUG", "# multi_processing() uses else options")
-    #             text = f"{options.tumor_id}.bam" if f"{options.tumor_id}.bam" in input else f"{options.normal_id}.bam"
-    #             misc.run_command(input, text, file, None)
-    #     except KeyboardInterrupt:
-    #         print("Bye")
-    #         sys.exit()
-    #     except Exception as e:
-    #         misc.log_exception(".multi_processing() in dna_seq_analysis.py:", e)
-    #         sys.exit()
+    def realign_chunks(self, shortcuts):
+        '''This function returns (chunk name, samtools regions, samtools filter expression) for every reference chunk in genome order.
+        The expression keeps the reads that start in the chunk, so a read overlapping two chunks is realigned only once'''
+
+        chunks = []
+        for chunk in sorted(listdir(shortcuts.reference_genome_chunks_dir)):
+            with open(f"{shortcuts.reference_genome_chunks_dir}{chunk}", 'r') as bed:
+                windows = [line.split()[:3] for line in bed if line.strip()]
+            regions = ' '.join(f"{contig}:{int(start) + 1}-{end}" for contig, start, end in windows)
+            expression = ' || '.join(f'(rname == "{contig}" && pos > {start} && pos <= {end})' for contig, start, end in windows)
+            chunks.append((chunk[:-4], regions, expression))
+        return chunks
 
     #---------------------------------------------------------------------------
     def gatk_haplotype(self, options, misc, shortcuts):
+        misc.set_log_context(stage="gatk_haplotype")
 
         try:
             start = timeit.default_timer()
             if not misc.step_allready_completed(shortcuts.haplotypecaller_complete, "GATK haplotypeCaller"):
-                misc.create_directory([f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/chunks/"])
-                cmd_haplotypecaller = []
-                misc.log_to_file("INFO", "Starting: looking for SNV's using GATK HaplotypeCaller (multiprocessing)")
+                misc.create_directory([shortcuts.haplotypecaller_chunks_dir, f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/"])
+                jobs_haplotypecaller = []
+                misc.log_to_file("INFO", "Starting: looking for SNV's using GATK HaplotypeCaller (one job per chunk)")
                 with open(shortcuts.realignedFiles_list, 'r') as list:
                     sample_1, sample_2 = list.read().splitlines()
-                    for chunk in listdir(shortcuts.reference_genome_chunks_dir):
-                        cmd_haplotypecaller.append(f"gatk HaplotypeCaller -R {shortcuts.reference_genome_file} -I {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1} -I {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2} -O {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/chunks/{options.tumor_id}_{chunk}.vcf -L {shortcuts.reference_genome_chunks_dir}{chunk}")
-                        misc.create_outputList_dna(shortcuts.gatk_chunks_list, f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/chunks/{options.tumor_id}_{chunk}.vcf")
-                with mp.Pool(processes=20) as pool:
-                    pool.map(partial(self.multi_processing, "gatk", options, misc, shortcuts),cmd_haplotypecaller)
+                # One completion record per chunk: a rerun only calls the chunks that are missing, failed or changed
+                chunk_vcfs = []
+                for chunk in sorted(listdir(shortcuts.reference_genome_chunks_dir)):
+                    chunk_vcf = f"{shortcuts.haplotypecaller_chunks_dir}{options.tumor_id}_{chunk}.vcf"
+                    jobs_haplotypecaller.append(Job(f"haplotypecaller_{chunk}", f"gatk --java-options -Xmx4g HaplotypeCaller -R {shortcuts.reference_genome_file} -I {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1} -I {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2} -O {chunk_vcf} -L {shortcuts.reference_genome_chunks_dir}{chunk}",
+                                                    f"{chunk_vcf}.complete", f"HaplotypeCaller {chunk}", 2, self.job_memory["HaplotypeCaller"], chunk_vcf, self.haplotypecaller_retries,
+                                                    input_size=self.interval_length(f"{shortcuts.reference_genome_chunks_dir}{chunk}")))
+                    chunk_vcfs.append(chunk_vcf)
+                if not create_executor(options, misc, shortcuts).run(jobs_haplotypecaller):
+                    misc.log_to_file("ERROR", "GATK HaplotypeCaller failed for some chunks, rerun to call only the chunks that are not completed")
+                    sys.exit()
+                # Rewritten (not appended to) so reruns do not add the chunks again
+                with open(f"{shortcuts.gatk_chunks_list}.partial", 'w') as list:
+                    list.write("\n".join(chunk_vcfs) + "\n")
+                rename(f"{shortcuts.gatk_chunks_list}.partial", shortcuts.gatk_chunks_list)
                 elapsed = timeit.default_timer() - start
-                misc.log_to_file("INFO", f'gatk haplotypecaller step 1 (multiprocessing) succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+                misc.log_to_file("INFO", f'gatk haplotypecaller step 1 succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 1 (snv calling) in dna_seq_analysis.py:", e)
 
         try:
             # Merge all vcf files
             cmd_merge = f"picard MergeVcfs -I {shortcuts.gatk_chunks_list} -O {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}.vcf"
-            misc.run_command(cmd_merge, None, f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}.vcf", None)
+            misc.run_command("picard MergeVcfs", "GATK haplotypeCaller step 2 (merge vcf)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}.vcf", None, cmd_merge)
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 2 (merge vcf) in dna_seq_analysis.py:", e)
 
         try:
             # Remove all reads with read depth less than 10, selects only snps, exludes normal samples
             cmd_filter_read_depth = f"bcftools view -i 'MIN(FMT/DP)>10' -m2 -M2 -v snps -s ^{options.normal_id} {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}.vcf > {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor.vcf"
-            misc.run_command(cmd_filter_read_depth, "GATK haplotypeCaller step 3 (remove read depth < 10, selects only snps, exludes normal samples)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor.vcf", None)
+            misc.run_command("bcftools view", "GATK haplotypeCaller step 3 (remove read depth < 10, selects only snps, exludes normal samples)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor.vcf", None, cmd_filter_read_depth)
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 3 in dna_seq_analysis.py:", e)
 
@@ -334,18 +656,15 @@ class DnaSeqAnalysis():
         try:
             # select heterozygous genotype, excludes GT=1/2
             cmd_filter_het = f"bcftools view -g het -e 'GT=\"1/2\"' {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor.vcf > {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het.vcf"
-            misc.run_command(cmd_filter_het, "GATK haplotypeCaller step 4 (select heterozygous genotype, excludes GT=1/2)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het.vcf", None)
+            misc.run_command("bcftools view", "GATK haplotypeCaller step 4 (select heterozygous genotype, excludes GT=1/2)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het.vcf", None, cmd_filter_het)
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 4 (select heterozygous genotype, excludes GT=1/2) in dna_seq_analysis.py:", e)
 
 
         try:
-            # Annotate vcf file
-            cmd_annotate = f'''java -Xmx4g -jar $HOME/anaconda3/envs/sequencing/share/snpeff-5.0-1/snpEff.jar \\
-            -v GRCh38.99 -canon -noInteraction -noNextProt -noMotif -strict \\
-            -onlyProtein {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het.vcf \\
-            > {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf'''
-            misc.run_command(cmd_annotate, "GATK haplotypeCaller step 5 (annotate vcf file)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf", None)
+            # Annotate vcf file, variants annotated for earlier samples are taken from the annotation cache
+            self.annotate(misc, shortcuts, f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het.vcf",
+                          f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf")
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 5 (annotate vcf file) in dna_seq_analysis.py:", e)
 
@@ -353,40 +672,102 @@ class DnaSeqAnalysis():
         try:
             # Index feature file
             cmd_indexFeatureFile = f"gatk IndexFeatureFile -I {shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf"
-            if misc.run_command(cmd_indexFeatureFile, "GATK haplotypeCaller step 6 (index fearure file)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf.idx", shortcuts.haplotypecaller_complete):
+            if misc.run_command("gatk IndexFeatureFile", "GATK haplotypeCaller step 6 (index fearure file)", f"{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf.idx", shortcuts.haplotypecaller_complete, cmd_indexFeatureFile):
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("INFO", f'All steps in GATK HaplotypeCaller succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+                self.storage.stage_finished(options, misc, shortcuts, "gatk_haplotype")
         except Exception as e:
             misc.log_exception(".gatk_haplotype step 6 (IndexFeatureFile) in dna_seq_analysis.py:", e)
 
 
+    #---------------------------------------------------------------------------
+    def annotate(self, misc, shortcuts, input_vcf, output_vcf):
+        '''This function annotates a vcf file with snpEff. Variants that are in the annotation cache get the cached annotation, only the
+        novel variants are annotated by snpEff and added to the cache. The records are written in the order of the input vcf'''
+
+        if misc.step_allready_completed(output_vcf, "GATK haplotypeCaller step 5 (annotate vcf file)"):
+            return
+        cache = AnnotationCache(shortcuts.snpeff_cache_db, f"{self.snpeff_database} {self.snpeff_parameters}")
+        with open(input_vcf, 'r') as vcf:
+            lines = vcf.read().splitlines()
+        header = [line for line in lines if line.startswith('#')]
+        records = [line.split('\t') for line in lines if line and not line.startswith('#')]
+        keys = [(record[0], int(record[1]), record[3], record[4]) for record in records]
+        annotations = cache.lookup(keys)
+        novel = [record for record, key in zip(records, keys) if key not in annotations]
+        misc.log_to_file("INFO", f"snpEff annotation cache: {len(records) - len(novel)} of {len(records)} variants found, annotating {len(novel)} with snpEff")
+
+        header_lines = cache.header_lines()
+        if novel or header_lines is None:
+            novel_vcf = f"{output_vcf[:-4]}_novel.vcf"
+            with open(novel_vcf, 'w') as vcf:
+                vcf.write("\n".join(header + ['\t'.join(record) for record in novel]) + "\n")
+            cmd_annotate = f"java -Xmx4g -jar $HOME/anaconda3/envs/sequencing/share/snpeff-5.0-1/snpEff.jar -v {self.snpeff_database} {self.snpeff_parameters} {novel_vcf} > {novel_vcf[:-4]}_annotated.vcf"
+            misc.run_command("snpEff", f"snpEff annotation of {len(novel)} novel variants", None, None, cmd_annotate)
+            with open(f"{novel_vcf[:-4]}_annotated.vcf", 'r') as vcf:
+                annotated = vcf.read().splitlines()
+            header_lines = [line for line in annotated if line.startswith('##') and line not in header]
+            # The INFO fields snpEff added to a record are the ones that were not in the input record
+            annotated_records = {}
+            for record, line in zip(novel, [line for line in annotated if line and not line.startswith('#')]):
+                fields = line.split('\t')
+                annotated_records[(fields[0], int(fields[1]), fields[3], fields[4])] = ';'.join(field for field in fields[7].split(';') if field not in record[7].split(';'))
+            cache.store(annotated_records, header_lines)
+            annotations.update(annotated_records)
+            remove(novel_vcf)
+            remove(f"{novel_vcf[:-4]}_annotated.vcf")
+
+        with open(f"{output_vcf}.partial", 'w') as vcf:
+            vcf.write("\n".join(header[:-1] + [line for line in header_lines if line not in header] + header[-1:]) + "\n")
+            for record, key in zip(records, keys):
+                info = annotations.get(key, "")
+                if info:
+                    record[7] = info if record[7] == '.' else f"{record[7]};{info}"
+                vcf.write('\t'.join(record) + "\n")
+        rename(f"{output_vcf}.partial", output_vcf)
+        misc.log_to_file("INFO", "GATK haplotypeCaller step 5 (annotate vcf file) succesfully completed")
+
     #---------------------------------------------------------------------------
     def delly(self, options, misc, shortcuts):
-        '''This function creates an output directory and runs delly to call for somatic SNV's'''
+        '''This function creates an output directory and runs delly to call for somatic SNV's. delly call runs once per SV type, all types
+        at the same time, and the calls are concatenated and sorted into delly.bcf before the somatic filter'''
+        misc.set_log_context(stage="delly")
 
         try:
             if not misc.step_allready_completed(shortcuts.delly_complete, "Delly SNV calling"):
-                misc.create_directory([f"{shortcuts.delly_output_dir}{options.tumor_id}/"])
+                delly_dir = f"{shortcuts.delly_output_dir}{options.tumor_id}/"
+                misc.create_directory([delly_dir])
                 start = timeit.default_timer()
-                misc.log_to_file("INFO", "Starting: looking for somatic SNV's using delly")
+                misc.log_to_file("INFO", f"Starting: looking for somatic SNV's using delly ({', '.join(self.delly_sv_types)} called in parallel)")
                 with open(shortcuts.realignedFiles_list, 'r') as list:
                     sample_1, sample_2 = list.read().splitlines()
-                    cmd_delly_call = f"delly call -x {shortcuts.reference_genome_exclude_template_file} -g {shortcuts.reference_genome_file} -o {shortcuts.delly_output_dir}{options.tumor_id}/delly.bcf {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1} {shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2}"
-                    misc.run_command(cmd_delly_call, "Delly calling (step 1)", f"{shortcuts.delly_output_dir}{options.tumor_id}/delly.bcf", None)
-                with open(f'{shortcuts.delly_output_dir}{options.tumor_id}/sample.tsv', 'w', newline='') as tsv:
+                bams = [f"{shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1}", f"{shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2}"]
+                jobs_delly = []
+                for sv_type in self.delly_sv_types:
+                    # delly uses one thread per bam file
+                    cmd_delly_call = f"OMP_NUM_THREADS=2 delly call -t {sv_type} -x {shortcuts.reference_genome_exclude_template_file} -g {shortcuts.reference_genome_file} -o {delly_dir}delly_{sv_type}.bcf {' '.join(bams)}"
+                    jobs_delly.append(Job(f"delly_{sv_type}", cmd_delly_call, f"{delly_dir}delly_{sv_type}.bcf.complete", f"Delly calling {sv_type} (step 1)", 2, self.job_memory["delly"],
+                                          f"{delly_dir}delly_{sv_type}.bcf", input_size=self.file_size(bams)))
+                if not create_executor(options, misc, shortcuts).run(jobs_delly):
+                    sys.exit()
+
+                # Concatenate the SV types, sort and index (delly filter needs an indexed bcf)
+                cmd_concat = f"bcftools concat -a -O u {' '.join(f'{delly_dir}delly_{sv_type}.bcf' for sv_type in self.delly_sv_types)} | bcftools sort -T {delly_dir}sort_tmp -O b -o {delly_dir}delly.bcf && bcftools index -f {delly_dir}delly.bcf"
+                misc.run_command("bcftools concat", "Delly concatenate SV types (step 2)", f"{delly_dir}delly.bcf.complete", f"{delly_dir}delly.bcf.complete", f"set -o pipefail; {cmd_concat}")
+                with open(f'{delly_dir}sample.tsv', 'w', newline='') as tsv:
                     tsv_output = csv.writer(tsv, delimiter='\t')
                     tsv_output.writerow([f"{options.tumor_id}", 'tumor'])
                     tsv_output.writerow([f"{options.normal_id}", 'control'])
-                cmd_dos2unix = f"dos2unix {shortcuts.delly_output_dir}{options.tumor_id}/sample.tsv"
-                misc.run_command(cmd_dos2unix, None, None, None)
+                cmd_dos2unix = f"dos2unix {delly_dir}sample.tsv"
+                misc.run_command("dos2unix", None, None, None, cmd_dos2unix)
 
                 # Filter bcf file to only show somatic mutations
-                cmd_filter = f"delly filter -f somatic -o {shortcuts.delly_output_dir}{options.tumor_id}/delly_filter.bcf -s {shortcuts.delly_output_dir}{options.tumor_id}/sample.tsv {shortcuts.delly_output_dir}{options.tumor_id}/delly.bcf"
-                misc.run_command(cmd_filter, "Delly filter (step 2)", f"{shortcuts.delly_output_dir}{options.tumor_id}/delly_filter.bcf", None)
+                cmd_filter = f"delly filter -f somatic -o {delly_dir}delly_filter.bcf -s {delly_dir}sample.tsv {delly_dir}delly.bcf"
+                misc.run_command("delly filter", "Delly filter (step 3)", f"{delly_dir}delly_filter.bcf", None, cmd_filter)
 
                 # Convert bcf file to human readable vcf file
-                cmd_convert = f"bcftools view {shortcuts.delly_output_dir}{options.tumor_id}/delly_filter.bcf > {shortcuts.delly_output_dir}{options.tumor_id}/delly_filter.vcf"
-                misc.run_command(cmd_convert, "Delly convert bcf > vcf (step 3)", f"{shortcuts.delly_output_dir}{options.tumor_id}/delly_filter.vcf", shortcuts.delly_complete)
+                cmd_convert = f"bcftools view {delly_dir}delly_filter.bcf > {delly_dir}delly_filter.vcf"
+                misc.run_command("bcftools view", "Delly convert bcf > vcf (step 4)", f"{delly_dir}delly_filter.vcf", shortcuts.delly_complete, cmd_convert)
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("INFO", f'Delly SNV calling succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
         except Exception as e:
@@ -394,23 +775,52 @@ class DnaSeqAnalysis():
             sys.exit()
 
         #---------------------------------------------------------------------------
+    def manta_call_regions(self, misc, shortcuts):
+        '''This function writes the call regions of Manta: every contig of the reference minus the regions in the exclude template, as a
+        bgzipped and tabix indexed BED file. The exclude template contig names are changed to the naming of the reference (with or without chr).
+        The file is named after a checksum of the reference .fai and the exclude template, so another reference gets its own call regions.
+        Returns the path of the file'''
+
+        try:
+            key = hashlib.sha256(f"{misc.checksum_file(f'{shortcuts.reference_genome_file}.fai')} {misc.checksum_file(shortcuts.reference_genome_exclude_template_file)}".encode()).hexdigest()[:12]
+            call_regions_file = f"{shortcuts.manta_call_regions_prefix}_{key}.bed.gz"
+            if not misc.step_allready_completed(f"{call_regions_file}.complete", "Creating Manta call regions"):
+                with open(f"{shortcuts.reference_genome_file}.fai", 'r') as fai:
+                    chr_naming = int(fai.readline().startswith('chr'))
+                genome_bed = f"{shortcuts.reference_genome_dir}manta_genome.bed"
+                exclude_bed = f"{shortcuts.reference_genome_dir}manta_exclude.bed"
+                cmd_call_regions = f'''set -eo pipefail
+                awk -v OFS='\\t' '{{print $1, 0, $2}}' {shortcuts.reference_genome_file}.fai | sort -k1,1 -k2,2n > {genome_bed}
+                awk -v OFS='\\t' -v chr={chr_naming} '!/^#/ {{name = $1; sub(/^chr/, "", name); if (chr) name = "chr" name; print name, $2, $3}}' {shortcuts.reference_genome_exclude_template_file} | sort -k1,1 -k2,2n > {exclude_bed}
+                bedtools subtract -a {genome_bed} -b {exclude_bed} | bgzip -c > {call_regions_file}
+                tabix -f -p bed {call_regions_file}
+                rm {genome_bed} {exclude_bed}'''
+                misc.run_command("bedtools subtract", "Creating Manta call regions", None, f"{call_regions_file}.complete", cmd_call_regions)
+            return call_regions_file
+        except Exception as e:
+            misc.log_exception(".manta_call_regions() in dna_seq_analysis.py:", e)
+            sys.exit()
+
+    #---------------------------------------------------------------------------
     def manta(self, options, misc, shortcuts):
-        '''This function creates an output directory and runs manta to call for somatic SNV's'''
+        '''This function creates an output directory and runs manta to call for somatic SNV's in the call regions, with the threads and
+        memory of the pipeline. PASS records are filtered directly from the compressed output'''
+        misc.set_log_context(stage="manta")
 
         try:
             if not misc.step_allready_completed(shortcuts.manta_complete, "Manta SNV calling"):
                 start = timeit.default_timer()
-                misc.log_to_file("INFO", "Starting: looking for somatic SNV's using manta")
+                threads, memory = int(options.threads), misc.memory_budget(options)
+                misc.log_to_file("INFO", f"Starting: looking for somatic SNV's using manta ({threads} threads, {memory} GB memory)")
+                call_regions_file = self.manta_call_regions(misc, shortcuts)
                 with open(shortcuts.realignedFiles_list, 'r') as list:
                     sample_1, sample_2 = list.read().splitlines()
-                    cmd_create_config_file = f"{shortcuts.configManta_file} --tumorBam={shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1} --bam={shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2} --referenceFasta={shortcuts.reference_genome_file} --runDir={shortcuts.manta_output_dir}{options.tumor_id}/"
-                    misc.run_command(cmd_create_config_file, "Manta create config file (step 1)", shortcuts.runWorkflow_file, None)
-                    cmd_runWorkflow = f"{shortcuts.runWorkflow_file} -m local -j 4"
-                    misc.run_command(cmd_runWorkflow, 'Manta running workflow (step 2)', f"{shortcuts.manta_variants_dir}somaticSV.vcf.gz", None)
-                    cmd_unzip = f'gunzip {shortcuts.manta_variants_dir}somaticSV.vcf.gz'
-                    misc.run_command(cmd_unzip, 'Unzipping somaticSV.vcf.gz (step 3)', f"{shortcuts.manta_variants_dir}somaticSV.vcf", None)
-                    cmd_filter = f'bcftools view -i \'FILTER=="PASS"\' {shortcuts.manta_variants_dir}somaticSV.vcf > {shortcuts.manta_variants_dir}somaticSV_PASS.vcf'
-                    misc.run_command(cmd_filter, 'Filtering of passed SNV\'s (step 4)', f"{shortcuts.manta_variants_dir}somaticSV_PASS.vcf", shortcuts.manta_complete)
+                    cmd_create_config_file = f"{shortcuts.configManta_file} --tumorBam={shortcuts.realigned_output_dir}{options.tumor_id}/{sample_1} --bam={shortcuts.realigned_output_dir}{options.tumor_id}/{sample_2} --referenceFasta={shortcuts.reference_genome_file} --callRegions={call_regions_file} --runDir={shortcuts.manta_output_dir}{options.tumor_id}/"
+                    misc.run_command("configManta", "Manta create config file (step 1)", shortcuts.runWorkflow_file, None, cmd_create_config_file)
+                    cmd_runWorkflow = f"{shortcuts.runWorkflow_file} -m local -j {threads} -g {memory}"
+                    misc.run_command("runWorkflow", 'Manta running workflow (step 2)', f"{shortcuts.manta_variants_dir}somaticSV.vcf.gz", None, cmd_runWorkflow)
+                    cmd_filter = f'bcftools view -i \'FILTER=="PASS"\' {shortcuts.manta_variants_dir}somaticSV.vcf.gz -o {shortcuts.manta_variants_dir}somaticSV_PASS.vcf'
+                    misc.run_command("bcftools view", 'Filtering of passed SNV\'s (step 3)', f"{shortcuts.manta_variants_dir}somaticSV_PASS.vcf", shortcuts.manta_complete, cmd_filter)
                     elapsed = timeit.default_timer() - start
                     misc.log_to_file("INFO", f'Manta SNV calling succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
         except Exception as e:
@@ -0,0 +1,434 @@
+from os import environ, getenv, killpg, listdir, path, remove, replace, stat, wait4, WNOHANG, WIFEXITED, WEXITSTATUS, WTERMSIG
+from runtime_history import RuntimeHistory
+from progress import ProgressMeter
+import re
+import signal
+import subprocess
+import time
+
+
+class Job():
+    '''A tool invocation submitted to an executor. The job is completed when trackfile exists, threads and memory (GB) are
+    the resources it needs. If output is given the trackfile records its size and modification time, and the job is run
+    again if the output was removed or changed. A failed job is started again up to retries times.
+    stage (default: the job name up to the first _) and input_size key the runtime history of the job. side_paths are the other
+    files and temp prefixes the command writes (metrics, intermediate files), a speculative duplicate gets its own copies of them'''
+
+    def __init__(self, name, command, trackfile=None, text=None, threads=1, memory=4, output=None, retries=0, stage=None, input_size=None, side_paths=None):
+        self.name = name
+        self.command = command
+        self.trackfile = trackfile
+        self.text = text or name
+        self.threads = threads
+        self.memory = memory
+        self.output = output
+        self.retries = retries
+        self.attempt = 1
+        self.stage = stage or name.split('_')[0]
+        self.input_size = input_size
+        self.side_paths = side_paths or []
+
+
+#-------------------------------------------------------------------------------
+def create_executor(options, misc, shortcuts):
+    '''Returns the executor selected with --executor (local or slurm)'''
+
+    misc.create_directory([shortcuts.executor_dir])
+    history = RuntimeHistory(shortcuts.runtime_history_db)
+    if getattr(options, "executor", "local") == "slurm":
+        return SlurmExecutor(misc, shortcuts.executor_dir, history, options.tumor_id, reads_size(shortcuts), getattr(options, "partition", None))
+    return LocalExecutor(misc, shortcuts.executor_dir, history, options.tumor_id, reads_size(shortcuts), int(options.threads), misc.memory_budget(options))
+
+
+#-------------------------------------------------------------------------------
+def reads_size(shortcuts):
+    '''Returns the size in bytes of the DNA reads of the sample, the input size that whole stages are keyed by'''
+
+    if not path.isdir(shortcuts.dna_reads_dir):
+        return 0
+    return sum(stat(f"{shortcuts.dna_reads_dir}{file}").st_size for file in listdir(shortcuts.dna_reads_dir))
+
+
+class LocalExecutor():
+    '''This class runs jobs on this machine, as many at a time as the thread and memory budget allows. Every job runs in its
+    own process group with its output in {log_dir}{job name}.log.
+    When no jobs are waiting, a job that runs much longer than the median runtime of its finished siblings (a straggler on a
+    hot disk or a noisy node) gets a speculative duplicate on the free capacity. The duplicate writes its output and side paths
+    to a .speculative/ folder next to them; the copy that finishes first is used and the other one is killed.
+    With a runtime history jobs are started longest predicted runtime first, sized by the peak memory seen for their stage,
+    and a job that does not fit is passed by smaller jobs that do. Runtime and peak memory of every job are recorded.
+    The progress lines in the log of every running job are followed and written to the status file of misc'''
+
+    def __init__(self, misc, log_dir, history, sample, sample_size, threads, memory):
+        self.misc = misc
+        self.log_dir = log_dir
+        self.history = history
+        self.sample = sample
+        self.sample_size = sample_size
+        self.threads = threads
+        self.memory = memory
+        self.peak_rss = {}
+        self.poll_interval = 1
+        # A job is a straggler when it has run straggler_factor times the median runtime of at least straggler_siblings
+        # finished siblings, and at least straggler_seconds
+        self.straggler_factor = 2.0
+        self.straggler_siblings = 3
+        self.straggler_seconds = 60
+
+    #---------------------------------------------------------------------------
+    def start(self, job, duplicate=False):
+        '''Starts a job (or its speculative duplicate) and returns its process'''
+
+        command = job.command
+        if duplicate:
+            # One pass over the command, so a path is never moved twice when it contains another one
+            paths = sorted([job.output] + job.side_paths, key=len, reverse=True)
+            command = re.sub("|".join(re.escape(file) for file in paths), lambda match: self.speculative_path(match.group(0)), command)
+        with open(f"{self.log_dir}{job.name}{'.speculative' if duplicate else ''}.log", 'w') as log:
+            return subprocess.Popen(["/bin/bash", "-c", f"set -o pipefail; {command}"], stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    #---------------------------------------------------------------------------
+    def meter(self, job):
+        '''Returns the progress meter of a job, with the runtime predicted by the runtime history for the ETA'''
+
+        return ProgressMeter(self.misc, self.misc.status_file, f"{job.stage}/{job.name}", job.stage, predicted=self.history.predict_elapsed(job.stage, job.input_size))
+
+    #---------------------------------------------------------------------------
+    def poll(self, process):
+        '''Returns the returncode of a process or None if it is running. The peak memory (MB) of the process and the processes
+        it waited for is kept in peak_rss'''
+
+        if process.returncode is None:
+            pid, status, rusage = wait4(process.pid, WNOHANG)
+            if pid:
+                process.returncode = WEXITSTATUS(status) if WIFEXITED(status) else -WTERMSIG(status)
+                self.peak_rss[process.pid] = rusage.ru_maxrss / 1024
+        return process.returncode
+
+    #---------------------------------------------------------------------------
+    def schedule(self, jobs):
+        '''Sizes the jobs by the peak memory seen for their stage (at least their declared memory) and orders them longest predicted runtime first. Jobs without
+        a prediction keep their order and go first'''
+
+        predicted = {}
+        for job in jobs:
+            # The recorded peak is the RSS of the top process only (not the pipe or children), so it never lowers the declared memory
+            job.memory = max(self.history.predict_memory(job.stage) or 0, job.memory)
+            predicted[job] = self.history.predict_elapsed(job.stage, job.input_size)
+        jobs = sorted(jobs, key=lambda job: -predicted[job] if predicted[job] is not None else float('-inf'))
+        if any(predicted.values()):
+            self.misc.log_to_file("DEBUG", f"Jobs ordered longest predicted runtime first: {', '.join(job.name for job in jobs)}")
+        return jobs
+
+    #---------------------------------------------------------------------------
+    def speculative_path(self, file):
+        '''Returns where the speculative duplicate of a job writes file (its output or a side path)'''
+
+        return f"{path.dirname(file)}/.speculative/{path.basename(file)}"
+
+    #---------------------------------------------------------------------------
+    def stop(self, process):
+        '''Kills a job with all processes it started'''
+
+        try:
+            killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        if process.returncode is None:
+            process.wait()
+
+    #---------------------------------------------------------------------------
+    def first_finished(self, job, process, duplicate):
+        '''Returns the returncode of the copy of a job that finished first, or None if it is still running. A failed copy waits
+        for the other one. If the duplicate wins its output files are moved in place of the output of the job'''
+
+        if not duplicate:
+            return self.poll(process)
+        returncode, duplicate_returncode = self.poll(process), self.poll(duplicate)
+        if returncode is None and duplicate_returncode != 0 or duplicate_returncode is None and returncode not in (None, 0):
+            return None
+        paths = [job.output] + job.side_paths
+        if returncode != 0 and duplicate_returncode == 0:
+            self.stop(process)
+            for output in paths:
+                speculative_dir = path.dirname(self.speculative_path(output))
+                for file in listdir(speculative_dir):
+                    if file.startswith(path.basename(output)):
+                        replace(f"{speculative_dir}/{file}", f"{path.dirname(output)}/{file}")
+            self.misc.log_to_file("INFO", f"Speculative duplicate of {job.text} finished first")
+            returncode = 0
+        else:
+            self.stop(duplicate)
+        for output in paths:
+            speculative_dir = path.dirname(self.speculative_path(output))
+            for file in listdir(speculative_dir):
+                if file.startswith(path.basename(output)):
+                    remove(f"{speculative_dir}/{file}")
+        return returncode
+
+    #---------------------------------------------------------------------------
+    def straggler(self, job, started, runtimes):
+        '''Returns True if a running job is a straggler compared to the runtimes of its finished siblings'''
+
+        if len(runtimes) < self.straggler_siblings or not job.output or job.output not in job.command:
+            return False
+        median = sorted(runtimes)[len(runtimes) // 2]
+        return time.time() - started > max(self.straggler_seconds, self.straggler_factor * median)
+
+    #---------------------------------------------------------------------------
+    def fits(self, job, running):
+        '''Returns True if job fits in the threads and memory not used by the running processes'''
+
+        return sum(other.threads for other in running) + job.threads <= self.threads and sum(other.memory for other in running) + job.memory <= self.memory
+
+    #---------------------------------------------------------------------------
+    def completed(self, job):
+        '''Returns True if the trackfile of the job exists and its output has the size and modification time it recorded'''
+
+        if not (job.trackfile and path.isfile(job.trackfile)):
+            return False
+        if not job.output:
+            return True
+        with open(job.trackfile, 'r') as trackfile:
+            record = trackfile.read().split()
+        if path.isfile(job.output) and record == [str(stat(job.output).st_size), str(stat(job.output).st_mtime_ns)]:
+            return True
+        self.misc.log_to_file("WARNING", f"{job.output} is missing or has changed since {job.text} completed, runs it again")
+        remove(job.trackfile)
+        return False
+
+    #---------------------------------------------------------------------------
+    def finished(self, job, returncode, log_file):
+        '''Logs the result of a job and creates its trackfile. Returns True if the job succeeded'''
+
+        if returncode == 0 and job.output and not path.isfile(job.output):
+            self.misc.log_to_file("ERROR", f"{job.text} ended without writing {job.output}")
+            returncode = -1
+        if returncode == 0:
+            if job.trackfile:
+                with open(job.trackfile, 'w') as trackfile:
+                    if job.output:
+                        trackfile.write(f"{stat(job.output).st_size} {stat(job.output).st_mtime_ns}\n")
+            self.misc.log_to_file("INFO", f"{job.text} succesfully completed")
+            return True
+        last_lines = []
+        if path.isfile(log_file):
+            with open(log_file, 'r') as log:
+                last_lines = log.readlines()[-5:]
+        if job.attempt <= job.retries:
+            self.misc.log_to_file("WARNING", f"{job.text} ended with returncode {returncode} (attempt {job.attempt} of {job.retries + 1}), starts it again. See {log_file}: {''.join(last_lines).strip()}")
+        else:
+            self.misc.log_to_file("ERROR", f"{job.text} ended with returncode {returncode}, see {log_file}: {''.join(last_lines).strip()}")
+        return False
+
+    #---------------------------------------------------------------------------
+    def retry(self, job):
+        '''Returns True if the failed job has attempts left, and counts the attempt'''
+
+        if job.attempt > job.retries:
+            return False
+        job.attempt += 1
+        return True
+
+    #---------------------------------------------------------------------------
+    def pending(self, jobs):
+        '''Returns the jobs that are not allready completed'''
+
+        pending = [job for job in jobs if not self.completed(job)]
+        if len(pending) < len(jobs):
+            self.misc.log_to_file("INFO", f"{len(jobs) - len(pending)} of {len(jobs)} jobs allready completed, skips them...")
+        return pending
+
+    #---------------------------------------------------------------------------
+    def run(self, jobs):
+        '''This function runs the jobs and waits for all of them. Returns True if all jobs succeeded'''
+
+        pending = self.schedule(self.pending(jobs))
+        self.peak_rss = {}
+        running = {}
+        duplicates = {}
+        started = {}
+        runtimes = []
+        failed = []
+        meters = {}
+        run_start = time.time()
+        try:
+            while pending or running:
+                # Start the first jobs that fit in the free threads and memory, a job larger than the budget runs alone
+                for job in list(pending):
+                    if running and not self.fits(job, list(running) + list(duplicates)):
+                        continue
+                    pending.remove(job)
+                    self.misc.log_to_file("DEBUG", f"Starting {job.name}: {job.command}")
+                    running[job] = self.start(job)
+                    started[job] = time.time()
+                    meters[job] = self.meter(job)
+                for job, process in list(running.items()):
+                    meters[job].follow(f"{self.log_dir}{job.name}.log")
+                    returncode = self.first_finished(job, process, duplicates.get(job))
+                    if returncode is None:
+                        continue
+                    del running[job]
+                    duplicates.pop(job, None)
+                    meters[job].finish(returncode == 0)
+                    if self.finished(job, returncode, f"{self.log_dir}{job.name}.log"):
+                        runtimes.append(time.time() - started[job])
+                        self.history.record(job.stage, job.name, self.sample, job.input_size, runtimes[-1], self.peak_rss.get(process.pid), job.threads)
+                    elif self.retry(job):
+                        pending.append(job)
+                    else:
+                        failed.append(job)
+                # Speculate only on capacity that no waiting job can use
+                for job in running:
+                    if not pending and job not in duplicates and self.straggler(job, started[job], runtimes) and self.fits(job, list(running) + list(duplicates)):
+                        self.misc.log_to_file("WARNING", f"{job.text} has run {self.misc.elapsed_time(time.time() - started[job])}, more than {self.straggler_factor} times the median of its siblings, starts a speculative duplicate")
+                        self.misc.create_directory([path.dirname(self.speculative_path(file)) + "/" for file in [job.output] + job.side_paths])
+                        duplicates[job] = self.start(job, duplicate=True)
+                if running:
+                    time.sleep(self.poll_interval)
+            # Whole stage runtimes are only comparable if no job was skipped as allready completed
+            if runtimes and not failed and len(runtimes) == len(jobs):
+                self.history.record(jobs[0].stage, "-", self.sample, self.sample_size, time.time() - run_start, max(self.peak_rss.values(), default=None), self.threads)
+            return not failed
+        except BaseException:
+            for process in list(running.values()) + list(duplicates.values()):
+                self.stop(process)
+            raise
+
+
+class SlurmExecutor(LocalExecutor):
+    '''This class submits jobs to a SLURM cluster. Jobs that need the same resources are submitted as one job array and the
+    scheduler is polled until every task has written the .rc file with its return code, or until the array has left the queue
+    and sacct reports all its tasks finished (a task killed by the scheduler writes no .rc file). A failed squeue is polled again.
+    The scheduler commands can be replaced (e.g. with stubs for offline tests) with $BASE_SBATCH, $BASE_SQUEUE, $BASE_SCANCEL
+    and $BASE_SACCT.
+    The runtime of every task is recorded in the runtime history, its peak memory is not known here. Progress is followed in the
+    task logs, as often as the queue is polled'''
+
+    def __init__(self, misc, log_dir, history, sample, sample_size, partition=None):
+        self.misc = misc
+        self.log_dir = log_dir
+        self.history = history
+        self.sample = sample
+        self.sample_size = sample_size
+        self.partition = partition
+        self.sbatch = getenv("BASE_SBATCH", "sbatch")
+        self.squeue = getenv("BASE_SQUEUE", "squeue")
+        self.scancel = getenv("BASE_SCANCEL", "scancel")
+        self.sacct = getenv("BASE_SACCT", "sacct")
+        self.poll_interval = int(getenv("BASE_SLURM_POLL", "30"))
+        # States sacct reports for tasks that will not run again
+        self.final_states = ("COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE")
+        # Without job accounting the arrays are done when squeue has not listed them for this many polls in a row
+        self.empty_polls = 5
+
+    #---------------------------------------------------------------------------
+    def submit(self, array_dir, jobs):
+        '''Writes one task script per job and submits them as a job array. Returns the job id'''
+
+        for task, job in enumerate(jobs):
+            with open(f"{array_dir}task_{task}.sh", 'w') as script:
+                script.write(f"#!/bin/bash\nexport PATH={environ.get('PATH', '')}\nset -o pipefail\n{job.command}\n")
+        with open(f"{array_dir}array.sh", 'w') as script:
+            script.write(f"#!/bin/bash\nbash {array_dir}task_${{SLURM_ARRAY_TASK_ID}}.sh\necho $? $SECONDS > {array_dir}task_${{SLURM_ARRAY_TASK_ID}}.rc\n")
+        cmd_sbatch = [self.sbatch, "--parsable", f"--job-name={path.basename(array_dir.rstrip('/'))}", f"--array=0-{len(jobs) - 1}",
+                      f"--cpus-per-task={jobs[0].threads}", f"--mem={jobs[0].memory}G", f"--output={array_dir}task_%a.log"]
+        if self.partition:
+            cmd_sbatch.append(f"--partition={self.partition}")
+        submitted = subprocess.run(cmd_sbatch + [f"{array_dir}array.sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if submitted.returncode != 0:
+            raise Exception(f"{self.sbatch} failed: {submitted.stdout.strip()}")
+        return submitted.stdout.strip().splitlines()[-1].split(';')[0]
+
+    #---------------------------------------------------------------------------
+    def arrays_finished(self, job_ids):
+        '''Returns True if sacct reports every task of the job arrays in a final state, False if not and None if job accounting
+        can not be read'''
+
+        accounting = subprocess.run([self.sacct, "-n", "-X", "-P", "-o", "State", "-j", ",".join(job_ids)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        states = [line.split()[0] for line in accounting.stdout.splitlines() if line.strip()]
+        if accounting.returncode != 0 or not states:
+            return None
+        return all(state in self.final_states for state in states)
+
+    #---------------------------------------------------------------------------
+    def run(self, jobs):
+        '''This function submits the jobs and waits until they have left the queue. Failed jobs with attempts left are
+        submitted again. Returns True if all jobs succeeded'''
+
+        pending = self.schedule(self.pending(jobs))
+        failed = []
+        run_start = time.time()
+        waiting = pending
+        while waiting:
+            # Jobs without attempts left stay failed, only the others are submitted again
+            retried = []
+            for job in self.run_arrays(waiting):
+                if self.retry(job):
+                    retried.append(job)
+                else:
+                    failed.append(job)
+            waiting = retried
+        if jobs and not failed and len(pending) == len(jobs):
+            self.history.record(jobs[0].stage, "-", self.sample, self.sample_size, time.time() - run_start, None, None)
+        return not failed
+
+    #---------------------------------------------------------------------------
+    def run_arrays(self, jobs):
+        '''Submits the jobs as job arrays, waits until they have left the queue and returns the jobs that failed'''
+
+        arrays = {}
+        for job in jobs:
+            arrays.setdefault((job.threads, job.memory), []).append(job)
+        submitted = {}
+        try:
+            for number, ((threads, memory), array_jobs) in enumerate(arrays.items()):
+                array_dir = f"{self.log_dir}{array_jobs[0].name}_array{number}_{time.time_ns()}/"
+                self.misc.create_directory([array_dir])
+                job_id = self.submit(array_dir, array_jobs)
+                submitted[job_id] = (array_dir, array_jobs)
+                self.misc.log_to_file("INFO", f"Submitted job array {job_id} with {len(array_jobs)} tasks ({threads} threads, {memory} GB each)")
+
+            meters = {job: self.meter(job) for array_dir, array_jobs in submitted.values() for job in array_jobs}
+            empty = 0
+            while submitted:
+                time.sleep(self.poll_interval)
+                for array_dir, array_jobs in submitted.values():
+                    for task, job in enumerate(array_jobs):
+                        meters[job].follow(f"{array_dir}task_{task}.log")
+                # Every task writes its .rc file when it ends, only tasks killed by the scheduler do not
+                if all(path.isfile(f"{array_dir}task_{task}.rc") for array_dir, array_jobs in submitted.values() for task in range(len(array_jobs))):
+                    break
+                queue = subprocess.run([self.squeue, "-h", "-o", "%i", "-j", ",".join(submitted)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                if queue.returncode != 0:
+                    # squeue fails now and then when the controller is busy, the arrays are still there
+                    self.misc.log_to_file("WARNING", f"{self.squeue} failed, polls again: {queue.stdout.strip()}")
+                    continue
+                if queue.stdout.strip():
+                    empty = 0
+                    continue
+                empty += 1
+                finished = self.arrays_finished(submitted)
+                if finished or (finished is None and empty >= self.empty_polls):
+                    break
+
+            failed = []
+            for job_id, (array_dir, array_jobs) in submitted.items():
+                for task, job in enumerate(array_jobs):
+                    # No .rc file: the task was killed by the scheduler (time limit, memory, node failure)
+                    rc_file = f"{array_dir}task_{task}.rc"
+                    returncode, elapsed = -1, None
+                    if path.isfile(rc_file):
+                        with open(rc_file, 'r') as rc:
+                            returncode, elapsed = [int(value) for value in rc.read().split()]
+                    meters[job].follow(f"{array_dir}task_{task}.log")
+                    meters[job].finish(returncode == 0)
+                    if self.finished(job, returncode, f"{array_dir}task_{task}.log"):
+                        self.history.record(job.stage, job.name, self.sample, job.input_size, elapsed, None, job.threads)
+                    else:
+                        failed.append(job)
+            return failed
+        except BaseException:
+            if submitted:
+                subprocess.run([self.scancel] + list(submitted), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            raise
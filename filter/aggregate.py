@@ -0,0 +1,118 @@
+import pandas as pd
+import argparse
+import sqlite3
+import time
+import json
+from filter import read_ase_table, significant_sites, significant_genes
+
+
+# Sufficient statistics stored per gene and sample, and summed per gene and subgroup
+statistics = ['sites', 'significant', 'RNA_refCount', 'RNA_altCount', 'DNA_refCount', 'DNA_altCount']
+ase_columns = ['Subgroup', 'Sample', 'geneName', 'RNA_refCount', 'RNA_altCount', 'DNA_refCount', 'DNA_altCount', 'pValue_WGS_VAF', 'pValue_CNV', 'RNA/DNA_ratio_WGS_VAF', 'RNA/DNA_ratio_CNV']
+
+
+def connect(database):
+    '''Returns a connection to the aggregation store and creates the tables if they do not exist.
+    sample_gene holds the statistics of every gene in every sample, subgroup_gene the sum over the samples of a subgroup'''
+
+    connection = sqlite3.connect(database, timeout=60)
+    connection.execute('''CREATE TABLE IF NOT EXISTS parameters (name TEXT PRIMARY KEY, value TEXT)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS samples (sample TEXT PRIMARY KEY, subgroup TEXT, sites INTEGER, added REAL)''')
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS sample_gene (subgroup TEXT, sample TEXT, geneName TEXT,
+                           {", ".join(f"{column} INTEGER" for column in statistics)}, PRIMARY KEY (sample, geneName))''')
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS subgroup_gene (subgroup TEXT, geneName TEXT, samples INTEGER DEFAULT 0, significant_samples INTEGER DEFAULT 0,
+                           {", ".join(f"{column} INTEGER DEFAULT 0" for column in statistics)}, PRIMARY KEY (subgroup, geneName))''')
+    return connection
+
+
+def check_parameters(connection, options):
+    '''Stores the significance thresholds with the first sample. The statistics of samples added with other thresholds can not be
+    summed, so adding a sample with other thresholds is an error'''
+
+    parameters = json.dumps({"pvalue": float(options.pvalue), "lower_foldchange": float(options.lower_foldchange), "upper_foldchange": float(options.upper_foldchange)}, sort_keys=True)
+    stored = connection.execute("SELECT value FROM parameters WHERE name = 'thresholds'").fetchone()
+    if stored is None:
+        connection.execute("INSERT INTO parameters VALUES ('thresholds', ?)", (parameters,))
+    elif stored[0] != parameters:
+        raise SystemExit(f"The store was built with thresholds {stored[0]}, not {parameters}. Use a new database for other thresholds")
+
+
+def sample_statistics(df, options):
+    '''Returns the statistics of every gene in the ASE table of one sample'''
+
+    df = df.assign(sites=1, significant=significant_sites(df, options.pvalue, options.lower_foldchange, options.upper_foldchange).astype(int))
+    return df.groupby('geneName', observed=True)[statistics].sum().astype('int64').reset_index()
+
+
+def update_subgroup(connection, subgroup, genes, sign):
+    '''Adds (sign 1) or subtracts (sign -1) the statistics of one sample to the subgroup totals of its genes'''
+
+    connection.executemany("INSERT OR IGNORE INTO subgroup_gene (subgroup, geneName) VALUES (?, ?)", [(subgroup, gene) for gene in genes['geneName']])
+    connection.executemany(f'''UPDATE subgroup_gene SET samples = samples + ?, significant_samples = significant_samples + ?,
+                               {", ".join(f"{column} = {column} + ?" for column in statistics)} WHERE subgroup = ? AND geneName = ?''',
+                           [(sign, sign * int(significant_genes(row.sites, row.significant)), *[sign * int(getattr(row, column)) for column in statistics], subgroup, row.geneName)
+                            for row in genes.itertuples(index=False)])
+
+
+def add_sample(connection, subgroup, sample, df, options):
+    '''Replaces the statistics of a sample with those of its ASE table. Only the genes of this sample are touched, and adding the
+    same sample again gives the same store'''
+
+    genes = sample_statistics(df, options)
+    with connection:
+        old = pd.read_sql_query(f"SELECT subgroup, geneName, {', '.join(statistics)} FROM sample_gene WHERE sample = ?", connection, params=(sample,))
+        for old_subgroup, old_genes in old.groupby('subgroup'):
+            update_subgroup(connection, old_subgroup, old_genes, -1)
+        connection.execute("DELETE FROM sample_gene WHERE sample = ?", (sample,))
+        connection.execute("DELETE FROM subgroup_gene WHERE samples = 0")
+        connection.executemany(f"INSERT INTO sample_gene VALUES (?, ?, ?, {', '.join('?' for column in statistics)})",
+                               [(subgroup, sample, row.geneName, *[int(getattr(row, column)) for column in statistics]) for row in genes.itertuples(index=False)])
+        update_subgroup(connection, subgroup, genes, 1)
+        connection.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)", (sample, subgroup, len(df), time.time()))
+    print(f"{sample} ({subgroup}): {len(df)} sites in {len(genes)} genes, {int(significant_genes(genes['sites'], genes['significant']).sum())} significant genes")
+
+
+def rank_genes(connection, subgroups=None, min_samples=1):
+    '''Returns the genes of the cohort (or of some subgroups) ranked by the number of samples where the gene has significant ASE.
+    Read from the subgroup totals, so the ranking does not depend on the number of sites in the store'''
+
+    where = f"WHERE subgroup IN ({', '.join('?' for subgroup in subgroups)})" if subgroups else ""
+    df = pd.read_sql_query(f'''SELECT geneName, SUM(samples) AS samples, SUM(significant_samples) AS significant_samples,
+                               {", ".join(f"SUM({column}) AS {column}" for column in statistics)} FROM subgroup_gene {where}
+                               GROUP BY geneName HAVING SUM(samples) >= ?''', connection, params=(*(subgroups or []), min_samples))
+    df['fraction_significant_samples'] = df['significant_samples'] / df['samples']
+    df['fraction_significant_sites'] = df['significant'] / df['sites']
+    df['RNA_refAllele_fraction'] = df['RNA_refCount'] / (df['RNA_refCount'] + df['RNA_altCount'])
+    df['DNA_refAllele_fraction'] = df['DNA_refCount'] / (df['DNA_refCount'] + df['DNA_altCount'])
+    return df.sort_values(['significant_samples', 'fraction_significant_samples', 'fraction_significant_sites'], ascending=False).reset_index(drop=True)
+
+
+def main():
+    # argparse lets ju input arguments to the script before starting it
+    parser = argparse.ArgumentParser(description='''This script keeps a store of gene ASE statistics per sample and subgroup, adds samples to it and ranks the genes of the cohort''')
+    parser.add_argument("-d", "--database", metavar="", required=True, help="Enter the aggregation store (sqlite file, created if it does not exist)")
+    parser.add_argument("-i", "--input", metavar="", help="Enter ASE table to add (csv, .parquet file or Parquet dataset folder)")
+    parser.add_argument("-S", "--sample", metavar="", nargs="+", help="Enter samples of the input to add (default: all samples in the input)")
+    parser.add_argument("-p", "--pvalue", metavar="", help="Enter threshold pValue (needed with --input)")
+    parser.add_argument("-l", "--lower_foldchange", metavar="", help="Enter lower threshold foldchange (needed with --input)")
+    parser.add_argument("-u", "--upper_foldchange", metavar="", help="Enter upper threshold foldchange (needed with --input)")
+    parser.add_argument("-o", "--output", metavar="", help="Enter output file for the gene ranking (.csv)")
+    parser.add_argument("-s", "--subgroup", metavar="", nargs="+", help="Enter subgroups to rank (default: whole cohort)")
+    parser.add_argument("-m", "--min_samples", metavar="", type=int, default=1, help="Enter the minimum number of samples with the gene to rank it (default: 1)")
+    options = parser.parse_args() # all arguments can be called by options. e.g. options.input
+    if options.input and None in (options.pvalue, options.lower_foldchange, options.upper_foldchange):
+        parser.error("--input needs --pvalue, --lower_foldchange and --upper_foldchange")
+
+    connection = connect(options.database)
+    if options.input:
+        with connection:
+            check_parameters(connection, options)
+        df = read_ase_table(options.input, ase_columns, None, options.sample)
+        for (subgroup, sample), df_sample in df.groupby(['Subgroup', 'Sample'], observed=True):
+            add_sample(connection, subgroup, sample, df_sample, options)
+    if options.output:
+        rank_genes(connection, options.subgroup, options.min_samples).to_csv(options.output, sep=',', index=False)
+    connection.close()
+
+if __name__ == '__main__':
+    main()
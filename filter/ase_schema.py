@@ -0,0 +1,8 @@
+# Column types of the ASE table, used by rna_seq_analysis.py when it writes the table and by filter.py and aggregate.py when they
+# read it. Repeated strings are categoricals (one dictionary per column)
+ase_schema = {
+    'Subgroup': 'category', 'Sample': 'category', 'geneName': 'category', 'variantType': 'category', 'Chromosome': 'category',
+    'position': 'int32', 'variantID': 'category', 'RNA_refAllele': 'category', 'RNA_altAllele': 'category',
+    'RNA_refCount': 'int32', 'RNA_altCount': 'int32', 'RNA_totalCount': 'int32', 'DNA_refCount': 'int32', 'DNA_altCount': 'int32', 'CN': 'int8',
+    'pValue_WGS_VAF': 'float64', 'RNA/DNA_ratio_WGS_VAF': 'float32', 'pValue_CNV': 'float64', 'RNA/DNA_ratio_CNV': 'float32',
+    }
@@ -1,88 +1,82 @@
 import pandas as pd
 import argparse
+from os import path
+from ase_schema import ase_schema
 
 
-
-def filter_csv(options):
-    df = pd.read_csv(options.input)
-
-
-
-
-    # create an empty dict
-    genes = {}
-    jonas_genes1 = []
-    jonas_genes2 = []
+# Columns the filter needs, they are always read even if --columns leaves them out
+filter_columns = ['geneName', 'pValue_WGS_VAF', 'pValue_CNV', 'RNA/DNA_ratio_WGS_VAF', 'RNA/DNA_ratio_CNV']
 
 
+def read_ase_table(input, columns=None, subgroups=None, samples=None):
+    '''Reads an ASE table from a csv file or from a Parquet dataset (folder partitioned by Subgroup and Sample, or one .parquet file).
+    With Parquet only the requested columns are read, and the subgroup and sample filters skip whole partitions'''
 
-    # counters for validation
-    tot = 0
-    sig = 0
+    if path.isdir(input) or input.endswith('.parquet'):
+        filters = []
+        if subgroups:
+            filters.append(('Subgroup', 'in', subgroups))
+        if samples:
+            filters.append(('Sample', 'in', samples))
+        return pd.read_parquet(input, engine='pyarrow', columns=columns, filters=filters or None).reset_index(drop=True)
 
-    # assign geneName as dict key and 2 empty placeholders for counting total genes and significant genes
-    for index, row in df.iterrows():
-        genes[row.loc['geneName']] = [0,0]
+    df = pd.read_csv(input, usecols=lambda column: columns is None or column in columns + ['Subgroup', 'Sample'], dtype=ase_schema)
+    if subgroups:
+        df = df[df['Subgroup'].isin(subgroups)]
+    if samples:
+        df = df[df['Sample'].isin(samples)]
+    return df[columns].reset_index(drop=True) if columns else df.reset_index(drop=True)
 
-    # iterate trough rows in df. if conditions are fullfilled for that geneName, add +1 for total count and +1 for count that fullfills condition, i.e., is significant.
-    # else just add total count for that geneName
 
-    # dict will show: geneName : {[total counts, matching counts]}
+def significant_sites(df, pvalue, lower_foldchange, upper_foldchange):
+    '''Returns True for every site (row) with significant ASE: both pValues <= pvalue and both RNA/DNA ratios outside the
+    lower - upper foldchange interval'''
 
-    for index, row in df.iterrows():
-        if row.loc['pValue_WGS_VAF'] <= float(options.pvalue) and row.loc['pValue_CNV'] <= float(options.pvalue) and not float(options.lower_foldchange) < row.loc['RNA/DNA_ratio_WGS_VAF'] < float(options.upper_foldchange) and not float(options.lower_foldchange) < row.loc['RNA/DNA_ratio_CNV'] <  float(options.upper_foldchange):
-            genes[row.loc['geneName']][0] += 1
-            genes[row.loc['geneName']][1] += 1
-            tot += 1
-            sig += 1
-        else:
-            genes[row.loc['geneName']][0] += 1
-            tot += 1
-    print("tot:", tot, "sig:", sig)
+    lower, upper = float(lower_foldchange), float(upper_foldchange)
+    return (
+        (df['pValue_WGS_VAF'] <= float(pvalue)) & (df['pValue_CNV'] <= float(pvalue))
+        & ~((lower < df['RNA/DNA_ratio_WGS_VAF']) & (df['RNA/DNA_ratio_WGS_VAF'] < upper))
+        & ~((lower < df['RNA/DNA_ratio_CNV']) & (df['RNA/DNA_ratio_CNV'] < upper))
+        )
 
 
-    # Thiw is just used to compare my gene list to minjuns earlier results
-    for index, row in df.iterrows():
-        if genes[row.loc['geneName']][1] >= (genes[row.loc['geneName']][0]/2):
-            jonas_genes1.append(row.loc['geneName'])
-            if row.loc['geneName'] not in jonas_genes2:
-                jonas_genes2.append(row.loc['geneName'])
+def significant_genes(sites, significant):
+    '''Returns True for genes where at least half of the sites are significant'''
 
+    return significant >= sites / 2
 
 
+def filter_csv(options):
+    columns = list(dict.fromkeys(options.columns.split(',') + filter_columns)) if options.columns else None
+    df = read_ase_table(options.input, columns, options.subgroup, options.sample)
 
-    # overlap = 0
-    # print("jonas:", len(jonas_genes1), len(jonas_genes2))
-    # with open("HeH_2064-01.txt", "r") as minjun:
-    #     minjun_list = minjun.read().splitlines()
-    #     for gene in minjun_list:
-    #         if gene in jonas_genes2:
-    #             overlap += 1
-    # print(overlap, "/",len(minjun_list))
-
-    for index, row in df.iterrows():
-        # if not significant. (if significant gene entries are not bigger than 50% of total entries)
-        if not genes[row.loc['geneName']][1] >= (genes[row.loc['geneName']][0]/2): # if not significant > total/2
-            df.drop(index, inplace=True)
-
-
-
+    # dataframe will show: geneName : total counts, matching counts
+    significant = significant_sites(df, options.pvalue, options.lower_foldchange, options.upper_foldchange)
+    genes = significant.groupby(df['geneName'], observed=True).agg(['size', 'sum'])
+    print("tot:", len(df), "sig:", int(significant.sum()))
 
+    # remove sites of genes that are not significant (if significant gene entries are not bigger than 50% of total entries)
+    keep = significant_genes(genes['size'], genes['sum'])
+    df = df[df['geneName'].isin(keep.index[keep])]
 
-    # df.drop_duplicates(subset ="geneName", inplace=True)
-    # print(df)
-    # print filtered file to csv
-    df.to_csv(options.output, sep=',', index=False)
+    # print filtered file to csv, or to parquet if the output file ends with .parquet
+    if options.output.endswith('.parquet'):
+        df.to_parquet(options.output, engine='pyarrow', index=False)
+    else:
+        df.to_csv(options.output, sep=',', index=False)
 
 
 def main():
     # argparse lets ju input arguments to the script before starting it
     parser = argparse.ArgumentParser(description='''This script is used to filter out genes with significant ASE''')
-    parser.add_argument("-i", "--input", metavar="", required=True, help="Enter input file")
-    parser.add_argument("-o", "--output", metavar="", required=True, help="Enter output file")
+    parser.add_argument("-i", "--input", metavar="", required=True, help="Enter input file (csv, .parquet file or Parquet dataset folder)")
+    parser.add_argument("-o", "--output", metavar="", required=True, help="Enter output file (.csv or .parquet)")
     parser.add_argument("-p", "--pvalue", metavar="", required=True, help="Enter threshold pValue")
     parser.add_argument("-l", "--lower_foldchange", metavar="", required=True, help="Enter lower threshold foldchange")
     parser.add_argument("-u", "--upper_foldchange", metavar="", required=True, help="Enter upper threshold foldchange")
+    parser.add_argument("-s", "--subgroup", metavar="", nargs="+", help="Enter subgroups to read (default: all)")
+    parser.add_argument("-S", "--sample", metavar="", nargs="+", help="Enter samples to read (default: all)")
+    parser.add_argument("-c", "--columns", metavar="", help="Enter comma separated columns to read and write (default: all)")
     options = parser.parse_args() # all arguments can be called by options. e.g. options.input
     filter_csv(options)
 
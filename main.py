@@ -6,14 +6,33 @@ import argparse
 from menus import Menus
 from miscellaneous import Misc
 from shortcuts import Shortcuts
+from runtime_history import RuntimeHistory
+from executor import reads_size
+from reference_bundle import ReferenceBundle
 import multiprocessing as mp
-from setup_anaconda3 import SetupAnaconda3
-from rna_seq_analysis import RnaSeqAnalysis
-from dna_seq_analysis import DnaSeqAnalysis
-from reference_genome import ReferenceGenome
+import importlib
 import time
 import timeit
 import signal
+import atexit
+
+
+# Stage registry, stage : (module, class). A stage module (and the packages it needs, e.g. pandas and scipy for RNA)
+# is only imported the first time the stage is used, so showing a menu or running a single step starts instantly
+stages = {
+    "setup": ("setup_anaconda3", "SetupAnaconda3"),
+    "reference_genome": ("reference_genome", "ReferenceGenome"),
+    "dna": ("dna_seq_analysis", "DnaSeqAnalysis"),
+    "rna": ("rna_seq_analysis", "RnaSeqAnalysis"),
+    }
+loaded_stages = {}
+
+def load_stage(name):
+    '''Imports the module of a stage the first time it is used and returns the stage object'''
+    if name not in loaded_stages:
+        module, stage_class = stages[name]
+        loaded_stages[name] = getattr(importlib.import_module(module), stage_class)()
+    return loaded_stages[name]
 
 
 
@@ -33,15 +52,27 @@ def main():
     parser.add_argument("-n", "--normal_id", metavar="", required=True, help="Input clinical id of normal samples")
     parser.add_argument("-sg", "--subgroup", metavar="", required=True, help="Input subgroup of your sample (STR)")
     parser.add_argument("-T", "--threads", metavar="", required=True, help="Input number of CPU threads to use (INT)")
+    parser.add_argument("-M", "--memory", metavar="", type=int, help="Input memory in GB the pipeline may use (INT, default: 80 %% of physical memory)")
+    parser.add_argument("-c", "--cohort", metavar="", help="Input file with one tumor id per line, used for cohort RNA mapping")
+    parser.add_argument("--scratch_dir", metavar="", help="Input fast local scratch folder (NVMe/tmpfs) for intermediate files (default: $BASE_SCRATCH)")
+    parser.add_argument("--shard_reads", metavar="", type=int, default=0, help="Input number of reads per shard to split FASTQ files into and align in parallel (INT, default: 0 = no sharding)")
+    parser.add_argument("--executor", metavar="", choices=["local", "slurm"], default="local", help="Input where pipeline jobs run: local or slurm (default: local)")
+    parser.add_argument("--partition", metavar="", help="Input SLURM partition to submit jobs to (used with --executor slurm)")
+    parser.add_argument("--dry_run", action="store_true", help="Print the predicted runtime and memory of the DNA-analysis from earlier runs instead of running it")
+    parser.add_argument("--markdup_backend", metavar="", choices=["picard", "samtools", "compare"], default="picard", help="Input duplicate marking backend: picard, samtools (streamed in the merge pass) or compare (both, with a report) (default: picard)")
+    parser.add_argument("--deep_validation", action="store_true", help="Also validate the aligned BAM files with Picard ValidateSamFile (in the background)")
+    parser.add_argument("--ase_format", metavar="", choices=["csv", "parquet"], default="csv", help="Input output format of the ASE table: csv or parquet (default: csv)")
+    parser.add_argument("--ase_model", metavar="", choices=["binomial", "betabinomial"], default="binomial", help="Input test for the ASE pValues: binomial or betabinomial (overdispersion fitted per sample, fewer false positives at high depth) (default: binomial)")
+    parser.add_argument("--ase_streaming", action="store_true", help="Join the het-SNP vcf and the ASE counts one chromosome at a time (memory independent of the number of sites)")
+    parser.add_argument("--reference_bundle", metavar="", help="Input shared folder with versioned reference bundles (indexed reference genome), used instead of a private index in reference_genome/")
+    parser.add_argument("--cohort_wasp", action="store_true", help="Map cohort samples one at a time with WASP tagging instead of in shared memory")
     options = parser.parse_args() # all arguments will be passed to the functions
     # hur göra här? options måste med i shortcuts
     misc = Misc()
     all_menus = Menus(misc)
     shortcuts = Shortcuts(options)
-    rna_analysis = RnaSeqAnalysis()
-    dna_analysis = DnaSeqAnalysis()
-    ref_genome = ReferenceGenome()
-    setup = SetupAnaconda3()
+    misc.start_logging(options, shortcuts)
+    atexit.register(misc.stop_logging)
 
     def signal_handler(sig, frame):
         misc.log_to_file("INFO", "Aborted by user!")
@@ -53,6 +84,12 @@ def main():
     misc.log_to_file("info", f"--normal_id: {options.normal_id}")
     misc.log_to_file("info", f"--subgroup: {options.subgroup}")
     misc.log_to_file("info", f"--thread: {options.threads}")
+    if options.scratch_dir and options.executor == "slurm":
+        misc.log_to_file("error", "--scratch_dir can not be used with --executor slurm, jobs on other nodes can not read node-local scratch. Exiting program...")
+        print("--scratch_dir can not be used with --executor slurm, jobs on other nodes can not read node-local scratch")
+        sys.exit()
+    if shortcuts.reference_bundle_dir:
+        ReferenceBundle(shortcuts.reference_bundle_dir).check(misc, shortcuts)
 
 
 
@@ -79,7 +116,7 @@ def main():
         if menu_choice == '1':
             misc.log_to_file("info","User input: 1, Setup anaconda3 environment")
             misc.clear_screen()
-            setup.create_anaconda_environment(misc, shortcuts)
+            load_stage("setup").create_anaconda_environment(misc, shortcuts)
 
         # Dna analysis menu
         elif menu_choice == '2':
@@ -104,11 +141,11 @@ def main():
                         # Download reference genome
                         elif reference_genome_menu_choice == '1':
                             misc.log_to_file("info", "User input: 1. Download reference genome\n")
-                            ref_genome.download(misc, shortcuts)
+                            load_stage("reference_genome").download(misc, shortcuts)
                         # Index reference genome
                         elif reference_genome_menu_choice == '2':
                             misc.log_to_file("info", "User input: 2. Index reference genome\n")
-                            dna_analysis.index_genome_dna(misc, shortcuts)
+                            load_stage("dna").index_genome_dna(options, misc, shortcuts)
                             break
 
                 # Create library list file
@@ -124,6 +161,12 @@ def main():
                     misc.log_to_file("info", "User input: 3. Run analysis\n")
                     misc.clear_screen()
                     misc.validate_id(options, shortcuts)
+                    if options.dry_run:
+                        misc.create_directory([shortcuts.executor_dir])
+                        RuntimeHistory(shortcuts.runtime_history_db).dry_run(misc, options.tumor_id, reads_size(shortcuts), int(options.threads), misc.memory_budget(options))
+                        input("Press any key to return to DNA-analysis menu...")
+                        continue
+                    dna_analysis = load_stage("dna")
                     # dna_analysis.alignment(options, misc, shortcuts)
                     if dna_analysis.validate_bam_dna(options, misc, shortcuts):
                         # dna_analysis.sort(options, misc, shortcuts)
@@ -133,6 +176,8 @@ def main():
                         dna_analysis.gatk_haplotype(options, misc, shortcuts)
                         dna_analysis.delly(options, misc, shortcuts)
                         dna_analysis.manta(options, misc, shortcuts)
+                        if not dna_analysis.wait_deep_validation(misc):
+                            sys.exit()
                         elapsed = timeit.default_timer() - start
                         misc.log_to_file("info", f'GDC DNA-Seq analysis pipeline successfully completed in {misc.elapsed_time(elapsed)} - OK!')
                         sys.exit()
@@ -151,16 +196,23 @@ def main():
                 # Index reference genome
                 elif rna_choice == '1':
                     misc.log_to_file("info", "User input: index reference genome\n")
-                    rna_analysis.index_genome_rna(misc, shortcuts)
+                    load_stage("rna").index_genome_rna(misc, shortcuts)
 
                 # Map reads to reference genome
                 elif rna_choice == '2':
                     misc.log_to_file("info", "User input: Map reads to reference genome\n")
+                    rna_analysis = load_stage("rna")
                     rna_analysis.map_reads(options, misc, shortcuts)
                     rna_analysis.ASEReadCounter(options, misc, shortcuts)
                     rna_analysis.add_wgs_data_to_csv(options, misc, shortcuts)
                     sys.exit()
 
+                # Map cohort reads to reference genome
+                elif rna_choice == '3':
+                    misc.log_to_file("info", "User input: Map cohort reads to reference genome (shared memory)\n")
+                    load_stage("rna").map_reads_cohort(options, misc, shortcuts)
+                    input("Press any key to return to RNA-analysis menu...")
+
 
 
 
@@ -1,4 +1,5 @@
 from os import listdir
+from read_discovery import ReadDiscovery
 
 class Menus():
 
@@ -8,7 +9,7 @@ class Menus():
             self.main_menu = (['Setup Anaconda3 environment', 'DNA-analysis', 'RNA-analysis'], "\033[1mMain menu\033[0m\n" + "-"*31 + "\nRun the options below in order:", "(leave blank to exit program)")
             self.reference_genome_menu = (['Download reference genome', 'Index reference genome'], "\033[1mSetup reference genome menu\033[0m\n" + "-"*31 + "\nRun the options below in order:", "(leave blank to return to previous menu)")
             self.dna_menu = (['Setup reference genome', 'Create library list file', 'Run analysis'], "\033[1mDNA-analysis menu\033[0m\n" + "-"*31 + "\nRun the options below in order:", "(leave blank to return to main menu)")
-            self.rna_menu = (['Index reference genome', 'Map reads to reference genome'], "\033[1m""RNA-analysis menu""\033[0m\n" + "-"*31 + "\nRun the options below in order:", "(leave blank to return to main menu)")
+            self.rna_menu = (['Index reference genome', 'Map reads to reference genome', 'Map cohort reads to reference genome (shared memory)'], "\033[1m""RNA-analysis menu""\033[0m\n" + "-"*31 + "\nRun the options below in order:", "(leave blank to return to main menu)")
         except Exception as e:
             misc.log_exception('.__init__() in menus.py:', e)
 
@@ -51,13 +52,21 @@ class Menus():
                 print("Create library list file.\n\n")
                 print("1. Single end sequencing\n")
                 print("2. Paired end sequencing\n")
-                choice = misc.validate_choice(2, "(leave blank to return to DNA-analysis menu)")
+                print("3. Automatic discovery (pairs reads and sets read groups per flowcell lane)\n")
+                choice = misc.validate_choice(3, "(leave blank to return to DNA-analysis menu)")
                 if choice == "":
                     misc.log_to_file("info", "User input: return to DNA-analysis menu")
                     return ""
                 elif misc.confirm_choice():
                     misc.log_to_file("info", f'User input: confirmed choice: {choice}')
                     misc.clear_screen()
+                    if choice == '3': # Lane-aware discovery from the FASTQ headers
+                        read_discovery = ReadDiscovery()
+                        read_discovery.write_library_file(options, misc, shortcuts, read_discovery.discover(options, misc, shortcuts))
+                        misc.log_to_file("info", f"Library list file and {shortcuts.dna_reads_manifest} created!")
+                        print("Now that you have created your list library file, you can run the analysis!\n")
+                        input("Press any key to return to DNA-analysis menu...")
+                        return
                     files = sorted(listdir(shortcuts.dna_reads_dir))
                     with open(f"{shortcuts.dna_seq_dir}{options.tumor_id}_library.txt", 'w') as out_file:
                         for line, library_id in enumerate(files, start=1):
@@ -1,26 +1,110 @@
-from os import path, getenv, listdir, makedirs, sys, remove, kill, getppid
+from os import path, getenv, getpid, listdir, makedirs, sys, remove, kill, getppid, sysconf, stat as os_stat
 import signal
+import hashlib
 import subprocess
 import logging
+import logging.handlers
+import multiprocessing as mp
 import timeit
 import time
 import shlex
 import re
-logging.basicConfig(filename = getenv("HOME")+'/BASE/Logfile.txt',
-                    format = '%(levelname)s     %(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
-                    level = logging.DEBUG,
-                    filemode = 'a')
-
-try:
-    from Bio import SeqIO
-except:
-    pass
+from progress import ProgressMeter
+
+# Fields added to every log record, set with Misc.set_log_context(). Pool workers inherit them when they are forked
+log_context = {"run_id": "-", "sample": "-", "stage": "-", "shard": "-"}
+log_format = '%(levelname)s     %(asctime)s - [%(run_id)s %(sample)s %(stage)s %(shard)s] %(message)s'
+log_listener = {"queue": None, "process": None, "pid": None}
+
+
+class LogContextFilter(logging.Filter):
+    '''Adds the current log context (run id, sample, stage and shard) to the log records'''
+
+    def filter(self, record):
+        for key, value in log_context.items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class StageFileHandler(logging.Handler):
+    '''Writes every record to the log file of its stage: {log_dir}{stage}.log'''
+
+    def __init__(self, log_dir):
+        super().__init__()
+        self.log_dir = log_dir
+        self.handlers = {}
+
+    def emit(self, record):
+        if record.stage not in self.handlers:
+            handler = logging.FileHandler(f"{self.log_dir}{record.stage.replace('/', '_')}.log")
+            handler.setFormatter(self.formatter)
+            self.handlers[record.stage] = handler
+        self.handlers[record.stage].emit(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+def listen_for_logs(queue, logfile, log_dir):
+    '''Runs in the log listener process: the only process that writes to the log files and the terminal'''
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is handled by the main process, which then stops the listener
+    makedirs(log_dir, exist_ok=True)
+    formatter = logging.Formatter(log_format, datefmt='%Y-%m-%d %H:%M:%S')
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(' %(levelname)s: %(message)s'))
+    handlers = [logging.FileHandler(logfile), StageFileHandler(log_dir), console]
+    for handler in handlers[:2]:
+        handler.setFormatter(formatter)
+    while True:
+        record = queue.get()
+        if record is None:
+            break
+        for handler in handlers:
+            handler.handle(record)
+    for handler in handlers:
+        handler.close()
 
 class Misc():
     '''This class contains miscellaneous functions related to general functionality'''
 
     def __init__(self):
-        pass
+        # Status file the progress of running tools is written to, set by start_logging()
+        self.status_file = None
+        # Memory (GB) of the budget held by work running in the background (Picard deep validation), the stages get the rest
+        self.reserved_memory = 0
+
+    #---------------------------------------------------------------------------
+    def checksum_file(self, file):
+        '''This function returns the sha256 checksum of a file. The checksum is cached in a {file}.sha256 sidecar together with the size and
+        modification time of the file, so that large files (e.g. the reference genome) only have to be read again if they have changed'''
+
+        try:
+            stat = os_stat(file)
+            fingerprint = f"{stat.st_size} {stat.st_mtime_ns}"
+            sidecar = f"{file}.sha256"
+            if path.isfile(sidecar):
+                with open(sidecar, 'r') as f:
+                    cached_fingerprint, _, digest = f.read().strip().rpartition(' ')
+                if cached_fingerprint == fingerprint:
+                    return digest
+            sha256 = hashlib.sha256()
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha256.update(block)
+            digest = sha256.hexdigest()
+            try:
+                with open(sidecar, 'w') as f:
+                    f.write(f"{fingerprint} {digest}\n")
+            except OSError:
+                pass # read-only location, the checksum is just not cached
+            return digest
+        except Exception as e:
+            self.log_exception(".checksum_file() in miscellaneous.py:", e)
+            sys.exit()
 
     #---------------------------------------------------------------------------
     def choose_chromosomes_to_index(self, menus, shortcuts):
@@ -114,6 +198,7 @@ class Misc():
                 start = timeit.default_timer()
                 self.log_to_file("INFO", f'Starting: creating a new fasta file for {filename}...')
                 self.create_directory([f'{ref_dir}{filename}'])
+                from Bio import SeqIO
                 sequences = SeqIO.parse(ref_file, 'fasta')
                 with open(f'{ref_dir}{filename}/{filename}.fa', 'w+') as fa:
                     for chr in chromosomes:
@@ -138,6 +223,7 @@ class Misc():
             if not self.step_allready_completed(f'{ref_dir}{filename}/{filename}.gtf', f'Creating Gtf for {filename}'):
                 start = timeit.default_timer()
                 self.log_to_file("INFO", f'Starting: creating a new gtf file for {filename}...')
+                from Bio import SeqIO
                 sequences = SeqIO.parse(shortcuts.reference_genome_file, 'fasta')
                 with open(f'{ref_dir}{filename}/{filename}.bed', 'w') as bed:
                     for chr in chromosomes:
@@ -208,18 +294,27 @@ class Misc():
 
     #---------------------------------------------------------------------------
     def log_to_file(self, level, text):
+        '''This function logs text with level (case insensitive, e.g. "INFO" or "info"). When logging is started the record is
+        put on the log queue and written by the log listener, otherwise it is only printed'''
         try:
-            print(f" {level}: {text}")
-            if level == "DEBUG": logging.debug(f"{text}")
-            elif level == "INFO": logging.info(f"{text}")
-            elif level == "WARNING": logging.warning(f"{text}")
-            elif level == "ERROR": logging.error(f"{text}")
-            elif level == "CRITICAL": logging.critical(f"{text}")
+            if not log_listener["queue"]:
+                print(f" {level.upper()}: {text}")
+                return
+            logging.log(getattr(logging, level.upper(), logging.INFO), f"{text}")
 
         except Exception as e:
             logging.error(f'Error with {self}.log_to_file() in miscellaneous.py: {e}. Exiting program...')
             sys.exit()
 
+    #---------------------------------------------------------------------------
+    def memory_budget(self, options):
+        '''Returns the memory in GB the pipeline may use: --memory if given, else 80 % of the physical memory, less the memory
+        reserved for background work'''
+
+        if getattr(options, "memory", None):
+            return max(1, int(options.memory) - self.reserved_memory)
+        return max(1, int(0.8 * sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') / 1024**3) - self.reserved_memory)
+
     #---------------------------------------------------------------------------
     def remove_file(self, file):
         '''This function removes incomplete files if the processing of file ended with returncode != 0'''
@@ -240,27 +335,27 @@ class Misc():
 
        
 
+        process = None
         try:
             
             if  cmd == "bwa-mem2":
                 # run_command() uses bwa-mem2 options
                 self.log_to_file("DEBUG", "# run_command() uses bwa-mem2 options")
-                text = input.split('-o')[1].split('/')[7]
-                file = trackfile = f"{input.split('-o ')[1]}.complete"
+                text = path.basename(input.rsplit(' -o ', 1)[1].split()[0])
+                file = trackfile = f"{input.rsplit(' -o ', 1)[1].split()[0]}.complete"
                 self.log_to_file("DEBUG", f"run_command(cmd: {input}, text: {text}, file: {file}")
-                process = subprocess.Popen(input, executable='/bin/bash', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
                 
             elif cmd == "ValidateSamFile":
                 # run_command() uses ValidateSamFile options
                 self.log_to_file("DEBUG", "# run_command() uses ValidateSamFile options")
-                text = input.split('-I')[1].split(' ')[1].split('/')[7]
+                text = path.basename(input.split('-I')[1].split(' ')[1])
                 file = trackfile = f"{input.split('-I')[1].split(' ')[1][:-3]}validated"
                 self.log_to_file("DEBUG", f"run_command(cmd: {input}, text: {text}, file: {file}")
 
             elif cmd == "realing index":   
                  # run_command() uses realign index options
                 self.log_to_file("DEBUG", "# run_command() uses realign index options")
-                text = f"Indexing {input.split(' ')[2].split('/')[7]}"
+                text = f"Indexing {path.basename(input.split(' ')[2])}"
                 file = trackfile = f"{input.split(' ')[2]}.bai.complete"
                 self.log_to_file("DEBUG", f"run_command(cmd: {input}, text: {text}, file: {file}")
             
@@ -268,10 +363,11 @@ class Misc():
             elif cmd == "realign LeftAlignIndels":   
                 # run_command() uses realign options
                 self.log_to_file("DEBUG", "# run_command() uses realign LeftAlignIndels options")
-                text = f"Realigning {input.split('-O ')[1].split('/')[7]}"
+                text = f"Realigning {path.basename(input.split('-O ')[1])}"
                 file = trackfile = f"{input.split('-O ')[1]}.complete"
                 self.log_to_file("DEBUG", f"run_command(cmd: {input}, text: {text}, file: {file}")
                
+            self.set_log_context(shard=text or "-")
 
             if file:
                 if self.step_allready_completed(file, text):
@@ -280,34 +376,70 @@ class Misc():
 
             # invoke process if not allready invoked
             if not process:
-                process = subprocess.Popen(input, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            
-            # print stdout during execution
-            while process.poll() is not None:
-                output = process.stdout.readline()
-                
-                if output:
-                    latest = output
-                    print("stdout:", output.strip())
-                    
-            rc = process.poll()
-            
+                process = subprocess.Popen(input, executable='/bin/bash', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+            # print stdout during execution and follow the progress lines of the tool, STAR writes them to Log.progress.out
+            meter = ProgressMeter(self, self.status_file, f"{log_context['stage']}/{text or cmd}", log_context['stage'])
+            star_prefix = re.search(r'--outFileNamePrefix\s+(\S+)', input) if cmd.startswith("STAR") else None
+            if star_prefix:
+                meter.follow_in_background(f"{star_prefix.group(1)}Log.progress.out", process)
+            # Reports also while the tool prints nothing, so a stalled tool is marked stalled
+            meter.report_in_background(process)
+            latest = ""
+            for output in process.stdout:
+                latest = output
+                self.log_to_file("DEBUG", output.strip())
+                meter.update(output)
+
+            rc = process.wait()
+            meter.finish(rc == 0)
+
             if rc == 0:
-                
+
                 if text: self.log_to_file("INFO", f"{text} succesfully completed")
-                
+
                 if trackfile: self.create_trackFile(trackfile)
                 return True
-           
+
             else:
                 print("Raise exception")
-                raise Exception(f"{output.strip()}")
+                raise Exception(f"{latest.strip()}")
 
         except Exception as e:
-            print(f"Something went wrong: {e} in misc.run_command()")
+            self.log_to_file("ERROR", f"Something went wrong: {e} in misc.run_command()")
             logging.exception(f'Process ended with returncode != 0: {text}')
             sys.exit()
 
+    #---------------------------------------------------------------------------
+    def set_log_context(self, **context):
+        '''This function sets fields (run_id, sample, stage, shard) that are added to every following log record'''
+
+        log_context.update({key: str(value) for key, value in context.items()})
+
+    #---------------------------------------------------------------------------
+    def start_logging(self, options, shortcuts):
+        '''This function starts the log listener process and sends the log records of this process and every process forked from it
+        to the listener through a queue. The listener writes Logfile.txt, one log file per stage in logs/{run_id}/ and the terminal'''
+
+        try:
+            run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{getpid()}"
+            self.set_log_context(run_id=run_id, sample=options.tumor_id)
+            queue = mp.Queue(-1)
+            process = mp.Process(target=listen_for_logs, args=(queue, f"{shortcuts.BASE_dir}Logfile.txt", f"{shortcuts.BASE_dir}logs/{run_id}/"), daemon=True)
+            process.start()
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            handler = logging.handlers.QueueHandler(queue)
+            handler.addFilter(LogContextFilter())
+            root.addHandler(handler)
+            root.setLevel(logging.DEBUG)
+            log_listener.update(queue=queue, process=process, pid=getpid())
+            self.status_file = shortcuts.progress_status_file
+        except Exception as e:
+            print(f"Error with .start_logging() in miscellaneous.py: {e}. Exiting program...")
+            sys.exit()
+
     #---------------------------------------------------------------------------
     def step_allready_completed(self, file, text):
         '''This function checks if a step is allready completed by checking if "file" allready exists.
@@ -327,6 +459,15 @@ class Misc():
             self.log_exception(".step_allready_completed() in miscellaneous.py:", e)
             sys.exit()
 
+    #---------------------------------------------------------------------------
+    def stop_logging(self):
+        '''This function lets the log listener write the remaining records and stops it'''
+
+        if log_listener["queue"] and log_listener["pid"] == getpid():
+            log_listener["queue"].put(None)
+            log_listener["process"].join(timeout=10)
+            log_listener.update(queue=None, process=None, pid=None)
+
     #---------------------------------------------------------------------------
     def validate_choice(self, choices, text):
         '''This function checks if the input choice is valid'''
@@ -0,0 +1,193 @@
+from os import makedirs, path, replace
+import fcntl
+import json
+import re
+import threading
+import time
+
+
+class ProgressMeter():
+    '''This class turns the progress lines of a running tool into processed items, items per second and an ETA, and writes them
+    to a status file (JSON, one entry per stage shard) that can be polled while the pipeline runs. Known progress lines:
+    bwa-mem2 processed reads, GATK ProgressMeter, Picard "Processed/Read N records" and STAR Log.progress.out.
+    The ETA comes from the total when it is known, else from the runtime predicted by the runtime history'''
+
+    # (tool, regular expression, True if the count is cumulative, False if it is added)
+    patterns = [
+        ("bwa-mem2", re.compile(r'Processed (\d+) reads in'), False),
+        ("gatk", re.compile(r'ProgressMeter -\s+(?!Current)\S+\s+[\d.]+\s+(\d+)\s+[\d.]+'), True),
+        ("picard", re.compile(r'(?:Processed|Read)\s+([\d,]+)\s+records'), True),
+        ("STAR", re.compile(r'^\w{3}\s+\d+\s+[\d:]+\s+[\d.]+\s+(\d+)\s'), True),
+        ]
+    units = {"bwa-mem2": "reads", "gatk": "records", "picard": "records", "STAR": "reads"}
+    gatk_unit = re.compile(r'ProgressMeter -\s+Current Locus\s+Elapsed Minutes\s+(\w+) Processed')
+
+    def __init__(self, misc, status_file, name, stage, total=None, predicted=None):
+        self.misc = misc
+        self.status_file = status_file
+        self.name = name
+        self.stage = stage
+        self.total = total
+        self.predicted = predicted
+        self.tool = None
+        self.unit = "items"
+        self.processed = 0
+        self.started = time.time()
+        self.changed = self.started
+        self.samples = [(self.started, 0)]
+        self.state = "running"
+        self.written = 0
+        self.logged = self.started
+        self.offset = 0
+        # Seconds between status file writes and between progress lines in the log, and without progress before a shard is stalled
+        self.write_interval = 5
+        self.log_interval = 300
+        self.stall_seconds = 900
+        self.rate_window = 300
+        # The output of the tool and the background threads (STAR log follower, timer) change the meter at the same time
+        self.lock = threading.RLock()
+
+    #---------------------------------------------------------------------------
+    def update(self, line):
+        '''Parses one line of tool output. Returns True if it was a progress line'''
+
+        with self.lock:
+            unit = self.gatk_unit.search(line)
+            if unit:
+                # GATK names what it counts (regions, reads, variants) in the header of its progress table
+                self.units = dict(self.units, gatk=unit.group(1).lower())
+                if self.tool == "gatk":
+                    self.unit = self.units["gatk"]
+            for tool, pattern, cumulative in self.patterns:
+                match = pattern.search(line)
+                if match:
+                    count = int(match.group(1).replace(',', ''))
+                    if self.tool != tool:
+                        self.tool, self.unit = tool, self.units[tool]
+                    self.progress(count if cumulative else self.processed + count)
+                    return True
+            return False
+
+    #---------------------------------------------------------------------------
+    def progress(self, processed):
+        '''Records the number of processed items'''
+
+        with self.lock:
+            now = time.time()
+            if processed != self.processed:
+                self.changed = now
+                if self.state == "stalled":
+                    self.misc.log_to_file("INFO", f"{self.name} makes progress again")
+                    self.state = "running"
+            self.processed = processed
+            self.samples = [sample for sample in self.samples if now - sample[0] <= self.rate_window][-100:] + [(now, processed)]
+            self.report()
+
+    #---------------------------------------------------------------------------
+    def follow(self, log_file):
+        '''Parses the lines added to a log file since the last call (the log of an executor job or STAR Log.progress.out)'''
+
+        if not path.isfile(log_file):
+            return
+        with self.lock, open(log_file, 'r', errors='replace') as log:
+            log.seek(self.offset)
+            for line in log.readlines():
+                self.update(line)
+            self.offset = log.tell()
+            self.report()
+
+    #---------------------------------------------------------------------------
+    def follow_in_background(self, log_file, process, interval=30):
+        '''Follows a log file every interval seconds in a thread until process has ended'''
+
+        def follow():
+            while process.poll() is None:
+                self.follow(log_file)
+                time.sleep(interval)
+        threading.Thread(target=follow, daemon=True).start()
+
+    #---------------------------------------------------------------------------
+    def report_in_background(self, process):
+        '''Reports every write_interval seconds in a thread until process has ended, so a tool that stops printing is still
+        marked stalled and its status entry stays up to date'''
+
+        def report():
+            while process.poll() is None:
+                time.sleep(self.write_interval)
+                self.report()
+        threading.Thread(target=report, daemon=True).start()
+
+    #---------------------------------------------------------------------------
+    def rate(self):
+        '''Returns items per second over the last rate_window seconds, or since the start'''
+
+        (first_time, first), (last_time, last) = self.samples[0], self.samples[-1]
+        if last_time - first_time < 1:
+            first_time, first = self.started, 0
+        return (last - first) / max(1, last_time - first_time)
+
+    #---------------------------------------------------------------------------
+    def eta(self):
+        '''Returns the estimated seconds left, or None if it can not be estimated'''
+
+        rate = self.rate()
+        if self.total and rate > 0:
+            return max(0, (self.total - self.processed) / rate)
+        if self.predicted:
+            return max(0, self.predicted - (time.time() - self.started))
+        return None
+
+    #---------------------------------------------------------------------------
+    def report(self):
+        '''Marks the shard stalled when it has made no progress for stall_seconds, writes the status file every write_interval
+        seconds and logs a progress line every log_interval seconds'''
+
+        with self.lock:
+            now = time.time()
+            if self.state == "running" and self.tool and now - self.changed > self.stall_seconds:
+                self.state = "stalled"
+                self.misc.log_to_file("WARNING", f"{self.name} has made no progress for {self.misc.elapsed_time(now - self.changed)} ({self.processed:,} {self.unit})")
+            if now - self.logged >= self.log_interval and self.tool:
+                self.logged = now
+                eta = self.eta()
+                self.misc.log_to_file("INFO", f"{self.name}: {self.processed:,} {self.unit}, {self.rate():,.0f} {self.unit}/s, ETA {self.misc.elapsed_time(eta) if eta is not None else 'unknown'}")
+            if now - self.written >= self.write_interval:
+                self.write()
+
+    #---------------------------------------------------------------------------
+    def finish(self, succeeded):
+        '''Marks the shard done or failed in the status file'''
+
+        with self.lock:
+            self.state = "done" if succeeded else "failed"
+            self.write()
+
+    #---------------------------------------------------------------------------
+    def status(self):
+        '''Returns the status file entry of the shard'''
+
+        eta = self.eta() if self.state in ("running", "stalled") else 0
+        return {"stage": self.stage, "tool": self.tool, "unit": self.unit, "processed": self.processed, "total": self.total,
+                "per_second": round(self.rate(), 1), "elapsed_seconds": round(time.time() - self.started), "eta_seconds": round(eta) if eta is not None else None,
+                "state": self.state, "last_progress": self.changed, "updated": time.time()}
+
+    #---------------------------------------------------------------------------
+    def write(self):
+        '''Writes the entry of the shard to the status file. Several processes share the file, so it is locked while it is updated
+        and replaced in one step'''
+
+        self.written = time.time()
+        if not self.status_file:
+            return
+        makedirs(path.dirname(self.status_file), exist_ok=True)
+        with open(f"{self.status_file}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.status_file, 'r') as f:
+                    status = json.load(f)
+            except (OSError, ValueError):
+                status = {}
+            status[self.name] = self.status()
+            with open(f"{self.status_file}.partial", 'w') as f:
+                json.dump(status, f, indent=2, sort_keys=True)
+            replace(f"{self.status_file}.partial", self.status_file)
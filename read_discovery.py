@@ -0,0 +1,130 @@
+from os import listdir, replace, stat, sys
+import gzip
+import hashlib
+import json
+import re
+
+
+class ReadDiscovery():
+    '''This class scans the DNA reads folder, pairs read 1 and read 2 files by name and derives lane-aware read groups from the
+    FASTQ headers. The result is cached in a checksummed manifest, so unchanged files are not read again on reruns'''
+
+    def __init__(self):
+        # <prefix>_R1_001.fastq.gz, <prefix>_1.fq.gz, <prefix>.R2.fastq ...
+        self.mate_pattern = re.compile(r'^(?P<prefix>.+?)[._]R?(?P<mate>[12])(?P<suffix>(_\d{3})?\.(fastq|fq)(\.gz)?)$')
+        self.fastq_pattern = re.compile(r'\.(fastq|fq)(\.gz)?$')
+        self.lane_pattern = re.compile(r'_L(\d{3})[._]')
+
+    #---------------------------------------------------------------------------
+    def read_header(self, file):
+        '''This function returns instrument, flowcell, lane and barcode from the header of the first record in a FASTQ file.
+        Casava 1.8+ headers: @instrument:run:flowcell:lane:tile:x:y read:filtered:control:barcode
+        Older headers:       @instrument:lane:tile:x:y#barcode/read'''
+
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt') as fastq:
+            header = fastq.readline().strip()
+        name, _, comment = header[1:].partition(' ')
+        fields = name.split(':')
+        if len(fields) >= 7:
+            return {"instrument": fields[0], "flowcell": fields[2], "lane": fields[3], "barcode": comment.split(':')[-1] if comment.count(':') >= 3 else ""}
+        if len(fields) >= 5:
+            barcode = name.partition('#')[2].partition('/')[0]
+            return {"instrument": fields[0], "flowcell": "", "lane": fields[1], "barcode": barcode}
+        return {"instrument": "", "flowcell": "", "lane": "", "barcode": ""}
+
+    #---------------------------------------------------------------------------
+    def load_manifest(self, misc, manifest_file):
+        '''This function returns the cached manifest if its checksum is valid, else an empty manifest'''
+
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get("checksum") == self.manifest_checksum(manifest):
+                return manifest
+            misc.log_to_file("WARNING", f"Checksum of {manifest_file} does not match, rescanning all reads")
+        except (OSError, ValueError):
+            pass
+        return {"files": {}, "units": []}
+
+    #---------------------------------------------------------------------------
+    def manifest_checksum(self, manifest):
+        '''Returns the sha256 checksum of the content of a manifest'''
+
+        return hashlib.sha256(json.dumps({"files": manifest["files"], "units": manifest["units"]}, sort_keys=True).encode()).hexdigest()
+
+    #---------------------------------------------------------------------------
+    def discover(self, options, misc, shortcuts):
+        '''This function pairs the FASTQ files in dna_reads_dir and returns the alignment units (one per flowcell lane and library)
+        with their read groups. Files whose size and modification time are unchanged since the last scan are not read again'''
+
+        try:
+            cached = self.load_manifest(misc, shortcuts.dna_reads_manifest)
+            files = {}
+            for file in sorted(listdir(shortcuts.dna_reads_dir)):
+                if not self.fastq_pattern.search(file):
+                    continue
+                file_stat = stat(f"{shortcuts.dna_reads_dir}{file}")
+                fingerprint = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+                entry = cached["files"].get(file)
+                if not entry or {key: entry[key] for key in fingerprint} != fingerprint:
+                    misc.log_to_file("DEBUG", f"Reading FASTQ header of {file}")
+                    entry = dict(fingerprint, **self.read_header(f"{shortcuts.dna_reads_dir}{file}"))
+                files[file] = entry
+
+            # Pair read 1 and read 2 by name, files without a mate are single-end
+            pairs = {}
+            for file in files:
+                match = self.mate_pattern.match(file)
+                key = (match.group('prefix'), match.group('suffix')) if match else (file, "")
+                pairs.setdefault(key, {})[match.group('mate') if match else '1'] = file
+
+            units = []
+            for (prefix, _), mates in sorted(pairs.items()):
+                read1, read2 = mates.get('1'), mates.get('2', 'N/A')
+                if not read1:
+                    misc.log_to_file("WARNING", f"{read2} has no read 1 file, skipping")
+                    continue
+                if options.tumor_id in read1:
+                    clinical_id = options.tumor_id
+                elif options.normal_id in read1:
+                    clinical_id = options.normal_id
+                else:
+                    misc.log_to_file("WARNING", f"{read1} does not contain tumor id {options.tumor_id} or normal id {options.normal_id}, skipping")
+                    continue
+                header = files[read1]
+                if read2 != 'N/A' and (files[read2]["flowcell"], files[read2]["lane"]) != (header["flowcell"], header["lane"]):
+                    misc.log_to_file("ERROR", f"{read1} and {read2} come from different flowcell lanes")
+                    sys.exit()
+                filename_lane = self.lane_pattern.search(read1)
+                lane = header["lane"] or (str(int(filename_lane.group(1))) if filename_lane else "1")
+                flowcell = header["flowcell"] or header["instrument"] or "unknown"
+                library = prefix.split('_')[0]
+                unit = f"{library}_{flowcell}_L{lane}" if clinical_id in library else f"{clinical_id}_{library}_{flowcell}_L{lane}"
+                if unit in [existing["unit"] for existing in units]: # the same lane split over several files
+                    unit = f"{unit}_{sum(existing['unit'].startswith(unit) for existing in units) + 1}"
+                units.append({
+                    "unit": unit, "clinical_id": clinical_id, "library": library, "read1": read1, "read2": read2, "flowcell": flowcell, "lane": lane,
+                    "read_group": f"@RG\\tID:{unit}\\tSM:{clinical_id}\\tLB:{library}\\tPL:ILLUMINA\\tPU:{flowcell}.{lane}{'.' + header['barcode'] if header['barcode'] else ''}",
+                    })
+
+            manifest = {"files": files, "units": units}
+            manifest["checksum"] = self.manifest_checksum(manifest)
+            with open(f"{shortcuts.dna_reads_manifest}.partial", 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            replace(f"{shortcuts.dna_reads_manifest}.partial", shortcuts.dna_reads_manifest)
+            misc.log_to_file("INFO", f"Found {len(units)} alignment units (flowcell lanes) in {len(files)} FASTQ files - OK!")
+            return units
+        except Exception as e:
+            misc.log_exception(".discover() in read_discovery.py:", e)
+
+    #---------------------------------------------------------------------------
+    def write_library_file(self, options, misc, shortcuts, units):
+        '''This function writes the units to the library list file used by the dna analysis (clinical_id library_id read1 read2)'''
+
+        try:
+            with open(f"{shortcuts.dna_seq_dir}{options.tumor_id}_library.txt", 'w') as out_file:
+                for unit in units:
+                    out_file.write(f"{unit['clinical_id']} {unit['unit']} {unit['read1']} {unit['read2']}\n")
+        except Exception as e:
+            misc.log_exception(".write_library_file() in read_discovery.py:", e)
@@ -0,0 +1,126 @@
+from os import chmod, getpid, makedirs, path, remove, rename, replace, stat, symlink, sys, walk
+import fcntl
+import hashlib
+import json
+import time
+
+
+class ReferenceBundle():
+    '''This class publishes the indexed reference genome (fasta, bwa-mem2 index, .dict, .fai and chunks) as an immutable, versioned
+    bundle in a shared folder (--reference_bundle) that many users and runs can read. Every version is a folder named after the
+    fasta and a checksum of the fasta and the index commands, with a manifest.json holding the size and sha256 of every file.
+    A version is built in {version}.partial/, made read-only and renamed in one step, then the current link is moved to it.
+    Runs use the version current points to when they start, its files are checked against the manifest before use'''
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, root):
+        self.root = f"{root.rstrip('/')}/"
+        self.current_link = f"{self.root}current"
+
+    #---------------------------------------------------------------------------
+    def version(self, misc, fasta, commands):
+        '''Returns the version name of a bundle built from fasta with commands. A new fasta or other index parameters give a new version'''
+
+        key = hashlib.sha256(misc.checksum_file(fasta).encode())
+        for command in commands:
+            key.update(command.encode())
+        return f"{path.splitext(path.basename(fasta))[0]}-{key.hexdigest()[:12]}"
+
+    #---------------------------------------------------------------------------
+    def lock(self, version):
+        '''Returns an open lock file of a version, locked so only one user builds it at a time'''
+
+        makedirs(self.root, exist_ok=True)
+        lock = open(f"{self.root}{version}.lock", 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    #---------------------------------------------------------------------------
+    def sha256(self, file):
+        '''Returns the sha256 checksum of a file'''
+
+        sha256 = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    #---------------------------------------------------------------------------
+    def publish(self, misc, build_dir, version):
+        '''Writes the manifest of a built version, makes it read-only, renames it to its version folder and points current to it'''
+
+        files = {}
+        for directory, folders, names in walk(build_dir):
+            for name in sorted(names):
+                file = path.join(directory, name)
+                relative = path.relpath(file, build_dir)
+                if relative != self.manifest_name and not name.endswith(".complete"):
+                    files[relative] = {"size": stat(file).st_size, "sha256": self.sha256(file)}
+        with open(f"{build_dir}{self.manifest_name}", 'w') as manifest:
+            json.dump({"version": version, "created": time.strftime('%Y-%m-%d %H:%M:%S'), "files": files}, manifest, indent=2, sort_keys=True)
+
+        # Trackfiles of the build jobs are not part of the bundle
+        for directory, folders, names in walk(build_dir):
+            for name in names:
+                if name.endswith(".complete"):
+                    remove(path.join(directory, name))
+        for directory, folders, names in walk(build_dir, topdown=False):
+            for name in names:
+                chmod(path.join(directory, name), 0o444)
+            chmod(directory, 0o555)
+        rename(build_dir, f"{self.root}{version}")
+
+        link = f"{self.current_link}.{getpid()}"
+        symlink(version, link)
+        replace(link, self.current_link)
+        misc.log_to_file("INFO", f"Reference bundle {version} published in {self.root} ({len(files)} files)")
+
+    #---------------------------------------------------------------------------
+    def verify(self, directory, checksums=False):
+        '''Returns the errors found when the files of a version are compared with its manifest, sizes only or also sha256 checksums'''
+
+        try:
+            with open(f"{directory}{self.manifest_name}", 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            return [f"Can not read the manifest of {directory}: {e}"]
+        errors = []
+        for relative, expected in sorted(manifest["files"].items()):
+            file = f"{directory}{relative}"
+            if not path.isfile(file):
+                errors.append(f"{relative} is missing")
+            elif stat(file).st_size != expected["size"]:
+                errors.append(f"{relative} has size {stat(file).st_size}, the manifest says {expected['size']}")
+            elif checksums and self.sha256(file) != expected["sha256"]:
+                errors.append(f"{relative} does not match its sha256 checksum in the manifest")
+        return errors
+
+    #---------------------------------------------------------------------------
+    def check(self, misc, shortcuts):
+        '''Checks the version this run uses before it starts. Sizes are compared every run, the checksums the first time this
+        account uses the version (recorded in reference_genome/bundle_verified/). Exits if the bundle does not match its manifest'''
+
+        try:
+            directory = shortcuts.reference_index_dir
+            if not path.isdir(directory):
+                misc.log_to_file("WARNING", f"No reference bundle is published in {self.root} yet, build it with Setup reference genome > Index reference genome")
+                return
+            version = path.basename(directory.rstrip('/'))
+            verified = f"{shortcuts.reference_genome_dir}bundle_verified/{version}"
+            checksums = not path.isfile(verified)
+            if checksums:
+                misc.log_to_file("INFO", f"Verifying the checksums of reference bundle {version}, this is done once per version...")
+            errors = self.verify(directory, checksums)
+            for error in errors:
+                misc.log_to_file("ERROR", f"Reference bundle {version}: {error}")
+            if errors:
+                misc.log_to_file("ERROR", f"Reference bundle {version} does not match its manifest. Exiting program...")
+                sys.exit()
+            if checksums:
+                makedirs(path.dirname(verified), exist_ok=True)
+                open(verified, 'w').close()
+            misc.log_to_file("INFO", f"Using reference bundle {version}")
+        except Exception as e:
+            misc.log_exception(".check() in reference_bundle.py:", e)
+            sys.exit()
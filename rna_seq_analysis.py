@@ -1,69 +1,141 @@
-from os import listdir, getenv, sys, path
+from os import listdir, getenv, sys, path, remove, rename
+from shutil import rmtree
+from functools import partial
+from itertools import groupby
+import argparse
 import subprocess
+import hashlib
+import fcntl
 import multiprocessing
 import time
 import timeit
-from miscellaneous import Misc
-try:
-    import vcfpy
-    import numpy as np
-    import pandas as pd
-    from Bio import SeqIO
-    from scipy.stats import binom_test
-except Exception as e:
-    Misc().log_to_file("info", f"importing in rna_seq_analysis.py: {e}")
+from shortcuts import Shortcuts
+from filter.ase_schema import ase_schema
+# vcfpy, pandas and scipy are imported in the functions that use them, so they are only loaded when the ASE table is created
 
 
 class RnaSeqAnalysis():
 
     def __init__(self):
-        pass
+        # Parameters that change the content of the STAR index, they are part of the index cache key
+        self.star_genome_generate_parameters = "--runMode genomeGenerate --sjdbOverhang 100"
+        # Private memory of one STAR process mapping against a genome in shared memory (unsorted BAM output)
+        self.star_process_memory = 4 * 1024**3
+        # Column types of the ASE table, in memory and in every writer (shared with the filter scripts)
+        self.ase_schema = ase_schema
+        self.vcf_columns = ["contig", "position", "DNA_refCount", "DNA_altCount", "DNA_totalCount", "geneName", "variantType"]
+        self.variants_to_exclude = ['downstream_gene_variant', 'intergenic_region', 'intragenic_variant', 'intron_variant', 'splice_region_variant', 'splice_region_variant&intron_variant', 'upstream_gene_variant']
+        # Rows read from the ASE csv files at a time with --ase_streaming
+        self.ase_chunk_rows = 200000
 
     #---------------------------------------------------------------------------
-    def index_genome_rna(self, misc, shortcuts):
-        '''This function indexes either the whole genome or the chromosomes entered'''
+    def star_index_key(self, misc, shortcuts):
+        '''This function returns the key of the shared STAR index cache. The key is a hash of the reference fasta, the gtf annotation,
+        the STAR version and the genomeGenerate parameters, so every sample that uses the same reference shares one index'''
 
         try:
-            ref_dir = shortcuts.reference_genome_dir
-            if not misc.step_allready_completed(f"{shortcuts.star_index_dir}starIndex.complete", "Indexing genome with STAR genomeGenerate"):
-                start = timeit.default_timer()
-                threads = multiprocessing.cpu_count() -2
-                misc.log_to_file("info", f"Starting: indexing genome with STAR using {threads} out of {threads + 2} available threads")
-                cmd_StarIndex = f'''
-                STAR --runThreadN {threads} \\
-                --runMode genomeGenerate \\
-                --genomeDir {shortcuts.star_index_dir} \\
-                --genomeFastaFiles {shortcuts.reference_genome_file} \\
-                --sjdbGTFfile {shortcuts.annotation_gtf_file}'''
-                if misc.run_command(cmd_StarIndex, None, None, f"{shortcuts.star_index_dir}starIndex.complete"):
-                    elapsed = timeit.default_timer() - start
-                    misc.log_to_file("info", f'Indexing whole genome with STAR succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
-                    input('press any key to exit')
-                    sys.exit()
-
+            star_version = subprocess.run("STAR --version", shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+            key = hashlib.sha256()
+            key.update(misc.checksum_file(shortcuts.reference_genome_file).encode())
+            key.update(misc.checksum_file(shortcuts.annotation_gtf_file).encode())
+            key.update(star_version.encode())
+            key.update(self.star_genome_generate_parameters.encode())
+            return key.hexdigest()[:16]
         except Exception as e:
-            misc.log_exception(".index_genome_rna in rna_seq_analysis.py:", e)
+            misc.log_exception(".star_index_key() in rna_seq_analysis.py:", e)
 
     #---------------------------------------------------------------------------
-    def map_reads(self, options, misc, shortcuts):
-        '''This function map reads to the reference genome'''
+    def star_index(self, misc, shortcuts):
+        '''This function returns the path to the cached STAR index that matches the reference genome and annotation'''
 
+        return f"{shortcuts.star_index_cache_dir}{self.star_index_key(misc, shortcuts)}/"
 
+    #---------------------------------------------------------------------------
+    def build_star_index(self, misc, shortcuts, key, extra_parameters):
+        '''This function builds the STAR index for a cache key unless it allready exists and returns the index directory.
+        The build runs under a lock file so concurrent samples wait for it instead of starting their own, and into a partial
+        directory that is renamed when STAR is done, so an interrupted build is never reused'''
 
         try:
-            if not misc.step_allready_completed(f"{shortcuts.star_output_dir}map.complete", f'Map reads to {options.tumor_id}'):
-                reads = []
-                for read in listdir(shortcuts.rna_reads_dir):
-                    if options.tumor_id in read:
-                        reads.append(read)
-                    else:
-                        misc.log_to_file("info", 'Rna reads are incorrectly named')
-                        sys.exit()
-                threads = multiprocessing.cpu_count() - 2
-                misc.log_to_file("info", f'Starting: mapping reads ({options.tumor_id}) to genome with STAR using {threads} out of {threads + 2} available threads')
+            misc.create_directory([shortcuts.star_index_cache_dir])
+            star_index_dir = f"{shortcuts.star_index_cache_dir}{key}/"
+            if not misc.step_allready_completed(f"{star_index_dir}starIndex.complete", f"Indexing genome with STAR genomeGenerate (cache key {key})"):
+                with open(f"{shortcuts.star_index_cache_dir}{key}.lock", 'w') as lock:
+                    misc.log_to_file("info", f"Waiting for lock on STAR index {key}...")
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    # Another sample may have built the index while we were waiting for the lock
+                    if misc.step_allready_completed(f"{star_index_dir}starIndex.complete", f"Indexing genome with STAR genomeGenerate (cache key {key})"):
+                        return star_index_dir
+                    start = timeit.default_timer()
+                    threads = multiprocessing.cpu_count() -2
+                    misc.log_to_file("info", f"Starting: indexing genome with STAR using {threads} out of {threads + 2} available threads")
+                    partial_dir = f"{shortcuts.star_index_cache_dir}{key}.partial/"
+                    rmtree(partial_dir, ignore_errors=True)
+                    misc.create_directory([partial_dir])
+                    cmd_StarIndex = f'''
+                    STAR --runThreadN {threads} \\
+                    --genomeDir {partial_dir} \\
+                    --genomeFastaFiles {shortcuts.reference_genome_file} \\
+                    --sjdbGTFfile {shortcuts.annotation_gtf_file} \\
+                    --outFileNamePrefix {partial_dir} \\
+                    {self.star_genome_generate_parameters} {extra_parameters}'''
+                    if misc.run_command("STAR genomeGenerate", "Indexing genome with STAR genomeGenerate", None, None, cmd_StarIndex):
+                        # The trackfile is written before the rename, so the index folder is never there without it. A folder left
+                        # without a trackfile by an older build is removed first
+                        misc.create_trackFile(f"{partial_dir}starIndex.complete")
+                        rmtree(star_index_dir, ignore_errors=True)
+                        rename(partial_dir, star_index_dir)
+                        elapsed = timeit.default_timer() - start
+                        misc.log_to_file("info", f'Indexing genome with STAR succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+            return star_index_dir
+
+        except Exception as e:
+            misc.log_exception(".build_star_index in rna_seq_analysis.py:", e)
+
+    #---------------------------------------------------------------------------
+    def index_genome_rna(self, misc, shortcuts):
+        '''This function indexes the genome with STAR genomeGenerate into the shared STAR index cache'''
+        misc.set_log_context(stage="index_genome_rna")
+
+        try:
+            key = self.star_index_key(misc, shortcuts)
+            if not misc.step_allready_completed(f"{shortcuts.star_index_cache_dir}{key}/starIndex.complete", "Indexing genome with STAR genomeGenerate"):
+                self.build_star_index(misc, shortcuts, key, "")
+                input('press any key to exit')
+                sys.exit()
 
-                cmd_mapReads = f'''
-                STAR --genomeDir {shortcuts.star_index_dir} \\
+        except Exception as e:
+            misc.log_exception(".index_genome_rna in rna_seq_analysis.py:", e)
+
+    #---------------------------------------------------------------------------
+    def rna_reads(self, options, misc, shortcuts):
+        '''This function returns the two read files of the tumor sample'''
+
+        reads = []
+        for read in sorted(listdir(shortcuts.rna_reads_dir)):
+            if options.tumor_id in read:
+                reads.append(read)
+            else:
+                misc.log_to_file("info", 'Rna reads are incorrectly named')
+                sys.exit()
+        return reads
+
+    #---------------------------------------------------------------------------
+    def star_map_command(self, options, shortcuts, star_index_dir, reads, threads, genome_load, pass1=False):
+        '''This function returns the STAR command used to map the reads of one sample.
+        --twopassMode and --varVCFfile (WASP) insert junctions and variants into the genome on the fly, STAR only allows that with
+        a private genome (NoSharedMemory). With a shared genome they are left out, junctions then come from the cohort junction index.
+        With pass1 only the splice junctions are collected: no BAM, no quantification and no chimeric output (WithinBAM needs a BAM)'''
+
+        private_genome = genome_load == "NoSharedMemory"
+        prefix = f"{shortcuts.star_output_dir}{options.tumor_id}_{'pass1_' if pass1 else ''}"
+        chimeric = "" if pass1 else """
+                --chimJunctionOverhangMin 15 \\
+                --chimMainSegmentMultNmax 1 \\
+                --chimOutType Junctions SeparateSAMold WithinBAM SoftClip \\
+                --chimSegmentMin 15 \\"""
+        cmd_mapReads = f'''
+                STAR --genomeDir {star_index_dir} \\
                 --readFilesIn {shortcuts.rna_reads_dir}{reads[0]} {shortcuts.rna_reads_dir}{reads[1]} \\
                 --runThreadN {threads} \\
                 --alignIntronMax 1000000 \\
@@ -71,14 +143,10 @@ class RnaSeqAnalysis():
                 --alignMatesGapMax 1000000 \\
                 --alignSJDBoverhangMin 1 \\
                 --alignSJoverhangMin 8 \\
-                --alignSoftClipAtReferenceEnds Yes \\
-                --chimJunctionOverhangMin 15 \\
-                --chimMainSegmentMultNmax 1 \\
-                --chimOutType Junctions SeparateSAMold WithinBAM SoftClip \\
-                --chimSegmentMin 15 \\
-                --genomeLoad NoSharedMemory \\
+                --alignSoftClipAtReferenceEnds Yes \\{chimeric}
+                --genomeLoad {genome_load} \\
                 --limitSjdbInsertNsj 1200000 \\
-                --outFileNamePrefix {shortcuts.star_output_dir}{options.tumor_id}_ \\
+                --outFileNamePrefix {prefix} \\
                 --outFilterIntronMotifs None \\
                 --outFilterMatchNminOverLread 0.33 \\
                 --outFilterMismatchNmax 999 \\
@@ -86,31 +154,195 @@ class RnaSeqAnalysis():
                 --outFilterMultimapNmax 20 \\
                 --outFilterScoreMinOverLread 0.33 \\
                 --outFilterType BySJout \\
-                --outSAMattributes NH HI AS nM NM MD XS ch vA vG vW \\
+                --outSAMattributes NH HI AS nM NM MD XS ch{" vA vG vW" if private_genome else ""} \\
                 --outSAMstrandField intronMotif \\
-                --outSAMtype BAM Unsorted \\
+                --outSAMtype {"None" if pass1 else "BAM Unsorted"} \\
                 --outSAMunmapped Within \\
-                --quantMode TranscriptomeSAM GeneCounts \\
+                --quantMode {"-" if pass1 else "TranscriptomeSAM GeneCounts"} \\
                 --readFilesCommand zcat \\
+                --outSAMattrRGline ID:{reads[0][:16]} SM:{options.tumor_id} LB:{reads[0][:16]} PL:"ILLUMINA" PU:{reads[0][:16]}'''
+        if private_genome:
+            cmd_mapReads += f''' \\
                 --waspOutputMode SAMtag \\
                 --varVCFfile {shortcuts.gatk_vcfFile} \\
-                --outSAMattrRGline ID:{reads[0][:16]} SM:{options.tumor_id} LB:{reads[0][:16]} PL:"ILLUMINA" PU:{reads[0][:16]} \\
                 --twopassMode Basic'''
+        return cmd_mapReads
+
+    #---------------------------------------------------------------------------
+    def post_process_bam(self, options, misc, shortcuts, threads, wasp):
+        '''This function coordinate sorts the BAM written by STAR and, if wasp is True, writes the WASP-pass BAM in the same pass.
+        The sorted reads are streamed uncompressed through tee: a fifo feeds the reads to a samtools view that keeps the reads whose
+        binary vW tag is 1, the main branch writes every read. Both BAMs are indexed while they are written, so the RNA BAM is only read once'''
+
+        unsorted_bam = f"{shortcuts.star_output_dir}{options.tumor_id}_Aligned.out.bam"
+        sorted_bam = f"{shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam"
+        wasp_bam = f"{shortcuts.star_output_dir}{options.tumor_id}_WASP_pass.bam"
+        cmd_sort = f"samtools sort -@ {threads} -m 1G -u -T {shortcuts.star_output_dir}{options.tumor_id}_sort_tmp {unsorted_bam}"
+        cmd_write_sorted = f"samtools view -@ {threads} --write-index -o {sorted_bam}##idx##{sorted_bam}.bai -"
+        if wasp:
+            fifo = f"{shortcuts.star_output_dir}{options.tumor_id}_WASP.fifo"
+            cmd_post_process = f'''
+                set -o pipefail
+                rm -f {fifo} && mkfifo {fifo} || exit 1
+                samtools view -@ {threads} -d vW:1 --write-index -o {wasp_bam}##idx##{wasp_bam}.bai {fifo} &
+                wasp=$!
+                {cmd_sort} | tee {fifo} | {cmd_write_sorted}
+                rc=$?
+                wait $wasp || rc=1
+                rm -f {fifo}
+                exit $rc'''
+            misc.run_command("samtools sort", "Sorting, indexing and WASP filtering BAM with samtools", wasp_bam, f"{shortcuts.star_output_dir}map.complete", cmd_post_process)
+        else:
+            cmd_post_process = f"set -o pipefail && {cmd_sort} | {cmd_write_sorted}"
+            misc.run_command("samtools sort", "Sorting and indexing BAM with samtools", sorted_bam, f"{shortcuts.star_output_dir}map.complete", cmd_post_process)
+
+    #---------------------------------------------------------------------------
+    def map_reads(self, options, misc, shortcuts):
+        '''This function map reads to the reference genome'''
+        misc.set_log_context(stage="map_reads")
+
+        try:
+            if not misc.step_allready_completed(f"{shortcuts.star_output_dir}map.complete", f'Map reads to {options.tumor_id}'):
+                reads = self.rna_reads(options, misc, shortcuts)
+                star_index_dir = self.star_index(misc, shortcuts)
+                if not path.isfile(f"{star_index_dir}starIndex.complete"):
+                    misc.log_to_file("error", f"No STAR index found for this reference genome in {star_index_dir}, please index the reference genome first")
+                    sys.exit()
+                threads = multiprocessing.cpu_count() - 2
+                misc.log_to_file("info", f'Starting: mapping reads ({options.tumor_id}) to genome with STAR using {threads} out of {threads + 2} available threads')
+                cmd_mapReads = self.star_map_command(options, shortcuts, star_index_dir, reads, threads, "NoSharedMemory")
                 start = timeit.default_timer()
-                misc.run_command(cmd_mapReads, f'Mapping reads to genome', f'{shortcuts.star_output_dir}{options.tumor_id}_Aligned.out.bam', None)
-                cmd_sortsam = f"picard SortSam -I {shortcuts.star_output_dir}{options.tumor_id}_Aligned.out.bam -O {shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam -SO coordinate"
-                misc.run_command(cmd_sortsam, "Sorting BAM with Picard SortSam", f"{shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam", None)
-                cmd_samtools_index = f"samtools index {shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam"
-                misc.run_command(cmd_samtools_index, "Indexing BAM with Samtools index", f"{shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam.bai",  None)
-                cmd_wasp = f"samtools view -h {shortcuts.star_output_dir}{options.tumor_id}_Aligned_sorted.out.bam | LC_ALL=C egrep \"^@|vW:i:1\" | samtools view -bo {shortcuts.star_output_dir}{options.tumor_id}_WASP_pass.bam -"
-                misc.run_command(cmd_wasp, "Applying wasp filtering", f"{shortcuts.star_output_dir}{options.tumor_id}_WASP_pass.bam", f"{shortcuts.star_output_dir}map.complete")
+                misc.run_command("STAR", 'Mapping reads to genome', f'{shortcuts.star_output_dir}{options.tumor_id}_Aligned.out.bam', None, cmd_mapReads)
+                self.post_process_bam(options, misc, shortcuts, threads, True)
                 elapsed = timeit.default_timer() - start
                 misc.log_to_file("info", f'All steps in mapping reads to gemome with STAR succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
         except Exception as e:
             misc.log_exception(".map_reads() in rna_seq_analysis.py:", e)
 
+    #---------------------------------------------------------------------------
+    def cohort_samples(self, options, misc):
+        '''This function reads the cohort file (one tumor id per line) and returns (options, shortcuts) for every sample in it'''
+
+        try:
+            samples = []
+            with open(options.cohort, 'r') as cohort:
+                for tumor_id in cohort.read().split():
+                    sample_options = argparse.Namespace(**dict(vars(options), tumor_id=tumor_id))
+                    samples.append((sample_options, Shortcuts(sample_options)))
+            return samples
+        except OSError as e:
+            misc.log_exception("You have to enter a cohort file with -c <file> first", e)
+        except Exception as e:
+            misc.log_exception(".cohort_samples() in rna_seq_analysis.py:", e)
+
+    #---------------------------------------------------------------------------
+    def star_parallel_jobs(self, options, misc, star_index_dir, n_samples):
+        '''This function returns how many STAR processes can map side by side against one genome in shared memory,
+        limited by the memory budget left after loading the genome and by the number of threads'''
+
+        genome_size = sum(path.getsize(f"{star_index_dir}{file}") for file in ("Genome", "SA", "SAindex") if path.isfile(f"{star_index_dir}{file}"))
+        total_memory = misc.memory_budget(options) * 1024**3
+        by_memory = int((total_memory - genome_size) // self.star_process_memory)
+        by_threads = int(options.threads) // 4
+        jobs = max(1, min(n_samples, by_memory, by_threads))
+        misc.log_to_file("info", f"Shared genome: {round(genome_size/1024**3, 1)} GB, memory budget: {round(total_memory/1024**3, 1)} GB, running {jobs} STAR processes side by side")
+        return jobs
+
+    #---------------------------------------------------------------------------
+    def map_cohort_sample(self, misc, star_index_dir, threads, pass1, sample):
+        '''This function maps one cohort sample against the genome loaded in shared memory. In the first pass only the splice
+        junctions are collected, in the second pass the BAM is written and post processed. Returns the tumor id of the sample
+        if it failed, else None. run_command() exits on errors, a pool worker that exits would make the pool wait forever'''
+
+        options, shortcuts = sample
+        try:
+            misc.create_directory([shortcuts.star_output_dir])
+            reads = self.rna_reads(options, misc, shortcuts)
+            cmd_mapReads = self.star_map_command(options, shortcuts, star_index_dir, reads, threads, "LoadAndKeep", pass1)
+            if pass1:
+                misc.run_command("STAR", f'Collecting splice junctions for {options.tumor_id}', f'{shortcuts.star_output_dir}{options.tumor_id}_pass1_SJ.out.tab', None, cmd_mapReads)
+            elif not misc.step_allready_completed(f"{shortcuts.star_output_dir}map.complete", f'Map reads to {options.tumor_id}'):
+                misc.run_command("STAR", f'Mapping reads of {options.tumor_id} to genome', f'{shortcuts.star_output_dir}{options.tumor_id}_Aligned.out.bam', None, cmd_mapReads)
+                self.post_process_bam(options, misc, shortcuts, threads, False)
+            return None
+        except (Exception, SystemExit) as e:
+            misc.log_to_file("ERROR", f"Mapping {options.tumor_id} failed: {e}")
+            return options.tumor_id
+
+    #---------------------------------------------------------------------------
+    def cohort_junction_index(self, options, misc, shortcuts, samples):
+        '''This function pools the splice junctions found in the first pass of all cohort samples and builds a STAR index with them
+        inserted, which replaces --twopassMode Basic for the whole cohort'''
+
+        try:
+            misc.create_directory([shortcuts.star_cohort_dir])
+            junctions = {}
+            for sample_options, sample_shortcuts in samples:
+                with open(f"{sample_shortcuts.star_output_dir}{sample_options.tumor_id}_pass1_SJ.out.tab", 'r') as sj:
+                    for line in sj:
+                        chromosome, start, end, strand, _, _, unique, _, _ = line.split('\t')
+                        junctions[(chromosome, start, end, strand)] = junctions.get((chromosome, start, end, strand), 0) + int(unique)
+            # Same filter as STAR uses between the two passes: junctions supported by uniquely mapped reads
+            with open(f"{shortcuts.star_cohort_dir}cohort_SJ.out.tab", 'w') as sj:
+                for (chromosome, start, end, strand), unique in junctions.items():
+                    if unique > 0:
+                        sj.write(f"{chromosome}\t{start}\t{end}\t{strand}\n")
+            key = hashlib.sha256(f"{self.star_index_key(misc, shortcuts)}{misc.checksum_file(f'{shortcuts.star_cohort_dir}cohort_SJ.out.tab')}".encode()).hexdigest()[:16]
+            return self.build_star_index(misc, shortcuts, key, f"--sjdbFileChrStartEnd {shortcuts.star_cohort_dir}cohort_SJ.out.tab --limitSjdbInsertNsj 1200000")
+        except Exception as e:
+            misc.log_exception(".cohort_junction_index() in rna_seq_analysis.py:", e)
+
+    #---------------------------------------------------------------------------
+    def map_cohort_pass(self, options, misc, star_index_dir, samples, pass1):
+        '''This function loads the genome into shared memory once, maps all samples against it and removes it again'''
+
+        jobs = self.star_parallel_jobs(options, misc, star_index_dir, len(samples))
+        threads = max(1, int(options.threads) // jobs)
+        cmd_load = f"STAR --genomeDir {star_index_dir} --genomeLoad LoadAndExit --outFileNamePrefix {star_index_dir}load_"
+        misc.run_command("STAR", "Loading genome into shared memory", None, None, cmd_load)
+        try:
+            with multiprocessing.Pool(processes=jobs) as pool:
+                failed = [sample for sample in pool.map(partial(self.map_cohort_sample, misc, star_index_dir, threads, pass1), samples) if sample]
+            if failed:
+                misc.log_to_file("ERROR", f"Mapping failed for {', '.join(failed)}, see the log of map_reads_cohort")
+                sys.exit()
+        finally:
+            cmd_remove = f"STAR --genomeDir {star_index_dir} --genomeLoad Remove --outFileNamePrefix {star_index_dir}remove_"
+            misc.run_command("STAR", "Removing genome from shared memory", None, None, cmd_remove)
+
+    #---------------------------------------------------------------------------
+    def map_reads_cohort(self, options, misc, shortcuts):
+        '''This function maps all samples in the cohort file against one STAR genome held in shared memory.
+        Pass 1 collects splice junctions of all samples, pass 2 maps against an index with the cohort junctions inserted.
+        WASP tagging needs --varVCFfile which STAR only allows with a private genome, use --cohort_wasp to map every
+        sample with map_reads() (NoSharedMemory) instead'''
+        misc.set_log_context(stage="map_reads_cohort")
+
+        try:
+            start = timeit.default_timer()
+            samples = self.cohort_samples(options, misc)
+            if options.cohort_wasp:
+                misc.log_to_file("warning", "--cohort_wasp: WASP tagging is not possible with a shared genome, mapping one sample at a time")
+                for sample_options, sample_shortcuts in samples:
+                    misc.create_directory([sample_shortcuts.star_output_dir])
+                    self.map_reads(sample_options, misc, sample_shortcuts)
+                return
+            star_index_dir = self.star_index(misc, shortcuts)
+            if not path.isfile(f"{star_index_dir}starIndex.complete"):
+                misc.log_to_file("error", f"No STAR index found for this reference genome in {star_index_dir}, please index the reference genome first")
+                sys.exit()
+            misc.log_to_file("info", f"Starting: mapping {len(samples)} samples to genome with STAR in shared memory")
+            self.map_cohort_pass(options, misc, star_index_dir, samples, True)
+            cohort_index_dir = self.cohort_junction_index(options, misc, shortcuts, samples)
+            self.map_cohort_pass(options, misc, cohort_index_dir, samples, False)
+            elapsed = timeit.default_timer() - start
+            misc.log_to_file("info", f'Mapping {len(samples)} samples to genome with STAR in shared memory succesfully completed in {misc.elapsed_time(elapsed)} - OK!')
+        except Exception as e:
+            misc.log_exception(".map_reads_cohort() in rna_seq_analysis.py:", e)
+
     #---------------------------------------------------------------------------
     def ASEReadCounter(self, options, misc, shortcuts):
+        misc.set_log_context(stage="ASEReadCounter")
 
         try:
             if not misc.step_allready_completed(f"{shortcuts.star_output_dir}ase.complete", f'ASEReadCounter for {options.tumor_id}'):
@@ -135,70 +367,198 @@ class RnaSeqAnalysis():
 
     #---------------------------------------------------------------------------
     def add_wgs_data_to_csv(self, options, misc, shortcuts):
-        '''This functions reads the CHROM and POS column of the vcf file and the allele depth 'AD' column. CHROM and POS columns are concatenated
-        into a string as key in the dict and the 'AD' matching the CHROM and POS is the value. The csv file created by gatk ASEReadCounter is opened
-        and 4 new columns with values are written to the file. df.apply applies the lambda function in every row in the csv file.'''
+        '''This functions reads the CHROM and POS column of the vcf file and the allele depth 'AD' column, and joins them on CHROM and POS with
+        the csv file created by gatk ASEReadCounter. CN, pValues and RNA/DNA ratios are added to every site and the table is written as csv or
+        to the Parquet dataset. With --ase_streaming the two position sorted inputs are joined one chromosome at a time instead'''
+        misc.set_log_context(stage="add_wgs_data_to_csv")
 
         # try:
+        import vcfpy
+        import pandas as pd
 
         start = timeit.default_timer()
         misc.log_to_file(f"Starting: Creating CSV...")
-        dict = {}
-        vcf_reader = vcfpy.Reader.from_path(f'{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf', 'r')
-        variants_to_exclude = ['downstream_gene_variant', 'intergenic_region', 'intragenic_variant', 'intron_variant', 'splice_region_variant', 'splice_region_variant&intron_variant', 'upstream_gene_variant']
-
-        for i, record in enumerate(vcf_reader):
-            contig = record.CHROM
-            position = record.POS
-            refCount = record.calls[0].data.get('AD')[0]
-            altCount = record.calls[0].data.get('AD')[1]
-            totalCount = refCount + altCount
-            geneName = record.__dict__['INFO']['ANN'][0].split('|')[3]
-            variantType = record.__dict__['INFO']['ANN'][0].split('|')[1] if not record.__dict__['INFO']['ANN'][0].split('|')[1] in variants_to_exclude else None
-            dict[i] = [contig, position, refCount, altCount, totalCount, geneName, variantType]
-
-        # Make DataFrame out of dict
-        df_vcf = pd.DataFrame.from_dict(dict, orient="index", columns=["contig", "position", "DNA_refCount", "DNA_altCount", "DNA_totalCount", "geneName", "variantType"])
         # read exel file with cnv information
         if not path.isfile(f'{shortcuts.star_output_dir}{options.tumor_id}_CN.xlsx'):
             misc.log_to_file(f"No file specifying copynumber, save {options.tumor_id}_CN.xlsx in {shortcuts.star_output_dir}")
             sys.exit()
         df_cn = pd.read_excel(f'{shortcuts.star_output_dir}{options.tumor_id}_CN.xlsx')
         df_cn = df_cn[['Chromosome', 'Start', 'End', 'Cn']]
-        # read csv from star output
-        df = pd.read_csv(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE.csv')
-
-        df['Subgroup'] = options.subgroup
-        df['Sample'] = options.tumor_id.replace('-', '_')
-        df_merge = pd.merge(df_vcf, df, on=["contig", "position"])
-        df_merge.insert(14, 'CN', True)
-        df_merge.insert(15, 'pValue_WGS_VAF', True)
-        df_merge.insert(16, 'RNA/DNA_ratio_WGS_VAF', True)
-        df_merge.insert(17, 'pValue_CNV', True)
-        df_merge.insert(18, 'RNA/DNA_ratio_CNV', True)
+        vcf_reader = vcfpy.Reader.from_path(f'{shortcuts.haplotypecaller_output_dir}{options.tumor_id}/{options.tumor_id}_filtered_RD10_snps_tumor_het_annotated.vcf', 'r')
 
-        df_merge.rename(columns={'contig' : "Chromosome", 'refAllele' : 'RNA_refAllele', 'altAllele' : 'RNA_altAllele', 'refCount': 'RNA_refCount', 'altCount': 'RNA_altCount', 'totalCount': 'RNA_totalCount'}, inplace=True)
-        df_merge = df_merge[['Subgroup', 'Sample', 'geneName', 'variantType', 'Chromosome', 'position', 'variantID', 'RNA_refAllele', 'RNA_altAllele', 'RNA_refCount', 'RNA_altCount', 'RNA_totalCount', 'DNA_refCount', 'DNA_altCount', 'CN', 'pValue_WGS_VAF', 'RNA/DNA_ratio_WGS_VAF', 'pValue_CNV', 'RNA/DNA_ratio_CNV']]
-        #                        0           1            2             3            4          5           6               7                8                9                10               11               12              13        14          15                   16                  17                 18
-        df_merge[['RNA_refCount', 'RNA_altCount']] = df_merge[['RNA_refCount', 'RNA_altCount']].apply(pd.to_numeric)
-        df_merge['CN'] = df_merge.apply(lambda row: self.add_CNV(misc, df_cn, row), axis=1) # row[14]
-        df_merge.dropna(inplace=True)
-        df_merge['RNA_altCount'] = df_merge.apply(lambda row: 1 if int(row[10]) < 1 else int(row[10]), axis=1)
-        df_merge['DNA_altCount'] = df_merge.apply(lambda row: 1 if int(row[13]) < 1 else int(row[13]), axis=1)
-        df_merge['pValue_WGS_VAF'] = df_merge.apply(lambda row: f"{binom_test(int(row[9]), int(row[11]), int(row[12])/(int(row[12]) + int(row[13])))}", axis=1) #input: RNA_refCount, RNA_totalCount, DNA_refCount/(DNA_refCount + DNA_altCount)
-        df_merge['RNA/DNA_ratio_WGS_VAF'] = df_merge.apply(lambda row: f"{(int(row[9])/int(row[10]))/(int(row[12])/int(row[13]))}", axis=1) # (RNA_refCount/RNA_altCount)/(DNA_refCount/DNA_altCount)
-        df_merge['pValue_CNV'] = df_merge.apply(lambda row: self.calculate_pValue_CNV(misc, row), axis=1) #input: RNA_refCount, RNA_totalCount, CNV
-        df_merge['RNA/DNA_ratio_CNV'] = df_merge.apply(lambda row: self.calculate_RNA_DNA_ratio_CNV(misc, row), axis=1) # RNA_refAllele_ratio/CNV_ratio
-        df_merge.to_csv(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE_completed.csv', sep=',', index=False)
-        print(df_merge.dtypes)
-        # Drop rows that have both RNA_refCount and RNA_altCount < 10
-        df_merge.drop(df_merge[ (df_merge['RNA_refCount'] < 10) & (df_merge['RNA_altCount'] < 10)].index, inplace=True)
+        if options.ase_streaming:
+            self.add_wgs_data_streaming(options, misc, shortcuts, vcf_reader, df_cn)
+        else:
+            df_vcf = pd.DataFrame([self.vcf_site(record) for record in vcf_reader], columns=self.vcf_columns)
+            # read csv from star output
+            df = pd.read_csv(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE.csv')
+            df_merge = self.ase_sites(options, pd.merge(df_vcf, df, on=["contig", "position"]), df_cn)
+            df_merge = self.ase_pValues(options, misc, df_merge)
+            self.write_ase_table(options, misc, shortcuts, df_merge, True)
+            self.finish_ase_table(options, misc, shortcuts)
         elapsed = timeit.default_timer() - start
         misc.log_to_file(f'Creating CSV completed in {misc.elapsed_time(elapsed)} - OK!')
         sys.exit()
         # except Exception as e:
         #     misc.log_exception(".add_wgs_data_to_csv() in rna_seq_analysis.py:", e)
 
+    # --------------------------------------------------------------------------
+    def add_wgs_data_streaming(self, options, misc, shortcuts, vcf_reader, df_cn):
+        '''This function joins the vcf file and the ASEReadCounter csv one chromosome at a time and writes every chromosome when it is done,
+        so memory depends on the largest chromosome instead of the whole genome. The beta-binomial dispersion needs all sites, so the sites
+        are written without pValues first while the number of sites of every (ref count, total count, expected fraction) is counted. The
+        dispersion is fitted on these counts, which gives the same estimate as fit_dispersion() on all sites, and the pValues are added
+        in a second pass over the written sites'''
+
+        import pandas as pd
+
+        sites_file = f"{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE_sites.csv.partial"
+        # Both inputs follow the contig order of the reference, which is the order of the contig lines in the vcf header
+        contig_order = {line.id: i for i, line in enumerate(vcf_reader.header.get_lines('contig'))}
+        betabinomial = options.ase_model == "betabinomial"
+        site_counts = None
+
+        first = True
+        blocks = self.merge_join(self.vcf_blocks(vcf_reader), self.csv_blocks(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE.csv'), contig_order)
+        for contig, df_merge in blocks:
+            df_merge = self.ase_sites(options, df_merge, df_cn)
+            if betabinomial:
+                sites = pd.DataFrame({'k': df_merge['RNA_refCount'].to_numpy(), 'n': df_merge['RNA_totalCount'].to_numpy(), 'p': self.expected_fractions(df_merge), 'sites': 1})
+                site_counts = pd.concat([site_counts, sites]).groupby(['k', 'n', 'p'])['sites'].sum().reset_index()
+                df_merge.to_csv(sites_file, mode='w' if first else 'a', header=first, sep=',', index=False)
+            else:
+                self.write_ase_table(options, misc, shortcuts, self.ase_pValues(options, misc, df_merge), first)
+            misc.log_to_file("DEBUG", f"{contig}: {len(df_merge)} sites")
+            first = False
+
+        if betabinomial and not first:
+            rho = self.fit_dispersion(misc, site_counts['k'].to_numpy(), site_counts['n'].to_numpy(), site_counts['p'].to_numpy(), site_counts['sites'].to_numpy())
+            for i, df_sites in enumerate(pd.read_csv(sites_file, dtype=self.ase_schema, chunksize=self.ase_chunk_rows)):
+                self.write_ase_table(options, misc, shortcuts, self.ase_pValues(options, misc, df_sites, rho), i == 0)
+            remove(sites_file)
+        if not first:
+            self.finish_ase_table(options, misc, shortcuts)
+
+    # --------------------------------------------------------------------------
+    def vcf_site(self, record):
+        '''This function returns contig, position, DNA counts, gene name and variant type of a vcf record'''
+
+        refCount = record.calls[0].data.get('AD')[0]
+        altCount = record.calls[0].data.get('AD')[1]
+        annotation = record.__dict__['INFO']['ANN'][0].split('|')
+        variantType = annotation[1] if not annotation[1] in self.variants_to_exclude else None
+        return [record.CHROM, record.POS, refCount, altCount, refCount + altCount, annotation[3], variantType]
+
+    # --------------------------------------------------------------------------
+    def vcf_blocks(self, vcf_reader):
+        '''This function yields the sites of the vcf file one chromosome at a time, as (contig, DataFrame)'''
+
+        import pandas as pd
+
+        for contig, records in groupby(vcf_reader, key=lambda record: record.CHROM):
+            yield contig, pd.DataFrame([self.vcf_site(record) for record in records], columns=self.vcf_columns)
+
+    # --------------------------------------------------------------------------
+    def csv_blocks(self, csv_file):
+        '''This function yields the rows of the ASEReadCounter csv one contig at a time, as (contig, DataFrame). The file is read
+        in chunks, and the rows of the last contig of a chunk wait for the next chunk'''
+
+        import pandas as pd
+
+        rest = None
+        for chunk in pd.read_csv(csv_file, dtype={'contig': str}, chunksize=self.ase_chunk_rows):
+            if rest is not None:
+                chunk = pd.concat([rest, chunk], ignore_index=True)
+            contigs = chunk['contig'].unique()
+            for contig in contigs[:-1]:
+                yield contig, chunk[chunk['contig'] == contig]
+            rest = chunk[chunk['contig'] == contigs[-1]]
+        if rest is not None:
+            yield rest['contig'].iloc[0], rest
+
+    # --------------------------------------------------------------------------
+    def merge_join(self, vcf_blocks, csv_blocks, contig_order):
+        '''This function walks the chromosomes of the vcf and the csv together in contig order and yields the sites in both, one chromosome
+        at a time. Chromosomes in only one of the files are skipped'''
+
+        import pandas as pd
+
+        vcf_block, csv_block = next(vcf_blocks, None), next(csv_blocks, None)
+        while vcf_block is not None and csv_block is not None:
+            vcf_rank, csv_rank = contig_order.get(vcf_block[0], len(contig_order)), contig_order.get(csv_block[0], len(contig_order))
+            if vcf_block[0] == csv_block[0]:
+                yield vcf_block[0], pd.merge(vcf_block[1], csv_block[1], on=["contig", "position"])
+                vcf_block, csv_block = next(vcf_blocks, None), next(csv_blocks, None)
+            elif vcf_rank <= csv_rank:
+                vcf_block = next(vcf_blocks, None)
+            else:
+                csv_block = next(csv_blocks, None)
+
+    # --------------------------------------------------------------------------
+    def ase_sites(self, options, df_merge, df_cn):
+        '''This function adds subgroup, sample, CN and the RNA/DNA ratios to the joined vcf and ASEReadCounter sites and returns them with
+        the types of the ASE schema. Sites without CN or with an excluded variant type are dropped'''
+
+        df_merge = df_merge.assign(Subgroup=options.subgroup, Sample=options.tumor_id.replace('-', '_'))
+        df_merge.rename(columns={'contig' : "Chromosome", 'refAllele' : 'RNA_refAllele', 'altAllele' : 'RNA_altAllele', 'refCount': 'RNA_refCount', 'altCount': 'RNA_altCount', 'totalCount': 'RNA_totalCount'}, inplace=True)
+        df_merge = df_merge[['Subgroup', 'Sample', 'geneName', 'variantType', 'Chromosome', 'position', 'variantID', 'RNA_refAllele', 'RNA_altAllele', 'RNA_refCount', 'RNA_altCount', 'RNA_totalCount', 'DNA_refCount', 'DNA_altCount']]
+        #                        0           1            2             3            4          5           6               7                8                9                10               11               12              13
+        df_merge['CN'] = self.add_CNV(df_cn, df_merge) # row[14]
+        df_merge.dropna(inplace=True)
+        df_merge = df_merge.astype({column: dtype for column, dtype in self.ase_schema.items() if column in df_merge.columns})
+        # Change RNA_altCount and DNA_altCount to 1 if 0 to avoid division with zero
+        df_merge['RNA_altCount'] = df_merge['RNA_altCount'].clip(lower=1)
+        df_merge['DNA_altCount'] = df_merge['DNA_altCount'].clip(lower=1)
+        df_merge['pValue_WGS_VAF'] = float('nan')
+        rna_ratio = df_merge['RNA_refCount'] / df_merge['RNA_altCount']
+        df_merge['RNA/DNA_ratio_WGS_VAF'] = rna_ratio / (df_merge['DNA_refCount'] / df_merge['DNA_altCount']) # (RNA_refCount/RNA_altCount)/(DNA_refCount/DNA_altCount)
+        df_merge['pValue_CNV'] = float('nan')
+        cnv_fractions = self.expected_fractions(df_merge)
+        df_merge['RNA/DNA_ratio_CNV'] = rna_ratio / (cnv_fractions / (1 - cnv_fractions)) # RNA_refAllele_ratio/CNV_ratio
+        return df_merge.astype(self.ase_schema)
+
+    # --------------------------------------------------------------------------
+    def ase_pValues(self, options, misc, df_merge, rho=None):
+        '''This function sets pValue_WGS_VAF and pValue_CNV of the sites with the test of --ase_model. The beta-binomial dispersion is
+        fitted on the sites unless rho is given'''
+
+        if options.ase_model == "betabinomial":
+            self.beta_binomial_pValues(misc, df_merge, rho)
+        elif len(df_merge):
+            from scipy.stats import binom_test
+            df_merge['pValue_WGS_VAF'] = df_merge.apply(lambda row: binom_test(int(row[9]), int(row[11]), int(row[12])/(int(row[12]) + int(row[13]))), axis=1) #input: RNA_refCount, RNA_totalCount, DNA_refCount/(DNA_refCount + DNA_altCount)
+            df_merge['pValue_CNV'] = df_merge.apply(lambda row: self.calculate_pValue_CNV(misc, row), axis=1) #input: RNA_refCount, RNA_totalCount, CNV
+        return df_merge.astype(self.ase_schema)
+
+    # --------------------------------------------------------------------------
+    def write_ase_table(self, options, misc, shortcuts, df, first):
+        '''This function writes (first) or appends sites to the ASE table, a partial csv file or the partition of the sample in the Parquet dataset'''
+
+        if options.ase_format == "parquet":
+            self.write_ase_dataset(options, misc, shortcuts, df, first)
+        else:
+            df.to_csv(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE_completed.csv.partial', mode='w' if first else 'a', header=first, sep=',', index=False)
+
+    # --------------------------------------------------------------------------
+    def finish_ase_table(self, options, misc, shortcuts):
+        '''This function renames the partial csv file when all sites are written'''
+
+        if options.ase_format == "parquet":
+            misc.log_to_file("INFO", f"ASE table written to {shortcuts.ase_dataset_dir}Subgroup={options.subgroup}/Sample={options.tumor_id.replace('-', '_')}/ - OK!")
+        else:
+            rename(f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE_completed.csv.partial', f'{shortcuts.star_output_dir}{options.tumor_id}_STAR_ASE_completed.csv')
+
+    # --------------------------------------------------------------------------
+    def write_ase_dataset(self, options, misc, shortcuts, df, replace=True):
+        '''This function writes the ASE table of the sample to the cohort Parquet dataset, partitioned by Subgroup and Sample.
+        With replace the partition of the sample is removed first, so rerunning a sample does not add its rows twice'''
+
+        partition = f"{shortcuts.ase_dataset_dir}Subgroup={options.subgroup}/Sample={options.tumor_id.replace('-', '_')}/"
+        if replace and path.isdir(partition):
+            rmtree(partition)
+        if len(df):
+            df.to_parquet(shortcuts.ase_dataset_dir, engine='pyarrow', partition_cols=['Subgroup', 'Sample'], index=False)
+
     # --------------------------------------------------------------------------
     # def RNA_refAllele_ratio(self, misc, row):
     #
@@ -212,100 +572,136 @@ class RnaSeqAnalysis():
     #     return f"{int(row[12])/int(row[13])}"
 
     # --------------------------------------------------------------------------
-    def add_CNV(self, misc, df_cn, row):
-        '''This function fetch the CN data from the CN.xlsx document for the specific position'''
+    def add_CNV(self, df_cn, df):
+        '''This function fetch the CN data from the CN.xlsx document for every site, with a binary search in the segments of its chromosome.
+        Sites outside the segments get NaN'''
+
+        import numpy as np
+
+        cn = np.full(len(df), np.nan)
+        chromosomes = df['Chromosome'].astype(str).to_numpy()
+        positions = df['position'].to_numpy()
+        for chromosome, segments in df_cn.groupby(df_cn['Chromosome'].astype(str)):
+            segments = segments.sort_values('Start')
+            sites = np.flatnonzero(chromosomes == chromosome)
+            i = np.searchsorted(segments['Start'].to_numpy(), positions[sites], side='right') - 1
+            inside = (i >= 0) & (positions[sites] < segments['End'].to_numpy()[np.maximum(i, 0)])
+            cn[sites[inside]] = segments['Cn'].to_numpy()[i[inside]]
+        return cn
+
+    # --------------------------------------------------------------------------
+    def expected_fractions(self, df):
+        '''This function returns the expected RNA ref allele fraction of every site from the CN, the same CNV ratios as calculate_pValue_CNV.
+        The larger fraction goes to the allele with the most DNA reads, sites with another CN get NaN'''
 
-        for i in df_cn.index:
-            if row[4] == df_cn["Chromosome"].iloc[i] and df_cn["Start"].iloc[i] <= row[5] < df_cn["End"].iloc[i]:
-                return df_cn["Cn"].iloc[i]
+        import numpy as np
+
+        cn = df['CN'].astype(int).to_numpy()
+        balanced = np.isin(cn, [2, -4])
+        major = np.select([balanced, cn == 3, cn == 4, cn == 5, np.isin(cn, [1, -5])], [0.5, 2/3, 0.75, 0.6, 0.8], np.nan)
+        ref_major = df['DNA_refCount'].astype(int).to_numpy() > df['DNA_altCount'].astype(int).to_numpy()
+        return np.where(balanced | ref_major, major, 1 - major)
 
     # --------------------------------------------------------------------------
-    def calculate_RNA_DNA_ratio_CNV(self, misc, row):
-        '''This function determines what CN-ratio value that should be used when calculating the VAF_ratio_CNV'''
+    def fit_dispersion(self, misc, k, n, p, weights=None):
+        '''This function returns the maximum likelihood overdispersion rho of a beta-binomial with mean p for ref counts k of n reads.
+        All sites are evaluated together in every step, rho = 0 is the binomial. weights is the number of sites of every k, n and p'''
 
+        import numpy as np
+        from scipy.optimize import minimize_scalar
 
-        # CN = 2 or CN = -4
-        if int(row[14]) == 2 or int(row[14]) == -4:
-            return f"{int(row[9])/int(row[10])}" # (RNA_refCount/RNA_altCount)/1 : CNV_ratio: 1/1
+        rho = minimize_scalar(lambda rho: -self.dispersion_log_likelihood(k, n, p, np.array([rho]), weights)[0], bounds=(1e-6, 0.5), method='bounded').x
+        misc.log_to_file("INFO", f"Beta-binomial overdispersion rho = {rho:.4g} fitted on {len(k) if weights is None else int(weights.sum())} sites")
+        return rho
 
-        # CN = 3
-        elif int(row[14]) == 3:
-            # if DNA_refCount > DNA_altCount
-            if int(row[12]) > int(row[13]):
-                return f"{(int(row[9])/int(row[10]))/2}" # (RNA_refCount/RNA_altCount)/2 : CNV_ratio: 2/1
-            # if DNA_refCount < DNA_altCount
-            else:
-                return f"{(int(row[9])/int(row[10]))/0.5}" # (RNA_refCount/RNA_altCount)/0.5 : CNV_ratio: 1/2
+    # --------------------------------------------------------------------------
+    def dispersion_log_likelihood(self, k, n, p, grid, weights=None):
+        '''This function returns the beta-binomial log-likelihood (without the binomial coefficients) of ref counts k of n reads with mean p
+        for every dispersion in grid, every k, n and p counted weights times (once if not given). Sites without expected fraction or reads are left out'''
+
+        import numpy as np
+        from scipy.special import betaln
+
+        if weights is None:
+            weights = np.ones(len(k))
+        valid = ~np.isnan(p) & (n > 0)
+        k, n, p, weights = k[valid], n[valid], p[valid], weights[valid]
+        log_likelihood = np.empty(len(grid))
+        for i, rho in enumerate(grid):
+            alpha, beta = p * (1 - rho) / rho, (1 - p) * (1 - rho) / rho
+            log_likelihood[i] = np.sum(weights * (betaln(k + alpha, n - k + beta) - betaln(alpha, beta)))
+        return log_likelihood
 
-        # CN = 4
-        elif int(row[14]) == 4:
-            # if DNA_refCount > DNA_altCount
-            if int(row[12]) > int(row[13]):
-                return f"{(int(row[9])/int(row[10]))/3}" # (RNA_refCount/RNA_altCount)/3 : CNV_ratio: 3/1
-            # if DNA_refCount < DNA_altCount
-            else:
-                return f"{(int(row[9])/int(row[10]))/(1/3)}" # (RNA_refCount/RNA_altCount)/(1/3) : CNV_ratio: 1/3
+    # --------------------------------------------------------------------------
+    def beta_binomial_test(self, k, n, p, rho):
+        '''This function returns the two-sided beta-binomial pValues of ref counts k of n reads with expected ref fractions p'''
 
-        # CN = 5
-        elif int(row[14]) == 5:
-            # if DNA_refCount > DNA_altCount
-            if int(row[12]) > int(row[13]):
-                return f"{(int(row[9])/int(row[10]))/(3/2)}" # (RNA_refCount/RNA_altCount)/(3/2) : CNV_ratio: 3/2
-            else:
-                return f"{(int(row[9])/int(row[10]))/(2/3)}" # (RNA_refCount/RNA_altCount)/(2/3) : CNV_ratio: 2/3
+        import numpy as np
+        from scipy.stats import betabinom
 
-        # CN = 1 or CN = -5
-        elif int(row[14]) == 1 or int(row[14]) == -5:
-            # if DNA_refCount > DNA_altCount
-            if int(row[12]) > int(row[13]):
-                return f"{(int(row[9])/int(row[10]))/4}" # (RNA_refCount/RNA_altCount)/4 : CNV_ratio: 4/1
-            # if DNA_refCount < DNA_altCount
-            else:
-                return f"{(int(row[9])/int(row[10]))/0.25}" # (RNA_refCount/RNA_altCount)/0.25 : CNV_ratio: 1/4
+        p = np.clip(p, 1e-6, 1 - 1e-6) # a fraction of 0 or 1 has no beta distribution
+        alpha, beta = p * (1 - rho) / rho, (1 - p) * (1 - rho) / rho
+        return np.minimum(1, 2 * np.minimum(betabinom.cdf(k, n, alpha, beta), betabinom.sf(k - 1, n, alpha, beta)))
 
+    # --------------------------------------------------------------------------
+    def beta_binomial_pValues(self, misc, df, rho=None):
+        '''This function fits the overdispersion of the sample with the CN expected fractions as null (unless rho is given) and sets
+        pValue_CNV and pValue_WGS_VAF (null: the DNA ref allele fraction) of all sites at once'''
+
+        k = df['RNA_refCount'].astype(int).to_numpy()
+        n = df['RNA_totalCount'].astype(int).to_numpy()
+        cnv_fractions = self.expected_fractions(df)
+        dna_ref, dna_alt = df['DNA_refCount'].astype(int).to_numpy(), df['DNA_altCount'].astype(int).to_numpy()
+        if rho is None:
+            rho = self.fit_dispersion(misc, k, n, cnv_fractions)
+        df['pValue_CNV'] = self.beta_binomial_test(k, n, cnv_fractions, rho)
+        df['pValue_WGS_VAF'] = self.beta_binomial_test(k, n, dna_ref / (dna_ref + dna_alt), rho)
 
+    # --------------------------------------------------------------------------
     def calculate_pValue_CNV(self, misc, row):
         '''This function determines what CN value that should be used when calculating the pValue_CNV'''
 
+        from scipy.stats import binom_test
+
         # -4 : AABB    4 : AAAB
 		# -5 : AAABB   5 AAAAB
 
         # CN = 2 or CN = -4
         if int(row[14]) == 2 or int(row[14]) == -4:
-            return f"{binom_test(int(row[9]), int(row[11]), 0.5)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/2
+            return binom_test(int(row[9]), int(row[11]), 0.5) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/2
 
         # CN = 3
         elif int(row[14]) == 3:
             # if DNA_refCount > DNA_altCount
             if int(row[12]) > int(row[13]):
-                return f"{binom_test(int(row[9]), int(row[11]), float(2/3))}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 2/3
+                return binom_test(int(row[9]), int(row[11]), float(2/3)) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 2/3
             # if DNA_refCount < DNA_altCount
             else:
-                return f"{binom_test(int(row[9]), int(row[11]), float(1/3))}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/3
+                return binom_test(int(row[9]), int(row[11]), float(1/3)) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/3
 
         # CN = 5
         elif int(row[14]) == 5:
             # if DNA_refCount > DNA_altCount
             if int(row[12]) > int(row[13]):
-                return f"{binom_test(int(row[9]), int(row[11]), 0.6)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 3/5
+                return binom_test(int(row[9]), int(row[11]), 0.6) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 3/5
             # if DNA_refCount < DNA_altCount
             else:
-                return f"{binom_test(int(row[9]), int(row[11]), 0.4)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 2/5
+                return binom_test(int(row[9]), int(row[11]), 0.4) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 2/5
 
         # CN = 1 or CN = -5
         elif int(row[14]) == 1 or int(row[14]) == -5:
             # if DNA_refCount > DNA_altCount
             if int(row[12]) > int(row[13]):
-                return f"{binom_test(int(row[9]), int(row[11]), 0.8)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 4/5
+                return binom_test(int(row[9]), int(row[11]), 0.8) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 4/5
                 # if DNA_refCount < DNA_altCount
             else:
-                return f"{binom_test(int(row[9]), int(row[11]), 0.2)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/5
+                return binom_test(int(row[9]), int(row[11]), 0.2) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/5
 
         # CN = 4
         elif int(row[14]) == 4:
             # if DNA_refCount > DNA_altCount
             if int(row[12]) > int(row[13]):
-                return f"{binom_test(int(row[9]), int(row[11]), 0.75)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 3/4
+                return binom_test(int(row[9]), int(row[11]), 0.75) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 3/4
             # if DNA_refCount < DNA_altCount
             else:
-                return f"{binom_test(int(row[9]), int(row[11]), 0.25)}" # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/4
+                return binom_test(int(row[9]), int(row[11]), 0.25) # Input: RNA_refCount, RNA_totalCount, CNV_ratio: 1/4
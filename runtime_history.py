@@ -0,0 +1,91 @@
+from os import path
+import math
+import sqlite3
+import time
+
+
+class RuntimeHistory():
+    '''This class stores the runtime and peak memory of every job and every stage run in a sqlite database that is shared by
+    all samples. Records are keyed by stage and input size (read bytes, BAM bytes or interval length), so the runtime and
+    memory of a new job can be predicted from earlier jobs of the same stage'''
+
+    def __init__(self, database):
+        self.database = database
+        # Predictions need at least this many earlier records of a stage
+        self.min_records = 3
+        # Suggested heap and packed memory are the largest peak seen times this margin
+        self.memory_margin = 1.2
+        with self.connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS runtimes (stage TEXT, shard TEXT, sample TEXT, input_size INTEGER,
+                                  elapsed REAL, peak_rss_mb REAL, threads INTEGER, recorded REAL)''')
+            connection.execute("CREATE INDEX IF NOT EXISTS runtimes_stage ON runtimes (stage, shard)")
+
+    #---------------------------------------------------------------------------
+    def connect(self):
+        '''Returns a connection to the database, several pipelines may write to it at the same time'''
+
+        return sqlite3.connect(self.database, timeout=60)
+
+    #---------------------------------------------------------------------------
+    def record(self, stage, shard, sample, input_size, elapsed, peak_rss_mb, threads):
+        '''Stores the runtime of a job (shard is the job name) or of a whole stage (shard is "-")'''
+
+        with self.connect() as connection:
+            connection.execute("INSERT INTO runtimes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (stage, shard, sample, input_size, elapsed, peak_rss_mb, threads, time.time()))
+
+    #---------------------------------------------------------------------------
+    def records(self, stage, whole_stage=False):
+        '''Returns (input_size, elapsed, peak_rss_mb) of the earlier jobs or stage runs of a stage'''
+
+        with self.connect() as connection:
+            return connection.execute(f"SELECT input_size, elapsed, peak_rss_mb FROM runtimes WHERE stage = ? AND shard {'=' if whole_stage else '!='} '-'", (stage,)).fetchall()
+
+    #---------------------------------------------------------------------------
+    def predict_elapsed(self, stage, input_size, whole_stage=False):
+        '''Returns the predicted runtime in seconds: the median runtime per input unit times input_size, or the median runtime if
+        the input size is unknown. Returns None if the stage has too few records (one earlier run is enough for a whole stage)'''
+
+        records = self.records(stage, whole_stage)
+        if len(records) < (1 if whole_stage else self.min_records):
+            return None
+        rates = sorted(elapsed / size for size, elapsed, _ in records if size)
+        if input_size and rates:
+            return rates[len(rates) // 2] * input_size
+        elapsed = sorted(elapsed for _, elapsed, _ in records)
+        return elapsed[len(elapsed) // 2]
+
+    #---------------------------------------------------------------------------
+    def predict_memory(self, stage):
+        '''Returns the predicted peak memory (GB, rounded up) of a job of the stage, or None if there are too few records'''
+
+        peaks = [peak for _, _, peak in self.records(stage) if peak]
+        if len(peaks) < self.min_records:
+            return None
+        return math.ceil(max(peaks) * self.memory_margin / 1024)
+
+    #---------------------------------------------------------------------------
+    def stages(self):
+        '''Returns the recorded stages in the order they were first run'''
+
+        with self.connect() as connection:
+            return [stage for stage, in connection.execute("SELECT stage FROM runtimes WHERE shard = '-' GROUP BY stage ORDER BY MIN(rowid)")]
+
+    #---------------------------------------------------------------------------
+    def dry_run(self, misc, sample, input_size, threads, memory):
+        '''This function prints the predicted runtime, peak memory and suggested heap of every recorded stage for a sample with
+        input_size read bytes, and the predicted makespan of the whole run'''
+
+        if not path.isfile(self.database) or not self.stages():
+            misc.log_to_file("WARNING", f"No runtime history in {self.database} yet, run a sample first")
+            return
+        misc.log_to_file("INFO", f"Dry run for {sample}: {input_size / 1024**3:.1f} GB of reads, {threads} threads, {memory} GB memory")
+        makespan = 0
+        for stage in self.stages():
+            elapsed = self.predict_elapsed(stage, input_size, whole_stage=True)
+            peak = self.predict_memory(stage)
+            jobs = len(self.records(stage)) // max(1, len(self.records(stage, whole_stage=True)))
+            makespan += elapsed or 0
+            misc.log_to_file("INFO", f"{stage:<16} ~{jobs} jobs  {misc.elapsed_time(elapsed) if elapsed else 'unknown':>14}  "
+                                     f"peak {f'{peak} GB' if peak else 'unknown':>8} per job  suggested -Xmx{f'{peak}g' if peak else '?'}"
+                                     f"{'  (more than the memory budget)' if peak and peak > memory else ''}")
+        misc.log_to_file("INFO", f"Predicted makespan: {misc.elapsed_time(makespan)}")
@@ -103,8 +103,8 @@ class SetupAnaconda3():
             shortcuts.rna_reads_dir,
             shortcuts.dna_reads_dir,
             shortcuts.star_output_dir,
-            shortcuts.star_index_dir,
-            shortcuts.reference_genome_chunks_dir,
+            shortcuts.star_index_cache_dir,
+            shortcuts.reference_genome_dir,
             ])
 
             if path.isdir(getenv("HOME")+'/anaconda3/envs/sequencing'):
@@ -132,15 +132,15 @@ Openpyxl
 Pandas
 Picard tools
 Python 3.7.6
-Samtools 1.9
+Samtools 1.15
 Scipy
 Snpeff 5.0
 STAR
 Vcfpy
 ''')
 
-            cmd_env = "conda create -n sequencing -c bioconda bedtools bcftools biopython bwa-mem2 gatk4 picard=2.25.2-0 python=3.7.6 samtools=1.9 star pandas vcfpy scipy snpeff openpyxl"
-            if misc.run_command(cmd_env, "Installing bedtools bcftools biopython bwa gatk4 picard python=3.7.6 samtools=1.9 star pandas vcfpy scipy snpeff=5.0", None, None):
+            cmd_env = "conda create -n sequencing -c bioconda bedtools bcftools biopython bwa-mem2 gatk4 picard=2.25.2-0 python=3.7.6 samtools=1.15 star pandas vcfpy scipy snpeff openpyxl pyarrow"
+            if misc.run_command(cmd_env, "Installing bedtools bcftools biopython bwa gatk4 picard python=3.7.6 samtools=1.15 star pandas vcfpy scipy snpeff=5.0 pyarrow", None, None):
 
                 # Delly in bioconda didn't work so I had to do a workaround
                 cmd_download_delly = "wget https://github.com/dellytools/delly/releases/download/v0.8.7/delly_v0.8.7_linux_x86_64bit -P $HOME/anaconda3/envs/sequencing/bin"
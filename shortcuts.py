@@ -1,4 +1,4 @@
-from os import getenv, sys
+from os import getenv, path, sys
 
 class Shortcuts():
     '''This class contains shortcuts to key files and folders neccessary for the program'''
@@ -13,13 +13,43 @@ class Shortcuts():
         # Shortcuts to input folders
         self.dna_reads_dir  = f"{self.dna_seq_dir}reads/{options.tumor_id}/"
         self.reference_genome_dir = f"{self.BASE_dir}reference_genome/"
-        self.reference_genome_chunks_dir = f"{self.reference_genome_dir}chunks/"
+        # Shared read-only folder with versioned reference bundles (--reference_bundle), see reference_bundle.py. The run uses the
+        # version current points to when it starts, without a bundle the indexes are in reference_genome_dir
+        reference_bundle = getattr(options, "reference_bundle", None)
+        self.reference_bundle_dir = f"{reference_bundle.rstrip('/')}/" if reference_bundle else None
+        if self.reference_bundle_dir and path.islink(f"{self.reference_bundle_dir}current"):
+            self.set_reference_index_dir(f"{path.realpath(f'{self.reference_bundle_dir}current')}/")
+        else:
+            self.set_reference_index_dir(f"{self.reference_bundle_dir}current/" if self.reference_bundle_dir else self.reference_genome_dir)
 
-        # Shortcuts to output folders in DNA sequencing analysis
-        self.aligned_output_dir = f"{self.dna_seq_dir}aligned/{options.tumor_id}/"
-        self.sorted_output_dir = f"{self.dna_seq_dir}sorted/"
-        self.merged_output_dir = f"{self.dna_seq_dir}merged/"
-        self.removed_duplicates_output_dir = f"{self.dna_seq_dir}removed_duplicates/{options.tumor_id}/"
+        # Shortcut to the scratch tier (local NVMe or tmpfs). Intermediate files and tool temp folders are placed there if it is
+        # configured with --scratch_dir or $BASE_SCRATCH, otherwise they stay in the persistent tree. Scratch is node-local, SLURM jobs
+        # on other nodes can not read it, so $BASE_SCRATCH is not used with --executor slurm (main.py rejects --scratch_dir with it)
+        scratch_dir = getattr(options, "scratch_dir", None) or (getenv("BASE_SCRATCH") if getattr(options, "executor", "local") == "local" else None)
+        self.scratch_dir = f"{scratch_dir.rstrip('/')}/BASE/" if scratch_dir else None
+        self.intermediate_dir = f"{self.scratch_dir}dna_seq/" if self.scratch_dir else self.dna_seq_dir
+        self.tmp_dir = f"{self.intermediate_dir}tmp/{options.tumor_id}/"
+        self.alignment_shards_dir = f"{self.tmp_dir}alignment_shards/"
+        self.realigned_shards_dir = f"{self.tmp_dir}realigned_shards/"
+        # Temp folder of the background bam validation, outside tmp_dir because that is removed after remove_duplicate
+        self.validation_tmp_dir = f"{self.intermediate_dir}validation_tmp/{options.tumor_id}/"
+        # Job scripts and logs of the executor, in the persistent tree so cluster nodes can reach them
+        self.executor_dir = f"{self.BASE_dir}executor/{options.tumor_id}/"
+        self.runtime_history_db = f"{self.BASE_dir}executor/runtime_history.sqlite"
+        # Live progress of the running stages and shards, see progress.py
+        self.progress_status_file = f"{self.executor_dir}status.json"
+        # snpEff annotations of all samples, see annotation_cache.py
+        self.snpeff_cache_db = f"{self.BASE_dir}annotation_cache/snpeff.sqlite"
+
+        # Shortcuts to output folders in DNA sequencing analysis (intermediates)
+        self.aligned_output_dir = f"{self.intermediate_dir}aligned/{options.tumor_id}/"
+        self.sorted_output_dir = f"{self.intermediate_dir}sorted/"
+        self.merged_output_dir = f"{self.intermediate_dir}merged/"
+        self.removed_duplicates_output_dir = f"{self.intermediate_dir}removed_duplicates/{options.tumor_id}/"
+        self.realigned_scratch_dir = f"{self.intermediate_dir}realigned/{options.tumor_id}/"
+        self.haplotypecaller_chunks_dir = f"{self.intermediate_dir}gatk_haplotypecaller/{options.tumor_id}/chunks/"
+
+        # Shortcuts to output folders in DNA sequencing analysis (final outputs, always in the persistent tree)
         self.realigned_output_dir = f"{self.dna_seq_dir}realigned/{options.tumor_id}/"
         self.haplotypecaller_output_dir = f"{self.dna_seq_dir}gatk_haplotypecaller/"
         self.delly_output_dir = f"{self.dna_seq_dir}delly/"
@@ -27,15 +57,23 @@ class Shortcuts():
         self.manta_variants_dir = f"{self.dna_seq_dir}manta/{options.tumor_id}/results/variants/"
 
         # Shortcuts to files used in DNA sequencing analysis
-        self.reference_genome_file = f"{self.reference_genome_dir}human_g1k_v37.fasta"
+        # The downloaded reference genome, the one that is indexed (and copied to the bundle with --reference_bundle)
+        self.reference_genome_source_file = f"{self.reference_genome_dir}human_g1k_v37.fasta"
+        self.dna_reads_manifest = f"{self.dna_seq_dir}{options.tumor_id}_manifest.json"
         self.reference_genome_exclude_template_file = f"{self.BASE_dir}excludeTemplate/human.hg38.excl.tsv"
+        # Reference contigs minus the exclude template (bgzipped and tabix indexed), the regions Manta calls in. The file name ends with a
+        # checksum of the reference .fai and the exclude template, see DnaSeqAnalysis.manta_call_regions()
+        self.manta_call_regions_prefix = f"{self.reference_genome_dir}manta_callRegions"
         self.configManta_file = getenv("HOME")+"/anaconda3/envs/sequencing/bin/manta-1.6.0.centos6_x86_64/bin/configManta.py"
         self.runWorkflow_file = getenv("HOME")+f"/BASE/dna_seq/manta/{options.tumor_id}/runWorkflow.py"
 
         # Shortcuts to folders used in RNA sequencing analysis
         self.rna_reads_dir  = f"{self.rna_seq_dir}reads/{options.tumor_id}/"
         self.star_output_dir = f"{self.rna_seq_dir}star/{options.tumor_id}/"
-        self.star_index_dir =  f"{self.reference_genome_dir}star_index/{options.tumor_id}/"
+        self.star_index_cache_dir =  f"{self.reference_genome_dir}star_index/"
+        self.star_cohort_dir = f"{self.rna_seq_dir}star/cohort/"
+        # ASE tables of all samples as one Parquet dataset, partitioned by Subgroup and Sample (--ase_format parquet)
+        self.ase_dataset_dir = f"{self.rna_seq_dir}ase_dataset/"
 
 
 
@@ -52,7 +90,16 @@ class Shortcuts():
         self.gatk_chunks_list = f"{self.haplotypecaller_output_dir}{options.tumor_id}/chunks.list"
 
         # Shortcuts to files used to validate if pipeline step is allready completed
-        self.bwa_index_complete = f"{self.reference_genome_dir}index.complete"
         self.haplotypecaller_complete = f"{self.haplotypecaller_output_dir}{options.tumor_id}/haplotypeCaller.complete"
         self.delly_complete = f"{self.delly_output_dir}{options.tumor_id}/delly.complete"
         self.manta_complete = f"{self.manta_output_dir}{options.tumor_id}/manta.complete"
+
+    #---------------------------------------------------------------------------
+    def set_reference_index_dir(self, reference_index_dir):
+        '''This function points the reference genome, its indexes and chunks to reference_index_dir (reference_genome_dir or a bundle version)'''
+
+        self.reference_index_dir = reference_index_dir
+        self.reference_genome_file = f"{reference_index_dir}human_g1k_v37.fasta"
+        self.reference_genome_chunks_dir = f"{reference_index_dir}chunks/"
+        # A bundle version is complete when its manifest exists, it is written last
+        self.bwa_index_complete = f"{reference_index_dir}{'manifest.json' if self.reference_bundle_dir else 'index.complete'}"
@@ -0,0 +1,84 @@
+from os import path, listdir, remove, replace, stat, sys
+from shutil import copy2, rmtree
+
+
+class Storage():
+    '''This class contains the storage policy of the pipeline. Intermediate files and tool temp directories are placed on the
+    scratch tier (shortcuts.intermediate_dir) if a scratch path is configured, declared final outputs are promoted to the
+    persistent tree with atomic moves and intermediates are reclaimed as soon as the last stage that reads them is finished'''
+
+    def __init__(self):
+        # stage : intermediates that stage is the last consumer of
+        self.last_consumer = {
+            "sort": ["aligned"],
+            "merge": ["sorted"],
+            "remove_duplicate": ["merged"],
+            "realign": ["removed_duplicates"],
+            "gatk_haplotype": ["haplotypecaller_chunks"],
+            }
+        # Intermediates that are removed even when they are kept on the persistent tree (no scratch path configured)
+        self.always_released = ["sorted", "merged"]
+
+    #---------------------------------------------------------------------------
+    def intermediate_folder(self, options, shortcuts, intermediate):
+        '''Returns the folder where the files of an intermediate are written for this sample'''
+
+        return {
+            "aligned": shortcuts.aligned_output_dir,
+            "sorted": f"{shortcuts.sorted_output_dir}{options.tumor_id}/",
+            "merged": f"{shortcuts.merged_output_dir}{options.tumor_id}/",
+            "removed_duplicates": f"{shortcuts.removed_duplicates_output_dir}{options.tumor_id}/",
+            "haplotypecaller_chunks": shortcuts.haplotypecaller_chunks_dir,
+            }[intermediate]
+
+    #---------------------------------------------------------------------------
+    def on_scratch(self, shortcuts, file):
+        '''Returns True if file is located on the scratch tier'''
+
+        return bool(shortcuts.scratch_dir) and path.abspath(file).startswith(path.abspath(shortcuts.scratch_dir))
+
+    #---------------------------------------------------------------------------
+    def promote(self, misc, source, destination):
+        '''This function moves a final output from the scratch tier to the persistent tree. The file is first copied next to
+        the destination and then renamed, so the destination is either missing or complete, never half written'''
+
+        try:
+            if stat(source).st_dev == stat(path.dirname(destination) or ".").st_dev:
+                replace(source, destination)
+            else:
+                copy2(source, f"{destination}.partial")
+                replace(f"{destination}.partial", destination)
+                remove(source)
+            misc.log_to_file("INFO", f"Promoted {source} to {destination} - OK!")
+        except Exception as e:
+            misc.log_exception(".promote() in storage.py:", e)
+            sys.exit()
+
+    #---------------------------------------------------------------------------
+    def promote_outputs(self, misc, source_dir, destination_dir, prefix):
+        '''This function promotes all files in source_dir starting with prefix (e.g. a BAM and its index) to destination_dir'''
+
+        misc.create_directory([destination_dir])
+        for file in sorted(listdir(source_dir)):
+            if file.startswith(prefix) and not file.endswith(".complete"):
+                self.promote(misc, f"{source_dir}{file}", f"{destination_dir}{file}")
+
+    #---------------------------------------------------------------------------
+    def stage_finished(self, options, misc, shortcuts, stage):
+        '''This function reclaims the intermediate folders whose last consumer is stage. Folders on the scratch tier are
+        always reclaimed, folders on the persistent tree only if they were removed before the storage policy existed'''
+
+        try:
+            for intermediate in self.last_consumer.get(stage, []):
+                folder = self.intermediate_folder(options, shortcuts, intermediate)
+                if not self.on_scratch(shortcuts, folder) and intermediate not in self.always_released:
+                    continue
+                if path.isdir(folder):
+                    for file in listdir(folder):
+                        if file.endswith((".bam", ".bai", ".vcf", ".idx")):
+                            remove(f"{folder}{file}")
+                    misc.log_to_file("INFO", f"Intermediate {intermediate} files in {folder} reclaimed after {stage} - OK!")
+            if stage == "remove_duplicate" and shortcuts.scratch_dir:
+                rmtree(shortcuts.tmp_dir, ignore_errors=True)
+        except Exception as e:
+            misc.log_exception(".stage_finished() in storage.py:", e)